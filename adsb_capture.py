@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""client.pyで受信したADSB_VEHICLEの列形式の記録と集計
+
+デコードしたフィールドを事前に確保した配列(チャンク)に1行ずつ書き込み、チャンクが埋まるたびにファイルに書き出す。
+
+- 出力先の名前が.parquetで終わるとき: 1つのParquetファイル。チャンクごとに1つのrow groupになる(pyarrowが必要)
+- それ以外: ディレクトリに part-00000.npz, part-00001.npz, ... の順に書き出す。
+  既にpartがあるディレクトリには、その続きの番号で追記する
+
+集計はNumPyの配列演算だけで行うので、数百万行でも数秒で終わる。
+
+    $ python3 client.py -d udpin:localhost:14550 --capture capture
+    $ python3 adsb_capture.py summary capture
+"""
+import os
+import glob
+import argparse
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# (列名, dtype)
+COLUMNS = (
+    ('time', 'f8'),             # 受信時刻(epoch秒)
+    ('icao', 'u4'),
+    ('lat', 'i4'),              # [degE7]
+    ('lon', 'i4'),              # [degE7]
+    ('altitude', 'i4'),         # [mm]
+    ('heading', 'u2'),          # [cdeg]
+    ('hor_velocity', 'u2'),     # [cm/s]
+    ('ver_velocity', 'i2'),     # [cm/s]
+    ('flags', 'u2'),
+    ('squawk', 'u2'),
+    ('tslc', 'u1'),             # [s]
+    ('emitter_type', 'u1'),
+    ('callsign', 'S9'),
+)
+DTYPE = np.dtype(list(COLUMNS))
+
+# ADSB_FLAGS
+FLAGS = (
+    ('VALID_COORDS', 1),
+    ('VALID_ALTITUDE', 2),
+    ('VALID_HEADING', 4),
+    ('VALID_VELOCITY', 8),
+    ('VALID_CALLSIGN', 16),
+    ('VALID_SQUAWK', 32),
+    ('SIMULATED', 64),
+    ('VERTICAL_VELOCITY_VALID', 128),
+    ('BARO_VALID', 256),
+    ('SOURCE_UAT', 32768),
+)
+
+
+def list_parts(path: str) -> list:
+    '''ディレクトリのpartを番号順に (番号, パス) のリストで返す'''
+    parts = []
+    for part in glob.glob(os.path.join(path, 'part-*.npz')):
+        try:
+            parts.append((int(os.path.basename(part)[5:-4]), part))
+        except ValueError:
+            pass
+    parts.sort()
+    return parts
+
+
+def next_part(path: str) -> int:
+    '''ディレクトリにある最大のpart番号の次の番号'''
+    parts = list_parts(path)
+    return parts[-1][0] + 1 if parts else 0
+
+
+class AdsbCapture:
+    """ADSB_VEHICLEをチャンク単位で列形式のファイルに書き出す"""
+
+    CHUNK = 65536
+
+    def __init__(self, path: str, chunk: int = CHUNK) -> None:
+        self.path = path
+        self.parquet = path.endswith('.parquet')
+        if self.parquet and pa is None:
+            raise ValueError(f'{path}: Parquet needs pyarrow')
+        if not self.parquet:
+            os.makedirs(path, exist_ok=True)
+        self.buf = np.empty(chunk, dtype=DTYPE)
+        self.n = 0
+        self.rows = 0
+        self.parts = 0 if self.parquet else next_part(path)
+        self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, msg, t: float) -> None:
+        self.buf[self.n] = (t, msg.ICAO_address, msg.lat, msg.lon, msg.altitude, msg.heading,
+            msg.hor_velocity, msg.ver_velocity, msg.flags, msg.squawk, msg.tslc, msg.emitter_type,
+            msg.callsign.encode(errors='replace'))
+        self.n += 1
+        if self.n == len(self.buf):
+            self.flush()
+
+    def extend(self, msgs: list, t: float) -> None:
+        '''同じ受信時刻のメッセージをまとめて追加する。ADSB_VEHICLE以外は無視する'''
+        for msg in msgs:
+            if msg.get_type() == 'ADSB_VEHICLE':
+                self.append(msg, t)
+
+    def flush(self) -> None:
+        if self.n == 0:
+            return
+        chunk = self.buf[:self.n]
+        if self.parquet:
+            table = pa.table({name: chunk[name] for name, _ in COLUMNS})
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            np.savez(os.path.join(self.path, f'part-{self.parts:05d}.npz'),
+                **{name: chunk[name] for name, _ in COLUMNS})
+        self.rows += self.n
+        self.parts += 1
+        self.n = 0
+
+    def close(self) -> None:
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def load(path: str, columns=None) -> dict:
+    '''記録を {列名: 配列} として読み込む'''
+    names = columns or [name for name, _ in COLUMNS]
+    if path.endswith('.parquet'):
+        if pa is None:
+            raise ValueError(f'{path}: Parquet needs pyarrow')
+        table = pq.read_table(path, columns=names)
+        return {name: table.column(name).to_numpy() for name in names}
+
+    parts = [part for _, part in list_parts(path)]
+    if not parts:
+        raise ValueError(f'{path}: no capture parts')
+    arrays = {name: [] for name in names}
+    for part in parts:
+        with np.load(part) as z:
+            for name in names:
+                arrays[name].append(z[name])
+    return {name: np.concatenate(a) for name, a in arrays.items()}
+
+
+def summary(data: dict) -> dict:
+    '''受信レート、機体ごとの更新間隔、フラグの有効率を計算する'''
+    t = data['time']
+    icao = data['icao']
+    flags = data['flags']
+    rows = len(t)
+    if rows == 0:
+        return {'rows': 0}
+
+    t0 = t.min()
+    duration = float(t.max() - t0)
+    per_sec = np.bincount((t - t0).astype(np.int64))
+
+    # 機体ごとに受信時刻順に並べ、同じ機体の隣り合う行の差を更新間隔とする
+    order = np.lexsort((t, icao))
+    ic = icao[order]
+    same = ic[1:] == ic[:-1]
+    intervals = np.diff(t[order])[same]
+    aircraft, counts = np.unique(icao, return_counts=True)
+
+    coverage = {}
+    for name, bit in FLAGS:
+        has = (flags & bit) != 0
+        coverage[name] = (
+            float(np.count_nonzero(has)) / rows,
+            float(len(np.unique(icao[has]))) / len(aircraft),
+        )
+
+    def pct(a, q):
+        return float(np.percentile(a, q)) if len(a) else float('nan')
+
+    return {
+        'rows': rows,
+        'duration': duration,
+        'rate': rows / duration if duration > 0 else float('nan'),
+        'rate_p50': pct(per_sec, 50),
+        'rate_max': int(per_sec.max()),
+        'aircraft': len(aircraft),
+        'msgs_per_aircraft_p50': pct(counts, 50),
+        'msgs_per_aircraft_max': int(counts.max()),
+        'interval_p50': pct(intervals, 50),
+        'interval_p90': pct(intervals, 90),
+        'interval_p99': pct(intervals, 99),
+        'interval_max': float(intervals.max()) if len(intervals) else float('nan'),
+        'tslc_mean': float(data['tslc'].mean()),
+        'tslc_max': int(data['tslc'].max()),
+        'coverage': coverage,
+    }
+
+
+def print_summary(s: dict) -> None:
+    if s['rows'] == 0:
+        print('no ADSB_VEHICLE')
+        return
+    print(f'{s["rows"]} rows {s["duration"]:.1f}s {s["aircraft"]} aircraft')
+    print(f'rate: mean {s["rate"]:.1f} msgs/s p50 {s["rate_p50"]:.0f} max {s["rate_max"]}')
+    print(f'per aircraft: p50 {s["msgs_per_aircraft_p50"]:.0f} msgs max {s["msgs_per_aircraft_max"]}')
+    print(f'update interval: p50 {s["interval_p50"]:.3f}s p90 {s["interval_p90"]:.3f}s'
+        f' p99 {s["interval_p99"]:.3f}s max {s["interval_max"]:.3f}s')
+    print(f'tslc: mean {s["tslc_mean"]:.2f}s max {s["tslc_max"]}s')
+    print(f'{"flag":<24} {"rows":>7} {"aircraft":>9}')
+    for name, (rows, aircraft) in s['coverage'].items():
+        print(f'{name:<24} {rows * 100:6.1f}% {aircraft * 100:8.1f}%')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize ADSB_VEHICLE captured by client.py.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('summary', help='message rates, update intervals and flag coverage')
+    p.add_argument('path', type=str, help='capture directory or .parquet file')
+    args = parser.parse_args()
+
+    if args.command == 'summary':
+        print_summary(summary(load(args.path, ['time', 'icao', 'flags', 'tslc'])))
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""ICAOアドレスから機体の区分(ADSB_EMITTER_TYPE)と登録記号を引く機体データベース
+
+機体登録のCSV(OpenSkyのaircraftDatabase.csvなど)を1度だけ変換して、ICAOアドレス順に並べたバイナリファイルを作る。
+実行時はファイルをmmapし、ICAOアドレスの配列を二分探索する。CSVは読まないので起動は速く、
+結果はlru_cacheでキャッシュする。
+
+ファイルの形式(リトルエンディアン)
+
+    MAGIC(8) 件数(uint32) 予約(uint32)
+    ICAOアドレス(uint32) x 件数            昇順
+    区分(uint8) 登録記号(8バイト) x 件数   ICAOアドレスと同じ順
+
+    $ python3 aircraft_db.py build aircraftDatabase.csv -o aircraft.db
+    $ python3 aircraft_db.py lookup aircraft.db 86D5B4 8500F1
+    $ python3 sbs2mav.py --aircraft-db aircraft.db
+"""
+import os
+import csv
+import sys
+import mmap
+import time
+import array
+import bisect
+import struct
+import argparse
+import functools
+
+MAGIC = b'ACDB1\n\0\0'
+HEADER = struct.Struct('<8sII')
+ICAO = struct.Struct('<I')
+RECORD = struct.Struct('<B8s')
+
+# CSVの列名の候補(小文字)
+ICAO_COLUMNS = ('icao24', 'icao', 'hex', 'icao_address')
+REGISTRATION_COLUMNS = ('registration', 'reg')
+CATEGORY_COLUMNS = ('emitter_type', 'category', 'emittercategory')
+DESCRIPTION_COLUMNS = ('categorydescription',)
+TYPE_COLUMNS = ('icaoaircrafttype', 'icaoaircraftclass', 'aircraft_class')
+
+# ADSB_EMITTER_TYPEの最大値(POINT_OBSTACLE)。これを超える値は0(NO_INFO)にする
+MAX_EMITTER_TYPE = 19
+
+# OpenSkyのcategoryDescriptionの書き出し -> ADSB_EMITTER_TYPE
+# 先に一致したものを使うので、他の書き出しで始まるものを先に置く('lighter-than-air' と 'light')
+DESCRIPTIONS = (
+    ('lighter-than-air', 10),
+    ('light', 1),
+    ('small', 2),
+    ('large', 3),
+    ('high vortex', 4),
+    ('heavy', 5),
+    ('high performance', 6),
+    ('rotorcraft', 7),
+    ('glider', 9),
+    ('parachutist', 11),
+    ('ultralight', 12),
+    ('unmanned', 14),
+    ('space', 15),
+)
+
+
+def parse_category(value: str) -> int:
+    '''ADSB_EMITTER_TYPEの数値か、ADS-Bの区分(A0〜A7, B0〜B7, C0〜C3)を変換する。不明なら0'''
+    value = value.strip().upper()
+    if value.isdigit():
+        n = int(value)
+    elif len(value) == 2 and value[0] in 'ABC' and value[1] in '1234567':
+        n = 'ABC'.index(value[0]) * 8 + int(value[1])
+    else:
+        # A0, B0, C0 は「区分の情報なし」
+        return 0
+    return n if n <= MAX_EMITTER_TYPE else 0
+
+
+def parse_description(value: str) -> int:
+    value = value.strip().lower()
+    for prefix, emitter_type in DESCRIPTIONS:
+        if value.startswith(prefix):
+            return emitter_type
+    return 0
+
+
+def parse_aircraft_type(value: str) -> int:
+    '''ICAOの機種区分(L2J など: 形態, エンジン数, エンジン種別)から大まかに推定する'''
+    value = value.strip().upper()
+    if len(value) != 3:
+        return 0
+    kind, engines, engine = value
+    if kind in 'HG':
+        return 7                # ROTOCRAFT
+    if kind not in 'LSAT' or not engines.isdigit():
+        return 0
+    if engine == 'J':
+        return 5 if int(engines) >= 3 else 3    # HEAVY / LARGE
+    if engine == 'T':
+        return 2                # SMALL
+    if engine in 'PE':
+        return 1                # LIGHT
+    return 0
+
+
+def find_column(fields: list, names: tuple):
+    for i, name in enumerate(fields):
+        if name.strip().strip("'\"").lower() in names:
+            return i
+    return None
+
+
+def read_csv(path: str) -> dict:
+    '''{ICAO: (区分, 登録記号)}。同じICAOが複数あれば後の行を使う'''
+    table = {}
+    with open(path, newline='', encoding='utf-8', errors='replace') as f:
+        # OpenSkyのダンプは ' で囲んでいる('icao24','registration',...)
+        quotechar = "'" if f.readline().lstrip().startswith("'") else '"'
+        f.seek(0)
+        reader = csv.reader(f, quotechar=quotechar)
+        fields = next(reader)
+        icao_col = find_column(fields, ICAO_COLUMNS)
+        if icao_col is None:
+            raise ValueError(f'{path}: no ICAO column ({", ".join(ICAO_COLUMNS)})')
+        reg_col = find_column(fields, REGISTRATION_COLUMNS)
+        cat_col = find_column(fields, CATEGORY_COLUMNS)
+        desc_col = find_column(fields, DESCRIPTION_COLUMNS)
+        type_col = find_column(fields, TYPE_COLUMNS)
+        for row in reader:
+            try:
+                icao = int(row[icao_col].strip().strip("'"), 16)
+            except (ValueError, IndexError):
+                continue
+            if not 0 <= icao <= 0xFFFFFF:
+                continue
+            get = lambda col: row[col] if col is not None and col < len(row) else ''
+            emitter_type = parse_category(get(cat_col)) or parse_description(get(desc_col)) \
+                or parse_aircraft_type(get(type_col))
+            registration = get(reg_col).strip().upper().encode('ascii', 'ignore')[:8]
+            if emitter_type or registration:
+                table[icao] = (emitter_type, registration)
+    return table
+
+
+def build(csv_path: str, out_path: str) -> int:
+    '''CSVからデータベースを作り、件数を返す。書き込み途中のファイルは残さない'''
+    table = read_csv(csv_path)
+    keys = sorted(table)
+    tmp = out_path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(keys), 0))
+        f.write(array.array('I', keys).tobytes() if sys.byteorder == 'little'
+            else b''.join(ICAO.pack(k) for k in keys))
+        f.write(b''.join(RECORD.pack(*table[k]) for k in keys))
+    os.replace(tmp, out_path)
+    return len(keys)
+
+
+class AircraftDb:
+    """機体データベースの検索"""
+
+    def __init__(self, path: str, cache_size: int = 65536) -> None:
+        self.path = path
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, _ = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or len(self.mm) < HEADER.size + self.count * (ICAO.size + RECORD.size):
+            self.close()
+            raise ValueError(f'{path}: not an aircraft database')
+        end = HEADER.size + self.count * ICAO.size
+        if sys.byteorder == 'little':
+            # mmapのままuint32の配列として二分探索する
+            self.keys = memoryview(self.mm)[HEADER.size:end].cast('I')
+        else:
+            self.keys = array.array('I', self.mm[HEADER.size:end])
+            self.keys.byteswap()
+        self.records = end
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _lookup(self, icao: int):
+        '''(区分, 登録記号) を返す。無ければNone'''
+        i = bisect.bisect_left(self.keys, icao)
+        if i == self.count or self.keys[i] != icao:
+            return None
+        emitter_type, registration = RECORD.unpack_from(self.mm, self.records + i * RECORD.size)
+        return (emitter_type, registration.rstrip(b'\0').decode('ascii'))
+
+    def close(self) -> None:
+        if isinstance(getattr(self, 'keys', None), memoryview):
+            self.keys.release()
+        self.mm.close()
+        self.file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build and query the ICAO aircraft database.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('build', help='convert an aircraft registry CSV')
+    p.add_argument('csv', type=str, help='CSV with an ICAO column (icao24) and registration / category / icaoaircrafttype')
+    p.add_argument('-o', '--output', type=str, required=True, help='output database file')
+    p = sub.add_parser('lookup', help='look up ICAO addresses')
+    p.add_argument('db', type=str, help='database file')
+    p.add_argument('icao', type=str, nargs='+', help='ICAO address in hex')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        t = time.perf_counter()
+        n = build(args.csv, args.output)
+        print(f'{n} aircraft to {args.output} in {time.perf_counter() - t:.1f}s')
+    else:
+        db = AircraftDb(args.db)
+        for icao in args.icao:
+            t = time.perf_counter()
+            result = db._lookup(int(icao, 16))
+            print(f'{icao.upper()} {result} {(time.perf_counter() - t) * 1e6:.1f}us')
+        db.close()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""sbs2mavのエンドツーエンドベンチマーク
+
+模擬トラフィックのSBSサーバ(sbs_generator)、ブリッジ(main_sbs + main_mav)、UDPの受信側をそれぞれ別プロセスで動かし、
+航空機の数ごとに次の値を測る。
+
+- 解析した行数/秒
+- 1000行あたりのCPU時間(ブリッジのプロセス)
+- ブリッジの最大RSS
+- SBSの位置の行を送ってからADSB_VEHICLEを受信するまでの遅延(p50/p99)
+
+    $ python3 bench/bench_e2e.py
+    $ python3 bench/bench_e2e.py -n 10 100 -d 5 --emit periodic
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import multiprocessing as mp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, BENCH_DIR)
+
+
+def run_generator(n: int, rate: float, duration: float, port_q, result_q):
+    from sbs_generator import TrafficGenerator, serve
+
+    gen = TrafficGenerator(n, rate)
+    gen.position_log = {}
+    asyncio.run(serve(gen, '127.0.0.1', 0, duration, ready=port_q.put))
+    result_q.put(gen.position_log)
+
+
+def run_sink(sock: socket.socket, duration: float, result_q):
+    os.environ['MAVLINK20'] = '1'
+    from pymavlink import mavutil
+
+    mav = mavutil.mavlink.MAVLink(None)
+    sock.settimeout(0.2)
+    received = {}
+    count = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        try:
+            data = sock.recv(65536)
+        except socket.timeout:
+            continue
+        now = time.time()
+        for msg in mav.parse_buffer(data) or []:
+            if msg.get_type() == 'ADSB_VEHICLE':
+                count += 1
+                received.setdefault((msg.ICAO_address, round(msg.lat / 100), round(msg.lon / 100)), now)
+    result_q.put((count, received))
+
+
+def run_bridge(sbs_port: int, sink_port: int, duration: float, emit: str, result_q):
+    sys.stdout = open(os.devnull, 'w')
+    import sbs2mav
+    # pymavlinkの読み込み(dialectの生成)をブリッジのCPU時間に含めない
+    sbs2mav.load_mavlink()
+
+    async def main():
+        model = sbs2mav.SbsModel()
+        sbs = sbs2mav.SbsClient(model, '127.0.0.1', sbs_port)
+        emitter = sbs2mav.AdsbEmitter(model, emit == 'change')
+        scheduler = sbs2mav.AdsbScheduler(None, sbs2mav.Ownship())
+        tasks = [
+            asyncio.create_task(sbs2mav.main_mav(model, [f'udpout:127.0.0.1:{sink_port}'], 57600, emitter, scheduler)),
+            asyncio.create_task(sbs2mav.run_sbs(model, sbs)),
+        ]
+        start = time.perf_counter()
+        cpu = time.process_time()
+        await asyncio.sleep(duration)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu
+        for t in tasks:
+            t.cancel()
+        return {
+            'lines': sbs.lines,
+            'bytes': sbs.bytes,
+            'vehicles': len(model.vehicles),
+            'sent': scheduler.sent,
+            'elapsed': elapsed,
+            'cpu': cpu,
+            'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+    result_q.put(asyncio.run(main()))
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench(ctx, n: int, rate: float, duration: float, emit: str) -> dict:
+    port_q = ctx.Queue()
+    gen_q = ctx.Queue()
+    sink_q = ctx.Queue()
+    bridge_q = ctx.Queue()
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink_port = sink.getsockname()[1]
+
+    # 接続と終了処理の分の余裕を持たせる
+    gen_p = ctx.Process(target=run_generator, args=(n, rate, duration + 2, port_q, gen_q))
+    gen_p.start()
+    sbs_port = port_q.get(timeout=30)
+    sink_p = ctx.Process(target=run_sink, args=(sink, duration + 1.5, sink_q))
+    sink_p.start()
+    bridge_p = ctx.Process(target=run_bridge, args=(sbs_port, sink_port, duration, emit, bridge_q))
+    bridge_p.start()
+
+    result = bridge_q.get()
+    count, received = sink_q.get()
+    emitted = gen_q.get()
+    for p in (gen_p, sink_p, bridge_p):
+        p.join()
+    sink.close()
+
+    latency = [(received[k] - t) * 1000 for k, t in emitted.items() if k in received]
+    result.update({
+        'aircraft': n,
+        'rate': rate,
+        'received': count,
+        'samples': len(latency),
+        'p50': percentile(latency, 50),
+        'p99': percentile(latency, 99),
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sbs2mav end-to-end benchmark.')
+    parser.add_argument('-n', '--aircraft', type=int, nargs='+', default=[10, 100, 1000, 5000], help='numbers of aircraft. default=10 100 1000 5000')
+    parser.add_argument('-r', '--rate', type=float, default=5, help='lines/s per aircraft. default=5')
+    parser.add_argument('--max-rate', type=float, default=20000, help='upper limit of aggregate lines/s. default=20000')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds per run. default=10')
+    parser.add_argument('--emit', choices=['periodic', 'change'], default='change', help='ADSB_VEHICLE emission mode. default=change')
+    args = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    print(f'{"aircraft":>8} {"rate":>7} {"lines/s":>9} {"cpu ms/1k":>10} {"maxrss MB":>10}'
+        f' {"adsb/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"samples":>8}')
+    for n in args.aircraft:
+        rate = min(n * args.rate, args.max_rate)
+        r = bench(ctx, n, rate, args.duration, args.emit)
+        # ru_maxrssはLinuxではKiB、macOSではbyte
+        rss = r['maxrss'] / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        print(f'{n:8} {rate:7.0f} {r["lines"] / r["elapsed"]:9.0f} {r["cpu"] * 1e6 / max(r["lines"], 1):10.2f}'
+            f' {rss:10.1f} {r["received"] / r["elapsed"]:8.0f} {r["p50"]:8.1f} {r["p99"]:8.1f} {r["samples"]:8}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""sbs2mavの起動から最初のADSB_VEHICLEまでの時間を測る
+
+模擬トラフィックのSBSサーバ(sbs_generator)を起動しておき、sbs2mavのプロセスを起動してから
+UDPで次のものを受信するまでの時間を繰り返し測る。
+
+- 最初のADSB_VEHICLE
+- 位置・高度・コールサインが全て有効な最初のADSB_VEHICLE
+
+    $ python3 bench/bench_startup.py
+    $ python3 bench/bench_startup.py --snapshot /tmp/sbs2mav.snap
+"""
+import os
+import sys
+import time
+import socket
+import struct
+import argparse
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, '..')
+
+MSG_ID_ADSB_VEHICLE = 246
+# ADSB_FLAGS: VALID_COORDS | VALID_ALTITUDE | VALID_CALLSIGN
+COMPLETE = 0x0001 | 0x0002 | 0x0010
+
+
+def adsb_flags(frame: bytes):
+    '''ADSB_VEHICLEならflagsを返す。それ以外はNone'''
+    if frame[0] == 0xFE and len(frame) >= 6 + 24 and frame[5] == MSG_ID_ADSB_VEHICLE:
+        return struct.unpack_from('<H', frame, 6 + 22)[0]
+    if frame[0] == 0xFD and len(frame) >= 10 + 24 and frame[7:10] == bytes((MSG_ID_ADSB_VEHICLE, 0, 0)):
+        return struct.unpack_from('<H', frame, 10 + 22)[0]
+    return None
+
+
+def wait_port(port: int, timeout: float = 10) -> None:
+    end = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            if time.monotonic() > end:
+                raise
+            time.sleep(0.05)
+
+
+def drain(sink: socket.socket) -> None:
+    '''前回の実行の残りのデータグラムを捨てる'''
+    sink.setblocking(False)
+    try:
+        while True:
+            sink.recv(65536)
+    except BlockingIOError:
+        pass
+    finally:
+        sink.setblocking(True)
+
+
+def run_once(script: str, sbs_port: int, sink: socket.socket, extra: list, timeout: float, hold: float = 0) -> tuple:
+    '''holdを指定したときは、その秒数が経つまで終了させない(スナップショットを書かせるため)'''
+    sink_port = sink.getsockname()[1]
+    drain(sink)
+    start = time.perf_counter()
+    p = subprocess.Popen([sys.executable, script, '--host', '127.0.0.1', '-p', str(sbs_port),
+        '-d', f'udpout:127.0.0.1:{sink_port}', '--display', 'none', '--emit', 'change', *extra],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first = complete = None
+    end = start + timeout
+    try:
+        while complete is None and time.perf_counter() < end:
+            sink.settimeout(max(end - time.perf_counter(), 0.01))
+            try:
+                frame = sink.recv(65536)
+            except socket.timeout:
+                break
+            flags = adsb_flags(frame)
+            if flags is None:
+                continue
+            now = time.perf_counter() - start
+            if first is None:
+                first = now
+            if flags & COMPLETE == COMPLETE:
+                complete = now
+        time.sleep(max(start + hold - time.perf_counter(), 0))
+    finally:
+        p.terminate()
+        p.wait()
+    return first, complete
+
+
+def main():
+    parser = argparse.ArgumentParser(description='sbs2mav time to first ADSB_VEHICLE.')
+    parser.add_argument('-n', '--runs', type=int, default=10, help='number of runs. default=10')
+    parser.add_argument('--aircraft', type=int, default=200, help='simulated aircraft. default=200')
+    parser.add_argument('--script', type=str, default=os.path.join(ROOT, 'sbs2mav.py'), help='sbs2mav.py to run')
+    parser.add_argument('--snapshot', type=str, default=None, help='pass --snapshot to sbs2mav (warm start after the first run)')
+    parser.add_argument('--sbs-port', type=int, default=30199, help='port of the simulated SBS server. default=30199')
+    parser.add_argument('--timeout', type=float, default=20, help='seconds to wait per run. default=20')
+    args = parser.parse_args()
+
+    gen = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'sbs_generator.py'), '-n', str(args.aircraft),
+        '--host', '127.0.0.1', '-p', str(args.sbs_port)], stdout=subprocess.DEVNULL)
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    extra = ['--snapshot', args.snapshot, '--snapshot-interval', '1'] if args.snapshot else []
+    try:
+        wait_port(args.sbs_port)
+        # 生成側の航空機が一通り出そろうまで待つ
+        time.sleep(2)
+        firsts = []
+        completes = []
+        for i in range(args.runs):
+            hold = 3 if args.snapshot and i == 0 else 0
+            first, complete = run_once(args.script, args.sbs_port, sink, extra, args.timeout, hold)
+            print(f'run {i}: first {first and first * 1000:.0f}ms complete {complete and complete * 1000:.0f}ms'
+                if first is not None and complete is not None else f'run {i}: first {first} complete {complete}')
+            if first is not None:
+                firsts.append(first)
+            if complete is not None:
+                completes.append(complete)
+            if args.snapshot and i == 0:
+                # 1回目はスナップショットを書くための実行とし、集計から外す
+                firsts.clear()
+                completes.clear()
+        if firsts:
+            print(f'first ADSB_VEHICLE: median {statistics.median(firsts) * 1000:.0f}ms min {min(firsts) * 1000:.0f}ms')
+        if completes:
+            print(f'first complete ADSB_VEHICLE: median {statistics.median(completes) * 1000:.0f}ms min {min(completes) * 1000:.0f}ms')
+    finally:
+        gen.terminate()
+        gen.wait()
+        sink.close()
+
+
+if __name__ == "__main__":
+    main()
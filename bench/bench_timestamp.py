@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""SBSタイムスタンプ変換のマイクロベンチマーク
+
+dateutilによる従来の変換(parser.parse + astimezone)と SbsTimeDecoder を比較する。
+
+    $ python3 bench/bench_timestamp.py [recorded.sbs]
+
+引数を省略した場合は組み込みのサンプル行を使う。
+"""
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tzlocal import get_localzone
+from dateutil import parser, tz
+from sbs2mav import SbsTimeDecoder
+
+SAMPLE = [
+    'MSG,3,1,1,86D4A2,1,2023/05/01,12:34:56.789,2023/05/01,12:34:56.812,,38000,,,35.54321,139.76543,,,0,,0,0',
+    'MSG,4,1,1,86D4A2,1,2023/05/01,12:34:57.016,2023/05/01,12:34:57.041,,,452,271,,,-64,,0,,0,0',
+    'MSG,1,1,1,86D4A2,1,2023/05/01,12:34:57.530,2023/05/01,12:34:57.551,JAL123  ,,,,,,,,0,,0,0',
+    'MSG,5,1,1,A1B2C3,1,2023/05/01,23:59:59.999,2023/05/02,00:00:00.021,,2500,,,,,,,0,,0,0',
+    'MSG,6,1,1,A1B2C3,1,2023/05/02,00:00:00.430,2023/05/02,00:00:00.452,,,,,,,,7700,0,1,0,0',
+]
+
+
+def load_lines(path: str) -> list:
+    lines = []
+    with open(path, 'r', errors='replace') as f:
+        for row in f:
+            line = row.rstrip('\r\n').split(',')
+            if line[0] == 'MSG' and len(line) >= 22:
+                lines.append(line)
+    return lines
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='SBS timestamp decoder micro benchmark.')
+    arg_parser.add_argument('file', nargs='?', help='recorded SBS lines (port 30003 dump)')
+    arg_parser.add_argument('-n', '--number', type=int, default=5, help='repeat count. default=5')
+    args = arg_parser.parse_args()
+
+    lines = load_lines(args.file) if args.file else [l.split(',') for l in SAMPLE]
+    if not lines:
+        sys.exit('no MSG lines')
+
+    zone = tz.gettz(str(get_localzone()))
+    decoder = SbsTimeDecoder()
+
+    def run_dateutil():
+        for line in lines:
+            parser.parse(f'{line[6]} {line[7]}').astimezone(zone)
+            parser.parse(f'{line[8]} {line[9]}').astimezone(zone)
+
+    def run_decoder():
+        for line in lines:
+            decoder.decode(line[6], line[7])
+            decoder.decode(line[8], line[9])
+
+    # 変換結果が一致することを確認
+    for line in lines:
+        expect = parser.parse(f'{line[6]} {line[7]}').astimezone(zone).timestamp()
+        actual = decoder.decode(line[6], line[7])
+        if abs(expect - actual) > 1e-6:
+            sys.exit(f'mismatch: {line[6]} {line[7]} dateutil={expect} decoder={actual}')
+
+    loops = max(1, 20000 // len(lines))
+    for name, func in (('dateutil', run_dateutil), ('SbsTimeDecoder', run_decoder)):
+        best = min(timeit.repeat(func, number=loops, repeat=args.number))
+        per_line = best / (loops * len(lines))
+        print(f'{name:15} {per_line * 1e6:8.3f} us/line {1 / per_line:12.0f} lines/s')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""模擬航空機のSBS(ポート30003)トラフィックを生成するTCPサーバ
+
+N機の航空機を基準点の周りで直線飛行させ、MSG 1〜8を全体でrate行/秒の割合で配信する。
+
+    $ python3 bench/sbs_generator.py -n 1000 -r 5000 -p 30003
+"""
+import math
+import time
+import random
+import asyncio
+import argparse
+
+METERS_PER_DEG = 6371000.0 * math.pi / 180
+
+# 実際の受信に近い送信種別の割合
+TX_WEIGHTS = (
+    (1, 4),     # 識別(コールサイン)
+    (2, 1),     # 地上位置
+    (3, 30),    # 空中位置
+    (4, 25),    # 速度
+    (5, 15),    # 監視(高度)
+    (6, 5),     # 監視(スコーク)
+    (7, 15),    # 空対空
+    (8, 5),     # 全呼出し応答
+)
+
+
+class Aircraft:
+    """直線飛行する模擬航空機"""
+
+    def __init__(self, rnd: random.Random, icao: int, lat: float, lon: float, radius: float) -> None:
+        self.icao = icao
+        self.hex = f'{icao:06X}'
+        self.callsign = f'{rnd.choice(["JAL", "ANA", "SKY", "APJ", "ADO"])}{rnd.randint(1, 9999):<5}'
+        r = radius * math.sqrt(rnd.random())
+        a = rnd.uniform(0, 2 * math.pi)
+        self.lat = lat + r * math.cos(a) / METERS_PER_DEG
+        self.lon = lon + r * math.sin(a) / (METERS_PER_DEG * math.cos(math.radians(lat)))
+        self.alt = rnd.randrange(1000, 41000, 25)
+        self.gs = rnd.randint(120, 520)
+        self.track = rnd.randrange(360)
+        self.vrate = rnd.choice((0, 0, 0, 64, -64, 1024, -1024))
+        self.squawk = rnd.choice((1200, 2000, 4521, 6412, 7700 if rnd.random() < 0.001 else 3012))
+
+    def step(self, dt: float) -> None:
+        d = self.gs * 1852 / 3600 * dt
+        self.lat += d * math.cos(math.radians(self.track)) / METERS_PER_DEG
+        self.lon += d * math.sin(math.radians(self.track)) / (METERS_PER_DEG * math.cos(math.radians(self.lat)))
+        self.alt = min(max(self.alt + int(self.vrate * dt / 60), 0), 45000)
+
+
+class TrafficGenerator:
+    """航空機の集合からSBSの行を生成する"""
+
+    def __init__(self, n: int, rate: float, lat: float = 35.55, lon: float = 139.78,
+            radius: float = 300000, seed: int = 1) -> None:
+        self.rnd = random.Random(seed)
+        self.rate = rate
+        self.aircraft = [Aircraft(self.rnd, 0x800000 + i * 7, lat, lon, radius) for i in range(n)]
+        self.tx = [tx for tx, _ in TX_WEIGHTS]
+        self.weights = [w for _, w in TX_WEIGHTS]
+        self.time = None
+        self.remain = 0.0
+        # 位置を送った時刻 {(ICAO, 緯度*10^5, 経度*10^5): 時刻}
+        self.position_log = None
+
+    def line(self, ac: Aircraft, tx: int, now: float) -> str:
+        lt = time.localtime(now)
+        date = time.strftime('%Y/%m/%d', lt)
+        clock = f'{time.strftime("%H:%M:%S", lt)}.{int(now * 1000) % 1000:03d}'
+        f = [''] * 12
+        if tx == 1:
+            f[0] = ac.callsign
+        elif tx in (2, 3):
+            f[1] = str(ac.alt)
+            f[4] = f'{ac.lat:.5f}'
+            f[5] = f'{ac.lon:.5f}'
+            f[8], f[9], f[10], f[11] = '0', '0', '0', '-1' if tx == 2 else '0'
+            if self.position_log is not None:
+                self.position_log.setdefault((ac.icao, round(ac.lat * 1e5), round(ac.lon * 1e5)), now)
+        elif tx == 4:
+            f[2] = str(ac.gs)
+            f[3] = str(ac.track)
+            f[6] = str(ac.vrate)
+        elif tx == 5:
+            f[1] = str(ac.alt)
+            f[8], f[10], f[11] = '0', '0', '0'
+        elif tx == 6:
+            f[1] = str(ac.alt)
+            f[7] = str(ac.squawk)
+            f[8], f[9], f[10], f[11] = '0', '-1' if ac.squawk == 7700 else '0', '0', '0'
+        elif tx == 7:
+            f[1] = str(ac.alt)
+            f[11] = '0'
+        else:
+            f[11] = '0'
+        return f'MSG,{tx},1,1,{ac.hex},1,{date},{clock},{date},{clock},{",".join(f)}\r\n'
+
+    def generate(self, now: float) -> bytes:
+        '''前回からの経過時間分の行を生成する'''
+        if self.time is None:
+            self.time = now
+            return b''
+        dt = now - self.time
+        self.time = now
+        for ac in self.aircraft:
+            ac.step(dt)
+        self.remain += self.rate * dt
+        n = int(self.remain)
+        self.remain -= n
+        if n == 0:
+            return b''
+        aircraft = self.rnd.choices(self.aircraft, k=n)
+        txs = self.rnd.choices(self.tx, self.weights, k=n)
+        return ''.join(self.line(ac, tx, now) for ac, tx in zip(aircraft, txs)).encode()
+
+
+async def serve(gen: TrafficGenerator, host: str, port: int, duration: float = None,
+        tick: float = 0.01, ready=None) -> None:
+    '''生成した行を接続中の全クライアントに配信する'''
+    writers = set()
+
+    async def handle(reader, writer):
+        writers.add(writer)
+        try:
+            await reader.read()
+        except ConnectionError:
+            pass
+        finally:
+            writers.discard(writer)
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    if ready is not None:
+        ready(server.sockets[0].getsockname()[1])
+    end = None if duration is None else time.monotonic() + duration
+    async with server:
+        while end is None or time.monotonic() < end:
+            data = gen.generate(time.time())
+            if data:
+                for w in list(writers):
+                    if w.transport.get_write_buffer_size() > 4 * 1024 * 1024:
+                        # 読まないクライアントは切断する
+                        w.close()
+                        writers.discard(w)
+                    else:
+                        w.write(data)
+            await asyncio.sleep(tick)
+        for w in list(writers):
+            w.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Synthetic SBS-1 traffic generator.')
+    parser.add_argument('-n', '--aircraft', type=int, default=100, help='number of aircraft. default=100')
+    parser.add_argument('-r', '--rate', type=float, default=None, help='aggregate lines/s. default=5 per aircraft')
+    parser.add_argument('--host', type=str, default='localhost', help='listen host. default=localhost')
+    parser.add_argument('-p', '--port', type=int, default=30003, help='listen port. default=30003')
+    parser.add_argument('--seed', type=int, default=1, help='random seed. default=1')
+    args = parser.parse_args()
+
+    gen = TrafficGenerator(args.aircraft, args.rate or args.aircraft * 5, seed=args.seed)
+    print(f'{args.aircraft} aircraft {gen.rate:.0f} lines/s on {args.host}:{args.port}')
+    try:
+        asyncio.run(serve(gen, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
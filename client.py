@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import os
+import sys
+import time
 import asyncio
 import argparse
+import threading
 from pymavlink import mavutil
 
 # export MAVLINK20=1
@@ -43,80 +46,181 @@ async def cycle_heartbeat_send(mav):
         mavutil.mavlink.MAV_STATE_ACTIVE)
 
 # Receiving
-async def cycle_recv(mav):
-    '''reciver'''
-    msg = mav.recv_match(type=['HEARTBEAT', 'ADSB_VEHICLE'], blocking=False)
-    # msg = mav.recv_msg()
-    if (msg is None) or (msg.get_type() == 'BAD_DATA'):
-        pass
-    elif msg.get_type() == 'HEARTBEAT':
-        print(f'(system {msg.get_srcSystem()} component {msg.get_srcComponent()}) {msg.get_type()}')
+TYPES = ('HEARTBEAT', 'ADSB_VEHICLE')
+
+
+class MavReader:
+    """接続が読めるようになったら、受信済みのメッセージをまとめて読み出してキューに入れる
+
+    接続のファイルディスクリプタをイベントループに登録(add_reader)し、
+    fdが無い接続やadd_readerが使えないイベントループ(Windows)ではスレッドで受信する。
+    """
+
+    # 1回に読み出す最大数。超えた分は次のループで読む
+    MAX_BATCH = 4096
+
+    def __init__(self, mav, types=TYPES) -> None:
+        self.mav = mav
+        self.types = set(types)
+        self.queue = asyncio.Queue()
+        self.loop = None
+        self.fd = None
+        self.thread = None
+        self.stop = threading.Event()
+        self.messages = 0
+        self.batches = 0
+
+    def start(self, loop) -> None:
+        self.loop = loop
+        fd = getattr(self.mav, 'fd', None)
+        if fd is not None:
+            try:
+                loop.add_reader(fd, self.on_readable)
+                self.fd = fd
+                return
+            except (NotImplementedError, ValueError, OSError):
+                pass
+        self.thread = threading.Thread(target=self.run_thread, daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.fd = None
+        self.stop.set()
+
+    def drain(self, msgs: list) -> bool:
+        '''受信済みのメッセージをmsgsに追加する。MAX_BATCHで打ち切ったときは真を返す'''
+        while len(msgs) < self.MAX_BATCH:
+            msg = self.mav.recv_msg()
+            if msg is None:
+                return False
+            if msg.get_type() in self.types:
+                msgs.append(msg)
+        return True
+
+    def put(self, msgs: list) -> None:
+        self.messages += len(msgs)
+        self.batches += 1
+        self.queue.put_nowait(msgs)
+
+    def on_readable(self) -> None:
+        msgs = []
+        more = self.drain(msgs)
+        if msgs:
+            self.put(msgs)
+        if self.mav.fd != self.fd:
+            # tcpinの接続の受け付けなどでfdが変わった
+            self.loop.remove_reader(self.fd)
+            self.fd = self.mav.fd
+            if self.fd is not None:
+                self.loop.add_reader(self.fd, self.on_readable)
+        if more:
+            # パーサのバッファに残っている分はfdが読めるようにならなくても読む
+            self.loop.call_soon(self.on_readable)
+
+    def run_thread(self) -> None:
+        while not self.stop.is_set():
+            msg = self.mav.recv_match(blocking=True, timeout=0.5)
+            if msg is None:
+                continue
+            msgs = [msg] if msg.get_type() in self.types else []
+            self.drain(msgs)
+            if msgs:
+                self.loop.call_soon_threadsafe(self.put, msgs)
+
+    async def get(self) -> list:
+        return await self.queue.get()
+
+
+def format_msg(msg) -> str:
+    '''受信したメッセージを1行の文字列にする'''
+    head = f'(system {msg.get_srcSystem()} component {msg.get_srcComponent()}) {msg.get_type()}'
+    if msg.get_type() == 'HEARTBEAT':
+        return head
     elif msg.get_type() == 'MESSAGE_INTERVAL':
-        dict = msg.to_dict()
-        print(f'(system {msg.get_srcSystem()} component {msg.get_srcComponent()}) {msg.get_type()} message_id={dict["message_id"]} interval_us={dict["interval_us"]}')
+        return f'{head} message_id={msg.message_id} interval_us={msg.interval_us}'
     elif msg.get_type() == 'UAVIONIX_ADSB_TRANSCEIVER_HEALTH_REPORT':
-        dict = msg.to_dict()
-        print(f'(system {msg.get_srcSystem()} component {msg.get_srcComponent()}) {msg.get_type()} rfHealth={dict["rfHealth"]}')
+        return f'{head} rfHealth={msg.rfHealth}'
     elif msg.get_type() == 'ADSB_VEHICLE':
-        print(f'(system {msg.get_srcSystem()} component {msg.get_srcComponent()}) {msg.get_type()}', end=' ')
-
-        dict = msg.to_dict()
-        flags = dict["flags"]
-        print(f'ModeS:{dict["ICAO_address"]:06X}', end=' ')
-        print(f'{dict["tslc"]:2}s', end=' ')
-        if not flags & mavutil.mavlink.ADSB_FLAGS_VALID_CALLSIGN:
-            print(f'{Color.MAGENTA}', end='')
-        print(f'CS:{dict["callsign"]: <8}', end=' ')
-        print(f'{Color.RESET}', end='')
-        if not flags & mavutil.mavlink.ADSB_FLAGS_VALID_ALTITUDE:
-            print(f'{Color.MAGENTA}', end='')
-        print(f'Alt:{int(dict["altitude"] / 1000):5}m', end=' ')
-        print(f'{Color.RESET}', end='')
-        if not flags & mavutil.mavlink.ADSB_FLAGS_VALID_COORDS:
-            print(f'{Color.MAGENTA}', end='')
-        print(f'Lat:{dict["lat"] / 10**7:8.5f}', end=' ')
-        print(f'Lon:{dict["lon"] / 10**7:9.5f}', end=' ')
-        print(f'{Color.RESET}', end='')
-        if not flags & mavutil.mavlink.ADSB_FLAGS_VALID_VELOCITY:
-            print(f'{Color.MAGENTA}', end='')
-        print(f'SP:{int(dict["hor_velocity"] * 3600 / (1000 * 100)):3}km/h', end=' ')
-        print(f'{Color.RESET}', end='')
-        if not flags & mavutil.mavlink.ADSB_FLAGS_VALID_HEADING:
-            print(f'{Color.MAGENTA}', end='')
-        print(f'TR:{int(dict["heading"] / 100):3}°', end=' ')
-        print(f'{Color.RESET}', end='')
-        if not flags & mavutil.mavlink.ADSB_FLAGS_VERTICAL_VELOCITY_VALID:
-            print(f'{Color.MAGENTA}', end='')
-        print(f'VR:{int(dict["ver_velocity"] / 100):3}m/s', end=' ')
-        print(f'{Color.RESET}', end='')
-        if not flags & mavutil.mavlink.ADSB_FLAGS_VALID_SQUAWK:
-            print(f'{Color.MAGENTA}', end='')
-        print(f'SQ:{dict["squawk"]:4}', end=' ')
-        print(f'{Color.RESET}', end='')
-        print(f'FL:{flags:#018b}')
-    else:
-        print("(system %u component %u) %s" % (msg.get_srcSystem(), msg.get_srcComponent(), msg.get_type()))
-
-async def main(mav):
-    loop = asyncio.get_running_loop()
-    heartbeat_wait_time = 1.0
-    heartbeat_end_time = 0
+        flags = msg.flags
+        mark = lambda bit: '' if flags & bit else Color.MAGENTA
+        return f'{head} ModeS:{msg.ICAO_address:06X} {msg.tslc:2}s' \
+            f' {mark(mavutil.mavlink.ADSB_FLAGS_VALID_CALLSIGN)}CS:{msg.callsign: <8} {Color.RESET}' \
+            f'{mark(mavutil.mavlink.ADSB_FLAGS_VALID_ALTITUDE)}Alt:{int(msg.altitude / 1000):5}m {Color.RESET}' \
+            f'{mark(mavutil.mavlink.ADSB_FLAGS_VALID_COORDS)}Lat:{msg.lat / 10**7:8.5f} Lon:{msg.lon / 10**7:9.5f} {Color.RESET}' \
+            f'{mark(mavutil.mavlink.ADSB_FLAGS_VALID_VELOCITY)}SP:{int(msg.hor_velocity * 3600 / (1000 * 100)):3}km/h {Color.RESET}' \
+            f'{mark(mavutil.mavlink.ADSB_FLAGS_VALID_HEADING)}TR:{int(msg.heading / 100):3}° {Color.RESET}' \
+            f'{mark(mavutil.mavlink.ADSB_FLAGS_VERTICAL_VELOCITY_VALID)}VR:{int(msg.ver_velocity / 100):3}m/s {Color.RESET}' \
+            f'{mark(mavutil.mavlink.ADSB_FLAGS_VALID_SQUAWK)}SQ:{msg.squawk:4} {Color.RESET}' \
+            f'FL:{flags:#018b}'
+    return head
+
+async def cycle_recv(reader: MavReader):
+    '''reciver'''
+    msgs = await reader.get()
+    sys.stdout.write('\n'.join(format_msg(msg) for msg in msgs) + '\n')
+
+async def cycle_stats(reader: MavReader):
+    '''受信数だけを1秒ごとに表示する'''
+    messages = reader.messages
+    batches = reader.batches
+    while True:
+        await asyncio.sleep(1.0)
+        print(f'{reader.messages - messages} msgs/s {reader.batches - batches} batches/s queue:{reader.queue.qsize()}')
+        messages = reader.messages
+        batches = reader.batches
+        while not reader.queue.empty():
+            reader.queue.get_nowait()
 
+async def cycle_capture(reader: MavReader, capture):
+    '''受信したADSB_VEHICLEを表示せずに記録する'''
     while True:
-        time_now = loop.time()
-        if time_now >= heartbeat_end_time:
-            heartbeat_end_time = time_now + heartbeat_wait_time
-            await cycle_heartbeat_send(mav)
+        msgs = await reader.get()
+        capture.extend(msgs, time.time())
 
-        await cycle_recv(mav)
-        await asyncio.sleep(0.01)
+async def cycle_heartbeat(mav):
+    while True:
+        await cycle_heartbeat_send(mav)
+        await asyncio.sleep(1.0)
+
+async def main(mav, quiet: bool = False, capture=None):
+    loop = asyncio.get_running_loop()
+    reader = MavReader(mav)
+    reader.start(loop)
+    heartbeat = asyncio.create_task(cycle_heartbeat(mav))
+
+    try:
+        if capture is not None:
+            await cycle_capture(reader, capture)
+        elif quiet:
+            await cycle_stats(reader)
+        else:
+            while True:
+                await cycle_recv(reader)
+    finally:
+        heartbeat.cancel()
+        reader.close()
+        if capture is not None:
+            capture.close()
+            print(f'{capture.rows} ADSB_VEHICLE to {capture.path}')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Parse command line options.')
     parser.add_argument('-d', '--device', type=str, default='udpin:localhost:14550', help='device name. (ex. "udpin:localhost:14550", "tcp:localhost:5763", "/dev/tty.usbserial-0001")')
     parser.add_argument('-b', '--baud', type=int, default=57600, help='baudrate. default=57600')
+    parser.add_argument('-q', '--quiet', action='store_true', help='print only the number of received messages per second')
+    parser.add_argument('--capture', type=str, default=None, help='record decoded ADSB_VEHICLE to a directory of .npz chunks or a ".parquet" file instead of printing (needs numpy, see adsb_capture.py)')
     args = parser.parse_args()
 
+    capture = None
+    if args.capture:
+        try:
+            from adsb_capture import AdsbCapture
+            capture = AdsbCapture(args.capture)
+        except (ImportError, ValueError) as e:
+            parser.error(f'--capture: {e}')
+
     # device = 'tcp:localhost:5763' # Ardupilot Simulatorから受信
     # device = 'udpin:localhost:14550' # PX4 Simulatorから受信
     # device = '/dev/tty.usbserial-0001'
@@ -129,7 +233,7 @@ if __name__ == "__main__":
     asyncio.set_event_loop(loop)
 
     try:
-        asyncio.run(main(mav))
+        asyncio.run(main(mav, args.quiet, capture))
     except KeyboardInterrupt:
         pass
     finally:
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""実行時メトリクス
+
+カウンタとゲージは値を読む関数を登録しておき、出力するときだけ呼び出す。
+計測する側はオブジェクトの整数属性を増やすだけなので、常時有効にしておける。
+ヒストグラムは固定の境界値にbisectで振り分ける。
+
+出力はPrometheusのテキスト形式(HTTP)か、一定間隔のJSON lines。
+"""
+import sys
+import json
+import time
+import bisect
+import asyncio
+import cProfile
+import functools
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+PARSE_BUCKETS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 1e-3)
+AGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    """固定の境界値で数えるヒストグラム"""
+
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, name: str, help: str, bounds: tuple) -> None:
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float, n: int = 1) -> None:
+        '''valueをn回観測したものとして数える'''
+        self.counts[bisect.bisect_left(self.bounds, value)] += n
+        self.sum += value * n
+        self.count += n
+
+    def quantile(self, q: float) -> float:
+        '''境界値からの概算'''
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        acc = 0
+        for bound, c in zip(self.bounds, self.counts):
+            acc += c
+            if acc >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """メトリクスの登録と出力"""
+
+    def __init__(self, prefix: str = 'sbs2mav') -> None:
+        self.prefix = prefix
+        self.values = []
+        self.histograms = []
+
+    def counter(self, name: str, help: str, fn) -> None:
+        '''fnは数値か {ラベル: 数値} を返す'''
+        self.values.append((name, help, 'counter', fn))
+
+    def gauge(self, name: str, help: str, fn) -> None:
+        self.values.append((name, help, 'gauge', fn))
+
+    def histogram(self, name: str, help: str, bounds: tuple) -> Histogram:
+        h = Histogram(name, help, bounds)
+        self.histograms.append(h)
+        return h
+
+    def prometheus(self) -> str:
+        out = []
+        for name, help, kind, fn in self.values:
+            name = f'{self.prefix}_{name}'
+            out.append(f'# HELP {name} {help}')
+            out.append(f'# TYPE {name} {kind}')
+            value = fn()
+            if isinstance(value, dict):
+                for label, v in value.items():
+                    out.append(f'{name}{{{label}}} {v}')
+            else:
+                out.append(f'{name} {value}')
+        for h in self.histograms:
+            name = f'{self.prefix}_{h.name}'
+            out.append(f'# HELP {name} {h.help}')
+            out.append(f'# TYPE {name} histogram')
+            acc = 0
+            for bound, c in zip(h.bounds, h.counts):
+                acc += c
+                out.append(f'{name}_bucket{{le="{bound}"}} {acc}')
+            out.append(f'{name}_bucket{{le="+Inf"}} {h.count}')
+            out.append(f'{name}_sum {h.sum}')
+            out.append(f'{name}_count {h.count}')
+        return '\n'.join(out) + '\n'
+
+    def snapshot(self) -> dict:
+        snap = {'time': time.time()}
+        for name, _, _, fn in self.values:
+            snap[name] = fn()
+        for h in self.histograms:
+            snap[h.name] = {
+                'count': h.count,
+                'mean': h.sum / h.count if h.count else 0.0,
+                'p50': h.quantile(0.5),
+                'p99': h.quantile(0.99),
+            }
+        return snap
+
+
+async def serve_http(registry: Registry, host: str, port: int) -> None:
+    '''GET /metrics でPrometheusのテキスト形式、GET /json でJSONを返す'''
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            path = request.split()[1] if len(request.split()) > 1 else b'/'
+            if path == b'/json':
+                body = json.dumps(registry.snapshot()).encode()
+                ctype = 'application/json'
+            else:
+                body = registry.prometheus().encode()
+                ctype = 'text/plain; version=0.0.4'
+            writer.write(f'HTTP/1.0 200 OK\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def write_json_lines(registry: Registry, path: str, interval: float) -> None:
+    '''interval秒ごとにJSONを1行追記する。pathが"-"のときは標準エラー出力'''
+    f = sys.stderr if path == '-' else open(path, 'a')
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            f.write(json.dumps(registry.snapshot()) + '\n')
+            f.flush()
+    finally:
+        if f is not sys.stderr:
+            f.close()
+
+
+async def monitor_loop_lag(hist: Histogram, interval: float = 0.1) -> None:
+    '''イベントループの遅れ(sleepが予定より遅れて戻った時間)を計測する'''
+    loop = asyncio.get_running_loop()
+    while True:
+        t = loop.time()
+        await asyncio.sleep(interval)
+        hist.observe(max(loop.time() - t - interval, 0.0))
+
+
+class SamplingProfiler:
+    """rate回に1回の呼び出しだけをcProfileで計測する"""
+
+    def __init__(self, rate: int = 100) -> None:
+        self.rate = rate
+        self.profile = cProfile.Profile()
+
+    def wrap(self, func):
+        count = 0
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            nonlocal count
+            count += 1
+            if count % self.rate:
+                return func(*args, **kwargs)
+            self.profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.profile.disable()
+        return wrapper
+
+    def dump(self, path: str) -> None:
+        self.profile.dump_stats(path)
@@ -1,16 +1,33 @@
 #!/usr/bin/env python3
-import io
 import os
-import csv
+import sys
 import socket
+import math
+import time
+import heapq
+import random
+import struct
+import shutil
+import signal
 import asyncio
-from datetime import datetime, timezone
-from tzlocal import get_localzone
-from dateutil import parser, tz
-from pymavlink import mavutil
+import argparse
+from datetime import datetime, timedelta
+from spatial import SpatialGrid, distance, METERS_PER_DEG
 
-# export MAVLINK20=1
-os.environ['MAVLINK20'] = '1'
+# pymavlink(とdialectの生成)、tzlocal、dateutilは使う直前まで読み込まない。
+# 起動してからSBSに接続し、最初のADSB_VEHICLEを送るまでの時間を短くするため。
+mavutil = None
+
+
+def load_mavlink():
+    '''pymavlinkを読み込む。MAVLINK20は読み込んだ後に設定する(以前のモジュール先頭での順序と同じ)'''
+    global mavutil
+    if mavutil is None:
+        from pymavlink import mavutil as m
+        mavutil = m
+        # export MAVLINK20=1
+        os.environ['MAVLINK20'] = '1'
+    return mavutil
 
 # http://woodair.net/sbs/article/barebones42_socket_data.htm
 #
@@ -38,251 +55,1597 @@ os.environ['MAVLINK20'] = '1'
 # Field 21: SPI (Ident)             Flag to indicate transponder Ident has been activated.
 # Field 22: IsOnGround              Flag to indicate ground squat switch is active
 
+class SbsTimeDecoder:
+    """SBSの固定書式の日付(YYYY/MM/DD)と時刻(HH:MM:SS.fff)をepoch秒に変換する
+
+    dump1090はローカル時刻で出力するため、日付ごとにその日の0時のepoch秒(UTCオフセット込み)をキャッシュし、
+    時刻部分は文字列のスライスで秒に変換して加算する。
+    夏時間の切り替えがある日(0時から翌日0時までが24時間でない日)だけは、時ごとの0分のepoch秒をキャッシュする。
+    切り替えで繰り返す1時間は、SBSの時刻からは区別できないので前半(切り替え前)として扱う。
+    """
+
+    def __init__(self) -> None:
+        self._days = {}
+        self._transitions = set()
+        self._hours = {}
+
+    def decode(self, date: str, time_: str) -> float:
+        base = self._days.get(date)
+        if base is None:
+            base = self._day_base(date)
+        if date in self._transitions:
+            return self._hour_base(date, time_[0:2]) + int(time_[3:5]) * 60 + float(time_[6:])
+        return base + int(time_[0:2]) * 3600 + int(time_[3:5]) * 60 + float(time_[6:])
+
+    def _day_base(self, date: str) -> float:
+        day = datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]))
+        base = day.timestamp()
+        if len(self._days) > 8:
+            self._days.clear()
+            self._transitions.clear()
+            self._hours.clear()
+        self._days[date] = base
+        if (day + timedelta(days=1)).timestamp() - base != 86400:
+            self._transitions.add(date)
+        return base
+
+    def _hour_base(self, date: str, hour: str) -> float:
+        key = (date, hour)
+        base = self._hours.get(key)
+        if base is None:
+            base = self._hours[key] = datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]), int(hour)).timestamp()
+        return base
+
+
+class Vehicle:
+    """航空機1機分の状態
+
+    flagsは値が有効なフィールドを示すビット列で、下位16bitはMAVLinkのADSB_FLAGSと同じ割り当て。
+    無効なフィールドの値は0のまま。
+    changedは前回の送信以降に値が変わったフィールドをflagsと同じビットで示す。
+    versionは値が変わるたびに増える。
+    time_pos, time_altは位置と高度を最後に受信した行の生成時刻。
+    emitter_typeはADSB_EMITTER_TYPE(機体データベースから引く)。
+    """
+
+    # ADSB_FLAGS (MAVLink common.xml)
+    VALID_COORDS = 0x0001
+    VALID_ALTITUDE = 0x0002
+    VALID_HEADING = 0x0004
+    VALID_VELOCITY = 0x0008
+    VALID_CALLSIGN = 0x0010
+    VALID_SQUAWK = 0x0020
+    VERTICAL_VELOCITY_VALID = 0x0080
+    BARO_VALID = 0x0100
+    ADSB_FLAGS_MASK = 0xFFFF
+
+    # SBS固有のフィールド(ADSB_FLAGSの範囲外)
+    VALID_ALERT = 0x10000
+    VALID_EMERGENCY = 0x20000
+    VALID_SPI = 0x40000
+    VALID_GND = 0x80000
+
+    __slots__ = ('icao', 'flags', 'changed', 'version', 'time_gen', 'time_log', 'time_sent', 'time_pos', 'time_alt', 'callsign', 'emitter_type',
+        'alt', 'gs', 'track', 'lat', 'lon', 'vrate', 'squawk', 'alert', 'emergency', 'spi', 'gnd')
+
+    def __init__(self, icao: int) -> None:
+        self.icao = icao
+        self.flags = 0
+        self.changed = 0
+        self.version = 0
+        self.time_gen = 0.0
+        self.time_log = 0.0
+        self.time_sent = 0.0
+        self.time_pos = 0.0
+        self.time_alt = 0.0
+        self.callsign = '        '
+        self.emitter_type = 0
+        self.alt = 0
+        self.gs = 0
+        self.track = 0
+        self.lat = 0.0
+        self.lon = 0.0
+        self.vrate = 0
+        self.squawk = 0
+        self.alert = 0
+        self.emergency = 0
+        self.spi = 0
+        self.gnd = 0
+
+
+class CoalescingQueue:
+    """ICAOアドレスをキーとする最新値優先の送信待ちバッファ
+
+    同じ航空機の更新は何度入れても1件にまとまり、最初に入った時刻を保持する。
+    中身はICAOだけで、値は取り出した時点のVehicleを使う。1行の反映はイベントループ上で中断されないため、
+    取り出した側からは常に行単位で整合した状態が見える。
+    maxsizeを超えたときは最も古いものを捨てる。
+    """
+
+    def __init__(self, maxsize: int = 8192) -> None:
+        self.maxsize = maxsize
+        self.pending = {}
+        self.event = asyncio.Event()
+        self.overflow = 0
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def __contains__(self, icao: int) -> bool:
+        return icao in self.pending
+
+    def __iter__(self):
+        return iter(self.pending)
+
+    def put(self, icao: int, now: float) -> None:
+        pending = self.pending
+        if icao in pending:
+            return
+        if len(pending) >= self.maxsize:
+            del pending[next(iter(pending))]
+            self.overflow += 1
+        pending[icao] = now
+
+    def discard(self, icao: int) -> None:
+        self.pending.pop(icao, None)
+
+    def drain(self) -> dict:
+        '''送信待ちを全て取り出す。{ICAO: 最初に入った時刻}'''
+        pending = self.pending
+        self.pending = {}
+        return pending
+
+    def clear(self) -> None:
+        self.pending = {}
+
+    def oldest_age(self, now: float) -> float:
+        if not self.pending:
+            return 0.0
+        return now - min(self.pending.values())
+
+    def stats(self, now: float) -> str:
+        return f'pending:{len(self.pending)} oldest:{self.oldest_age(now):.3f}s overflow:{self.overflow}'
+
+
+class SbsParser:
+    """MSG行のフィールドを航空機1機分の更新(タプル)に変換する
+
+    更新は (ICAO, 有効なフィールドのマスク, 生成時刻, 記録時刻, コールサイン, 高度, 対地速度, 航跡,
+    緯度, 経度, 昇降率, スコーク, Alert, Emergency, SPI, IsOnGround) の順。
+    マスクはVehicle.flagsと同じビットで、行に含まれていなかったフィールドの値は0(コールサインは空文字列)。
+    RECORDはプロセス間で受け渡すときの固定長のバイナリ表現。
+    """
+
+    RECORD = struct.Struct('<IIdd8siiiddiibbbb')
+
+    def __init__(self) -> None:
+        self.decoder = SbsTimeDecoder()
+        self.rejected = 0
+
+    def iter_parse(self, lines):
+        '''MSG行のリストを解析し、(行, 更新)を返すジェネレータ。壊れた行は読み飛ばしてrejectedに数える
+
+        SbsModel・sbs_ingest.RingSinkはこれを通して解析するので、行の選び方と数え方はどこでも同じになる。
+        '''
+        parse = self.parse
+        for line in lines:
+            if line[0] != 'MSG' or len(line) < 22:
+                continue
+            try:
+                update = parse(line)
+            except ValueError:
+                self.rejected += 1
+                continue
+            yield line, update
+
+    def parse(self, line: list) -> tuple:
+        '''壊れた行と、RECORDに収まらない値の行はValueErrorを送出する'''
+        mask = 0
+        callsign = ''
+        alt = gs = track = vrate = squawk = alert = emergency = spi = gnd = 0
+        lat = lon = 0.0
+        icao = int(line[4], 16)
+        if not 0 <= icao <= 0xFFFFFF:
+            raise ValueError(f'HexIdent out of range: {line[4]}')
+        if line[10]:
+            callsign = line[10]
+            mask |= Vehicle.VALID_CALLSIGN
+        if line[11]:
+            alt = int(line[11])
+            if not -0x80000000 <= alt <= 0x7FFFFFFF:
+                raise ValueError(f'Altitude out of range: {line[11]}')
+            mask |= Vehicle.VALID_ALTITUDE | Vehicle.BARO_VALID
+        if line[12]:
+            gs = int(line[12])
+            if not -0x80000000 <= gs <= 0x7FFFFFFF:
+                raise ValueError(f'GroundSpeed out of range: {line[12]}')
+            mask |= Vehicle.VALID_VELOCITY
+        if line[13]:
+            track = int(line[13])
+            if not -0x80000000 <= track <= 0x7FFFFFFF:
+                raise ValueError(f'Track out of range: {line[13]}')
+            mask |= Vehicle.VALID_HEADING
+        if line[14] and line[15]:
+            lat = float(line[14])
+            lon = float(line[15])
+            mask |= Vehicle.VALID_COORDS
+        if line[16]:
+            vrate = int(line[16])
+            if not -0x80000000 <= vrate <= 0x7FFFFFFF:
+                raise ValueError(f'VerticalRate out of range: {line[16]}')
+            mask |= Vehicle.VERTICAL_VELOCITY_VALID
+        if line[17]:
+            squawk = int(line[17])
+            if not -0x80000000 <= squawk <= 0x7FFFFFFF:
+                raise ValueError(f'Squawk out of range: {line[17]}')
+            mask |= Vehicle.VALID_SQUAWK
+        # フラグ(0か-1)は1バイトで持つ
+        if line[18]:
+            alert = int(line[18])
+            if not -128 <= alert <= 127:
+                raise ValueError(f'Alert out of range: {line[18]}')
+            mask |= Vehicle.VALID_ALERT
+        if line[19]:
+            emergency = int(line[19])
+            if not -128 <= emergency <= 127:
+                raise ValueError(f'Emergency out of range: {line[19]}')
+            mask |= Vehicle.VALID_EMERGENCY
+        if line[20]:
+            spi = int(line[20])
+            if not -128 <= spi <= 127:
+                raise ValueError(f'SPI out of range: {line[20]}')
+            mask |= Vehicle.VALID_SPI
+        if line[21]:
+            gnd = int(line[21])
+            if not -128 <= gnd <= 127:
+                raise ValueError(f'IsOnGround out of range: {line[21]}')
+            mask |= Vehicle.VALID_GND
+        return (icao, mask, self.decoder.decode(line[6], line[7]), self.decoder.decode(line[8], line[9]),
+            callsign, alt, gs, track, lat, lon, vrate, squawk, alert, emergency, spi, gnd)
+
+    @classmethod
+    def pack_into(cls, buf, offset: int, update: tuple) -> None:
+        icao, mask, time_gen, time_log, callsign, *rest = update
+        cls.RECORD.pack_into(buf, offset, icao, mask, time_gen, time_log,
+            callsign.encode('ascii', 'replace'), *rest)
+
+    @classmethod
+    def unpack(cls, buf) -> list:
+        '''RECORDを並べたバイト列を更新のリストにする'''
+        return [(icao, mask, time_gen, time_log, callsign.rstrip(b'\0').decode('ascii'), *rest)
+            for icao, mask, time_gen, time_log, callsign, *rest in cls.RECORD.iter_unpack(buf)]
+
+
 class SbsModel:
     """Kinetic Avionic Products製品SBSのBaseStationソフトウェア互換のプロトコル・モデルクラス
+
+    vehiclesはICAOアドレス(int)をキーとするVehicleの辞書。
+    timeout秒以上受信していない航空機は delete_lost_aircraft() で削除し、expire_listenersに通知する。
+    値が変わった航空機のICAOはdirty(CoalescingQueue)に入り、dirty.eventがセットされる。
+    位置が有効な航空機はgridに登録する。
+    aircraft_db(aircraft_db.AircraftDb)を指定したときは、新しい航空機の区分を引き、
+    コールサインを受信するまでは登録記号をコールサインとして使う。
+    save_snapshot() / load_snapshot() で航空機の一覧を固定長のバイナリ(SNAPSHOT_RECORD)のファイルに保存・復元する。
     """
 
-    def __init__(self) -> None:
-        self.zone = tz.gettz(str(get_localzone()))
+    SNAPSHOT_MAGIC = b'SBSSNAP1'
+    # MAGIC, 件数, 保存時刻
+    SNAPSHOT_HEADER = struct.Struct('<8sId')
+    # icao, flags, time_gen, time_log, time_pos, time_alt, callsign, emitter_type,
+    # alt, gs, track, lat, lon, vrate, squawk, alert, emergency, spi, gnd
+    SNAPSHOT_RECORD = struct.Struct('<IIdddd8sBiiiddiibbbb')
+
+    def __init__(self, timeout: float = 30, aircraft_db=None) -> None:
+        self.aircraft_db = aircraft_db
+        # format_time() で初めて使うときに設定する
+        self.zone = None
+        self.parser = SbsParser()
+        self.decoder = self.parser.decoder
+        self.timeout = timeout
         self.vehicles = {}
+        self.dirty = CoalescingQueue()
+        self._now = 0.0
+        self.grid = SpatialGrid()
+        self.expire_listeners = []
+        self.parsed = 0
+        self.expired = 0
+        # (最終受信時刻, ICAO)のヒープ。更新のたびには積まず、取り出した時点で最新の受信時刻を確認する
+        self._expiry = []
+        self._time_str = {}
 
-    def set_vehicles(self, csv) -> None:
-        for line in csv:
-            msg_type = line[0]
-            if msg_type == 'MSG':
-                # tx_type = line[1]
-                hex_ident = line[4]
-                veh = self.vehicles.setdefault(hex_ident, {})
-                self.vehicles[hex_ident] = self.set_vehicle(veh, line)
-
-    def set_vehicle(self, veh: dict, line: str) -> dict:
-        veh['update'] = True
-
-        gen_date = line[6]
-        gen_time = line[7]
-        log_date = line[8]
-        log_time = line[9]
-
-        veh['datetime_gen'] = parser.parse(f'{gen_date} {gen_time}').astimezone(self.zone)
-        veh['datetime_log'] = parser.parse(f'{log_date} {log_time}').astimezone(self.zone)
-
-        if 'callsign' not in veh.keys(): veh['callsign'] = '        '
-
-        if line[10]: veh['callsign'] = line[10]
-        if line[11]: veh['alt'] = int(line[11])
-        if line[12]: veh['gs'] = int(line[12])
-        if line[13]: veh['track'] = int(line[13])
-        if line[14]: veh['lat'] = float(line[14])
-        if line[15]: veh['lon'] = float(line[15])
-        if line[16]: veh['vrate'] = int(line[16])
-        if line[17]: veh['squawk'] = int(line[17])
-        if line[18]: veh['alert'] = int(line[18])
-        if line[19]: veh['emergency'] = int(line[19])
-        if line[20]: veh['spi'] = int(line[20])
-        if line[21]: veh['gnd'] = int(line[21])
+    def set_vehicles(self, lines, accepted: list = None) -> None:
+        '''acceptedを指定したときは、反映できた行をそこに追加する'''
+        apply = self.apply
+        self._now = time.time()
+        for line, update in self.parser.iter_parse(lines):
+            apply(update)
+            self.parsed += 1
+            if accepted is not None:
+                accepted.append(line)
+        if self.dirty:
+            self.dirty.event.set()
 
+    @property
+    def rejected(self) -> int:
+        '''解析できなかった行数'''
+        return self.parser.rejected
+
+    def apply_updates(self, updates) -> None:
+        '''別プロセスなどで解析済みの更新をまとめて反映する'''
+        self._now = time.time()
+        apply = self.apply
+        n = 0
+        for update in updates:
+            apply(update)
+            n += 1
+        self.parsed += n
+        if self.dirty:
+            self.dirty.event.set()
+
+    def iter_apply(self, batches):
+        '''iter_lines() の行のリストを順に反映し、反映できた行ごとにVehicleを返すジェネレータ
+
+        set_vehicles() と同じ解析・反映を行う。dirty.eventはセットしない。
+        '''
+        iter_parse = self.parser.iter_parse
+        apply = self.apply
+        for lines in batches:
+            self._now = time.time()
+            for _, update in iter_parse(lines):
+                veh = apply(update)
+                self.parsed += 1
+                yield veh
+
+    def apply(self, update: tuple) -> Vehicle:
+        '''SbsParser.parse() の結果を反映する。dirty.eventのセットは呼び出し側で行う'''
+        (icao, mask, time_gen, time_log, callsign, alt, gs, track, lat, lon,
+            vrate, squawk, alert, emergency, spi, gnd) = update
+        veh = self.vehicles.get(icao)
+        new = veh is None
+        if new:
+            veh = Vehicle(icao)
+            if self.aircraft_db is not None:
+                info = self.aircraft_db.lookup(icao)
+                if info is not None:
+                    veh.emitter_type, registration = info
+                    if registration and not mask & Vehicle.VALID_CALLSIGN:
+                        callsign = registration
+                        mask |= Vehicle.VALID_CALLSIGN
+        changed = 0
+
+        if mask & Vehicle.VALID_CALLSIGN:
+            if callsign != veh.callsign: changed |= Vehicle.VALID_CALLSIGN
+            veh.callsign = callsign
+        if mask & Vehicle.VALID_ALTITUDE:
+            if alt != veh.alt: changed |= Vehicle.VALID_ALTITUDE
+            veh.alt = alt
+            veh.time_alt = time_gen
+        if mask & Vehicle.VALID_VELOCITY:
+            if gs != veh.gs: changed |= Vehicle.VALID_VELOCITY
+            veh.gs = gs
+        if mask & Vehicle.VALID_HEADING:
+            if track != veh.track: changed |= Vehicle.VALID_HEADING
+            veh.track = track
+        if mask & Vehicle.VALID_COORDS:
+            if lat != veh.lat or lon != veh.lon: changed |= Vehicle.VALID_COORDS
+            veh.lat = lat
+            veh.lon = lon
+            veh.time_pos = time_gen
+        if mask & Vehicle.VERTICAL_VELOCITY_VALID:
+            if vrate != veh.vrate: changed |= Vehicle.VERTICAL_VELOCITY_VALID
+            veh.vrate = vrate
+        if mask & Vehicle.VALID_SQUAWK:
+            if squawk != veh.squawk: changed |= Vehicle.VALID_SQUAWK
+            veh.squawk = squawk
+        if mask & Vehicle.VALID_ALERT:
+            if alert != veh.alert: changed |= Vehicle.VALID_ALERT
+            veh.alert = alert
+        if mask & Vehicle.VALID_EMERGENCY:
+            if emergency != veh.emergency: changed |= Vehicle.VALID_EMERGENCY
+            veh.emergency = emergency
+        if mask & Vehicle.VALID_SPI:
+            if spi != veh.spi: changed |= Vehicle.VALID_SPI
+            veh.spi = spi
+        if mask & Vehicle.VALID_GND:
+            if gnd != veh.gnd: changed |= Vehicle.VALID_GND
+            veh.gnd = gnd
+
+        # 新たに有効になったフィールドも変更として扱う
+        flags = veh.flags | mask
+        changed |= flags & ~veh.flags
+        if changed & Vehicle.VALID_COORDS:
+            self.grid.update(icao, lat, lon)
+        veh.flags = flags
+        veh.time_gen = time_gen
+        veh.time_log = time_log
+        if changed:
+            veh.changed |= changed
+            veh.version += 1
+            self.dirty.put(icao, self._now)
+        if new:
+            self.vehicles[icao] = veh
+            heapq.heappush(self._expiry, (time_gen, icao))
         return veh
 
-    def clear_update_flag(self) -> None:
-        for v in self.vehicles.values():
-            v['update'] = False
-
-    def delete_lost_aircraft(self, timeout: int = 30) -> None:
-        now = datetime.now(timezone.utc)
-        self.vehicles = {k: v for k, v in self.vehicles.items() if (now - v["datetime_gen"]).total_seconds() < timeout}
-
-    def make_str(self, k: str, v: dict, d: float) -> str:
-        val: str = lambda v, name: v[name] if name in v.keys() else "-"
-        valm: str = lambda v, name, multi: int(v[name] * multi) if name in v.keys() else "-"
-
-        return f'{"*" if v.get("update") else " "}' \
-            f'ModeS:{k} {d:8.5f}' \
-            f' MG:{v.get("datetime_gen").strftime("%x %X")}' \
-            f' CS:{v.get("callsign"):8}' \
-            f' Alt:{val(v, "alt")}ft/{valm(v, "alt", 0.3048)}m' \
-            f' Lat:{val(v, "lat")}' \
-            f' Lon:{val(v, "lon")}' \
-            f' SP:{val(v, "gs")}kts/{valm(v, "gs", 1.852)}km/h' \
-            f' TR:{val(v, "track")}°' \
-            f' VR:{val(v, "vrate")}fpm/{valm(v, "vrate", 0.3048)}m' \
-            f' SQ:{v.get("squawk")}' \
-            f' ALERT:{val(v, "alert")}' \
-            f' Emg:{val(v, "emergency")}' \
-            f' SPI:{val(v, "spi")}' \
-            f' GND:{val(v, "gnd")}'
+    def add_expire_listener(self, listener) -> None:
+        '''航空機を削除したときに listener(veh) を呼ぶ'''
+        self.expire_listeners.append(listener)
+
+    def delete_lost_aircraft(self, now: float = None) -> list:
+        '''timeout秒以上受信していない航空機を削除し、削除したVehicleのリストを返す'''
+        if now is None:
+            now = time.time()
+        limit = now - self.timeout
+        heap = self._expiry
+        expired = []
+        while heap and heap[0][0] <= limit:
+            _, icao = heapq.heappop(heap)
+            veh = self.vehicles.get(icao)
+            if veh is None:
+                continue
+            if veh.time_gen > limit:
+                # その後も受信しているので最新の受信時刻で積み直す
+                heapq.heappush(heap, (veh.time_gen, icao))
+            else:
+                del self.vehicles[icao]
+                self.dirty.discard(icao)
+                self.grid.remove(icao)
+                expired.append(veh)
+
+        self.expired += len(expired)
+        for veh in expired:
+            for listener in self.expire_listeners:
+                listener(veh)
+        return expired
+
+    def save_snapshot(self, path: str) -> int:
+        '''航空機の一覧をファイルに保存し、件数を返す。書き込み途中のファイルは残さない'''
+        record = self.SNAPSHOT_RECORD
+        vehicles = list(self.vehicles.values())
+        buf = bytearray(self.SNAPSHOT_HEADER.size + len(vehicles) * record.size)
+        self.SNAPSHOT_HEADER.pack_into(buf, 0, self.SNAPSHOT_MAGIC, len(vehicles), time.time())
+        offset = self.SNAPSHOT_HEADER.size
+        for v in vehicles:
+            record.pack_into(buf, offset, v.icao, v.flags, v.time_gen, v.time_log, v.time_pos, v.time_alt,
+                v.callsign.encode('ascii', 'replace'), v.emitter_type, v.alt, v.gs, v.track, v.lat, v.lon,
+                v.vrate, v.squawk, v.alert, v.emergency, v.spi, v.gnd)
+            offset += record.size
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(buf)
+        os.replace(tmp, path)
+        return len(vehicles)
+
+    def load_snapshot(self, path: str, now: float = None) -> int:
+        '''save_snapshot() のファイルから航空機を復元し、件数を返す
+
+        timeout秒以上受信していない航空機と、既にある航空機は復元しない。
+        復元した航空機は全てのフィールドを変更ありとしてdirtyに入れる。壊れたファイルはValueErrorを送出する。
+        '''
+        if now is None:
+            now = time.time()
+        with open(path, 'rb') as f:
+            data = f.read()
+        header = self.SNAPSHOT_HEADER
+        record = self.SNAPSHOT_RECORD
+        if len(data) < header.size:
+            raise ValueError(f'{path}: not a snapshot')
+        magic, count, _ = header.unpack_from(data, 0)
+        if magic != self.SNAPSHOT_MAGIC or len(data) != header.size + count * record.size:
+            raise ValueError(f'{path}: not a snapshot')
+        limit = now - self.timeout
+        restored = 0
+        for (icao, flags, time_gen, time_log, time_pos, time_alt, callsign, emitter_type, alt, gs, track,
+                lat, lon, vrate, squawk, alert, emergency, spi, gnd) in record.iter_unpack(data[header.size:]):
+            if time_gen <= limit or icao in self.vehicles:
+                continue
+            veh = Vehicle(icao)
+            veh.flags = flags
+            veh.changed = flags
+            veh.version = 1
+            veh.time_gen = time_gen
+            veh.time_log = time_log
+            veh.time_pos = time_pos
+            veh.time_alt = time_alt
+            veh.callsign = callsign.rstrip(b'\0').decode('ascii')
+            veh.emitter_type = emitter_type
+            veh.alt = alt
+            veh.gs = gs
+            veh.track = track
+            veh.lat = lat
+            veh.lon = lon
+            veh.vrate = vrate
+            veh.squawk = squawk
+            veh.alert = alert
+            veh.emergency = emergency
+            veh.spi = spi
+            veh.gnd = gnd
+            self.vehicles[icao] = veh
+            heapq.heappush(self._expiry, (time_gen, icao))
+            if flags & Vehicle.VALID_COORDS:
+                self.grid.update(icao, lat, lon)
+            self.dirty.put(icao, now)
+            restored += 1
+        if self.dirty:
+            self.dirty.event.set()
+        return restored
+
+    def make_str(self, v: Vehicle, d: float) -> str:
+        f = v.flags
+        alt = f & Vehicle.VALID_ALTITUDE
+        coords = f & Vehicle.VALID_COORDS
+        vel = f & Vehicle.VALID_VELOCITY
+        vr = f & Vehicle.VERTICAL_VELOCITY_VALID
+
+        return f'{"*" if v.changed else " "}' \
+            f'ModeS:{v.icao:06X} {d:8.5f}' \
+            f' MG:{self.format_time(v.time_gen)}' \
+            f' CS:{v.callsign:8}' \
+            f' Alt:{v.alt if alt else "-"}ft/{int(v.alt * 0.3048) if alt else "-"}m' \
+            f' Lat:{v.lat if coords else "-"}' \
+            f' Lon:{v.lon if coords else "-"}' \
+            f' SP:{v.gs if vel else "-"}kts/{int(v.gs * 1.852) if vel else "-"}km/h' \
+            f' TR:{v.track if f & Vehicle.VALID_HEADING else "-"}°' \
+            f' VR:{v.vrate if vr else "-"}fpm/{int(v.vrate * 0.3048) if vr else "-"}m' \
+            f' SQ:{v.squawk if f & Vehicle.VALID_SQUAWK else "-"}' \
+            f' ALERT:{v.alert if f & Vehicle.VALID_ALERT else "-"}' \
+            f' Emg:{v.emergency if f & Vehicle.VALID_EMERGENCY else "-"}' \
+            f' SPI:{v.spi if f & Vehicle.VALID_SPI else "-"}' \
+            f' GND:{v.gnd if f & Vehicle.VALID_GND else "-"}'
+
+    def format_time(self, t: float) -> str:
+        '''epoch秒を"%x %X"の文字列にする。同じ秒の変換はキャッシュする'''
+        sec = int(t)
+        s = self._time_str.get(sec)
+        if s is None:
+            if self.zone is None:
+                from tzlocal import get_localzone
+                from dateutil import tz
+                self.zone = tz.gettz(str(get_localzone()))
+            if len(self._time_str) >= 256:
+                self._time_str.clear()
+            s = self._time_str[sec] = datetime.fromtimestamp(sec, self.zone).strftime('%x %X')
+        return s
 
     def __str__(self) -> str:
-        prt = ''
-        now = datetime.now(timezone.utc)
-        for k, v in self.vehicles.items():
-            d = (now - v["datetime_gen"]).total_seconds()
-            if len(prt):
-                prt += '\n'
-            prt += self.make_str(k, v, d)
-        return prt
+        now = time.time()
+        return '\n'.join(self.make_str(v, now - v.time_gen) for v in self.vehicles.values())
+
+
+class SbsFramer:
+    """受信したバイト列を行単位に分割し、MSG行だけをフィールドに分割する
+
+    行末(CRLF)で終わっていない末尾は次の受信データと連結して処理する。
+    """
+
+    MAX_LINE = 1024
+
+    def __init__(self) -> None:
+        self.partial = b''
+
+    def feed(self, data: bytes) -> list:
+        lines = data.split(b'\n')
+        if self.partial:
+            lines[0] = self.partial + lines[0]
+        self.partial = lines.pop()
+        if len(self.partial) > self.MAX_LINE:
+            # 行末が来ないデータは捨てる
+            self.partial = b''
+        return [line.decode('ascii', 'replace').rstrip('\r').split(',') for line in lines if line.startswith(b'MSG,')]
+
+
+def iter_chunks(source, size: int = 4096 * 16):
+    '''ファイル(read)かブロッキングのソケット(recv)から、終わりまでbytesを読み出すジェネレータ'''
+    read = getattr(source, 'recv', None) or source.read
+    while True:
+        try:
+            data = read(size)
+        except EOFError:
+            # 書きかけで終端のない.gzは、読めたところまでとする
+            return
+        if not data:
+            return
+        yield data
+
+
+def iter_lines(chunks):
+    '''bytesの列をSbsFramerで行に分割し、MSG行(フィールドのリスト)のリストを返すジェネレータ
+
+    SbsClientと同じ分割なので、ファイルやブロッキングのソケットもasyncioのブリッジと同じ結果になる。
+    '''
+    framer = SbsFramer()
+    for data in chunks:
+        lines = framer.feed(data)
+        if lines:
+            yield lines
+
+
+class SbsDeduplicator:
+    """複数の受信機から届いた同じ観測を捨てる
+
+    HexIdent・送信種別・生成日時が同じ行を重複とみなす。
+    キーは2世代のsetで保持し、世代ごとにsizeを超えたら古い世代を捨てる。
+    """
+
+    def __init__(self, size: int = 65536) -> None:
+        self.size = size
+        self.current = set()
+        self.previous = set()
+
+    def filter(self, lines: list) -> list:
+        seen = self.seen
+        return [line for line in lines if not seen((line[4], line[1], line[6], line[7]))]
+
+    def seen(self, key) -> bool:
+        '''keyを登録済みなら真を返す。未登録なら登録して偽を返す'''
+        if key in self.current or key in self.previous:
+            return True
+        self.current.add(key)
+        if len(self.current) >= self.size:
+            self.previous = self.current
+            self.current = set()
+        return False
 
 
 class SbsClient:
     """Kinetic Avionic Products製品SBSのBaseStationソフトウェア互換のプロトコルクライアント
+
+    接続できないときはRETRY_MIN秒からRETRY_MAX秒まで待ち時間を倍にしながら再接続する。
+    dedupを指定したときは、他の受信機と重複した行を捨てる。
+    recorder(sbs_record.SbsRecorder)を指定したときは、受信データをfeed番号とともに記録する。
+    server(sbs_server.SbsServer)を指定したときは、modelに反映できた行を再配信する。
     """
 
-    BUF_SIZE = 4096 * 4
+    BUF_SIZE = 4096 * 16
+    RETRY_MIN = 1.0
+    RETRY_MAX = 30.0
 
-    def __init__(self, model: SbsModel, host: str = 'localhost', port: int = 30003) -> None:
+    def __init__(self, model: SbsModel, host: str = 'localhost', port: int = 30003,
+            dedup: SbsDeduplicator = None, recorder=None, feed: int = 0, server=None) -> None:
         self.model = model
         self.host = host
         self.port = port
+        self.dedup = dedup
+        self.recorder = recorder
+        self.feed = feed
+        self.server = server
+        self.framer = SbsFramer()
+        self.connects = 0
+        self.bytes = 0
+        self.lines = 0
+        self.duplicates = 0
+        # 1行あたりの解析時間を記録するmetrics.Histogram
+        self.parse_time = None
 
     async def __aenter__(self):
+        delay = self.RETRY_MIN
         while True:
             try:
                 self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
                 break
             except socket.error as e:
-                await asyncio.sleep(1)
+                # 複数の受信機が同時に再接続しないようにずらす
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, self.RETRY_MAX)
+        self.framer = SbsFramer()
+        self.connects += 1
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback):
         self.writer.close()
-        await self.writer.wait_closed()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            # リセットされた接続は閉じるときにも例外になる
+            pass
 
     async def recv(self) -> bool:
         data = await self.reader.read(self.BUF_SIZE)
         if not data:
             return False
-        csv_reader = self.perse_csv(data.decode())
-        self.model.set_vehicles(csv_reader)
+        self.bytes += len(data)
+        if self.recorder is not None:
+            self.recorder.write(data, self.feed)
+        lines = self.framer.feed(data)
+        self.lines += len(lines)
+        if self.dedup is not None:
+            fresh = self.dedup.filter(lines)
+            self.duplicates += len(lines) - len(fresh)
+            lines = fresh
+        accepted = [] if self.server is not None else None
+        if self.parse_time is not None and lines:
+            t = time.perf_counter()
+            self.model.set_vehicles(lines, accepted)
+            self.parse_time.observe((time.perf_counter() - t) / len(lines), len(lines))
+        else:
+            self.model.set_vehicles(lines, accepted)
+        if accepted:
+            self.server.publish(accepted)
         return True
 
-    def perse_csv(self, data: str):
-        f = io.StringIO()
-        f.write(data)
-        f.seek(0)
-        csv_reader = csv.reader(f)
-        return csv_reader
+    def stats(self) -> str:
+        return f'{self.host}:{self.port} connects:{self.connects} bytes:{self.bytes} lines:{self.lines} dup:{self.duplicates}'
+
+
+async def run_sbs(model: SbsModel, sbs: SbsClient):
+    '''1つの受信機から受信し続ける。切断やリセットされたら再接続する
+
+    1つの受信機の接続エラーで他の受信機やMAVLinkの送信を止めないように、ここで例外を受け止める。
+    '''
+    while True:
+        try:
+            async with sbs:
+                print(f'connect! {sbs.host}:{sbs.port}')
+                while True:
+                    ret = await sbs.recv()
+                    if not ret:
+                        break
+                    model.delete_lost_aircraft()
+        except OSError as e:
+            print(f'disconnect {sbs.stats()} {e!r}')
+            # 接続直後にリセットし続ける相手に詰めて再接続しないようにする
+            await asyncio.sleep(sbs.RETRY_MIN * random.uniform(0.5, 1.0))
+            continue
+        print(f'disconnect {sbs.stats()}')
+
+
+def make_clients(model: SbsModel, feeds: list, recorder=None, server=None) -> list:
+    '''feeds: (host, port)のリスト。全ての受信機を1つのmodelにまとめる'''
+    dedup = SbsDeduplicator() if len(feeds) > 1 else None
+    return [SbsClient(model, host, port, dedup, recorder, i, server) for i, (host, port) in enumerate(feeds)]
+
+
+async def main_sbs(model: SbsModel, clients: list):
+    await asyncio.gather(*(run_sbs(model, sbs) for sbs in clients))
+
+
+async def save_snapshots(model: SbsModel, path: str, interval: float):
+    '''interval秒ごとに航空機の一覧を保存する'''
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            model.save_snapshot(path)
+        except (OSError, struct.error) as e:
+            # 保存できなくても受信と送信は続ける
+            print(f'snapshot: {e}')
+
+
+class ConsoleDisplay:
+    """航空機の一覧を端末に一定間隔で表示する
+
+    受信のたびではなくrate[Hz]ごとに表示するため、表示のコストは受信量によらない。
+    mode="live"は前回から内容が変わった行だけをカーソル移動で書き換え、
+    mode="print"は従来の形式(SbsModel.make_str)で一覧全体を出力する。
+    sortとrowsで並び順と表示する機数を指定する。
+    """
+
+    SORT_KEYS = ('icao', 'callsign', 'alt', 'range', 'age')
+    HEADER = '  ICAO   Callsign  Alt[ft]       Lat        Lon   GS TRK     VR   SQ  A E S G  Range  Age'
+    # live: 他の出力で画面が崩れても直るように、この秒数ごとに全体を描き直す
+    FULL_REDRAW = 5.0
+
+    def __init__(self, model: SbsModel, mode: str = 'live', rate: float = 2.0, sort: str = 'icao',
+            rows: int = None, ownship=None, out=None) -> None:
+        self.model = model
+        self.mode = mode
+        self.interval = 1.0 / rate
+        self.sort = sort
+        self.rows = rows
+        self.ownship = ownship
+        self.out = out or sys.stdout
+        self.screen = []
+        self.last_full = 0.0
+        self.frames = 0
+        self.rows_written = 0
+
+    def sort_key(self):
+        if self.sort == 'callsign':
+            return lambda v: (v.callsign, v.icao)
+        if self.sort == 'alt':
+            # 高い順。高度が無いものは最後
+            return lambda v: (not v.flags & Vehicle.VALID_ALTITUDE, -v.alt, v.icao)
+        if self.sort == 'age':
+            # 最近受信した順
+            return lambda v: -v.time_gen
+        if self.sort == 'range' and self.ownship is not None and self.ownship.valid:
+            ownship = self.ownship
+            return lambda v: (not v.flags & Vehicle.VALID_COORDS, ownship.distance2(v) if v.flags & Vehicle.VALID_COORDS else 0.0)
+        return lambda v: v.icao
+
+    def select(self, limit: int = None) -> list:
+        vehicles = self.model.vehicles.values()
+        key = self.sort_key()
+        if limit is not None and limit < len(vehicles):
+            return heapq.nsmallest(limit, vehicles, key)
+        return sorted(vehicles, key=key)
+
+    def make_row(self, v: Vehicle, now: float) -> str:
+        f = v.flags
+        alt = f & Vehicle.VALID_ALTITUDE
+        coords = f & Vehicle.VALID_COORDS
+        vel = f & Vehicle.VALID_VELOCITY
+        rng = '-'
+        if coords and self.ownship is not None and self.ownship.valid:
+            rng = f'{distance(self.ownship.lat, self.ownship.lon, v.lat, v.lon) / 1000:.1f}'
+        return f'{"*" if v.changed else " "} {v.icao:06X} {v.callsign:8}' \
+            f' {v.alt if alt else "-":>8}' \
+            f' {f"{v.lat:.5f}" if coords else "-":>9} {f"{v.lon:.5f}" if coords else "-":>10}' \
+            f' {v.gs if vel else "-":>4} {v.track if f & Vehicle.VALID_HEADING else "-":>3}' \
+            f' {v.vrate if f & Vehicle.VERTICAL_VELOCITY_VALID else "-":>6}' \
+            f' {f"{v.squawk:04d}" if f & Vehicle.VALID_SQUAWK else "-":>4}' \
+            f' {"A" if v.alert else "-"} {"E" if v.emergency else "-"} {"S" if v.spi else "-"} {"G" if v.gnd else "-"}' \
+            f' {rng:>6} {now - v.time_gen:4.0f}'
 
+    def render(self, now: float) -> None:
+        if self.mode == 'print':
+            lines = [self.model.make_str(v, now - v.time_gen) for v in self.select(self.rows)]
+            self.out.write('\n' + '\n'.join(lines) + '\n')
+            self.rows_written += len(lines)
+        else:
+            self.render_live(now)
+        self.out.flush()
+        self.frames += 1
 
-async def main_sbs(model: SbsModel, host: str = 'localhost', port: int = 30003):
-    async with SbsClient(model, host, port) as sbs:
-        print('connect!')
+    def render_live(self, now: float) -> None:
+        width, height = shutil.get_terminal_size()
+        # ヘッダ2行と最下行を除いた行数に収める。折り返すと行の位置がずれるため幅も切り詰める
+        limit = max(height - 3, 1)
+        if self.rows is not None:
+            limit = min(limit, self.rows)
+        vehicles = self.select(limit)
+        screen = [f'aircraft:{len(self.model.vehicles)} shown:{len(vehicles)} sort:{self.sort}'[:width],
+            self.HEADER[:width]]
+        screen.extend(self.make_row(v, now)[:width] for v in vehicles)
+
+        full = now - self.last_full >= self.FULL_REDRAW
+        out = []
+        if full:
+            out.append('\x1b[H\x1b[2J')
+            self.screen = []
+            self.last_full = now
+        old = self.screen
+        for i, row in enumerate(screen):
+            if i >= len(old) or old[i] != row:
+                out.append(f'\x1b[{i + 1};1H{row}\x1b[K')
+                self.rows_written += 1
+        if len(screen) < len(old):
+            # 減った行を消す
+            out.append(f'\x1b[{len(screen) + 1};1H\x1b[J')
+        out.append(f'\x1b[{len(screen) + 1};1H')
+        self.out.write(''.join(out))
+        self.screen = screen
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_time = loop.time()
         while True:
-            ret = await sbs.recv()
-            if not ret:
-                break
-            print('')
-            print(model)
-            model.delete_lost_aircraft()
+            self.render(time.time())
+            next_time = max(next_time + self.interval, loop.time())
+            await asyncio.sleep(next_time - loop.time())
+
+    def register(self, registry) -> None:
+        '''metrics.Registryにメトリクスを登録する'''
+        registry.counter('display_frames_total', 'console display refreshes', lambda: self.frames)
+        registry.counter('display_rows_written_total', 'console display rows written', lambda: self.rows_written)
+
+
+class MavFanout:
+    """複数のMAVLink接続に同じフレームを書き込む
+
+    フレームは1回だけエンコードし、プロトコルのバージョンとシーケンス番号、システムIDは先頭の接続のものを使う。
+    """
+
+    def __init__(self, conns: list) -> None:
+        self.conns = conns
+
+    @property
+    def mav(self):
+        return self.conns[0].mav
+
+    def write(self, buf: bytes) -> None:
+        for conn in self.conns:
+            conn.write(buf)
+
+    def next_seq(self) -> int:
+        seq = self.mav.seq
+        self.mav.seq = (seq + 1) % 256
+        return seq
+
+    def send(self, msg) -> bytes:
+        '''pymavlinkのメッセージを送信し、送信したフレームを返す'''
+        buf = msg.pack(self.mav)
+        self.next_seq()
+        self.write(buf)
+        return buf
+
+    def send_payload(self, msg_id: int, crc_extra: int, payload: bytes) -> bytes:
+        '''エンコード済みのペイロードにヘッダとCRCを付けて送信し、送信したフレームを返す'''
+        mav = self.mav
+        plen = len(payload)
+        if self.conns[0].WIRE_PROTOCOL_VERSION == '2.0':
+            # MAVLink2は末尾の0を省略する
+            while plen > 1 and payload[plen - 1] == 0:
+                plen -= 1
+            buf = bytearray(struct.pack('<BBBBBBBHB', 253, plen, 0, 0, self.next_seq(),
+                mav.srcSystem, mav.srcComponent, msg_id & 0xFFFF, msg_id >> 16))
+        else:
+            buf = bytearray(struct.pack('<BBBBBB', 254, plen, self.next_seq(),
+                mav.srcSystem, mav.srcComponent, msg_id))
+        buf += payload[:plen]
+        crc = mavutil.mavlink.x25crc(buf[1:])
+        crc.accumulate(bytes((crc_extra,)))
+        buf += struct.pack('<H', crc.crc)
+        buf = bytes(buf)
+        self.write(buf)
+        return buf
+
+    def close(self) -> None:
+        for conn in self.conns:
+            conn.close()
+
 
-            await asyncio.sleep(0.1)
+class AdsbFrameCache:
+    """航空機ごとにADSB_VEHICLEのペイロードをキャッシュする
 
+    値が変わったとき(Vehicle.versionが変わったとき)だけエンコードし直し、
+    再送時はtslcとシーケンス番号、CRCだけを更新する。
+    """
+
+    PAYLOAD = struct.Struct('<IiiiHHhHHB9sBB')
+    TSLC_OFFSET = 37
+
+    def __init__(self) -> None:
+        self.payloads = {}
+
+    def payload(self, veh: Vehicle, tslc: int) -> bytearray:
+        entry = self.payloads.get(veh.icao)
+        if entry is None or entry[0] != veh.version:
+            entry = (veh.version, self.encode(veh, veh.lat, veh.lon, veh.alt))
+            self.payloads[veh.icao] = entry
+        payload = entry[1]
+        payload[self.TSLC_OFFSET] = min(max(tslc, 0), 255)
+        return payload
+
+    def predicted(self, veh: Vehicle, tslc: int, position: tuple) -> bytearray:
+        '''推定した位置 (緯度, 経度, 高度[ft]) のペイロード。送信のたびに変わるのでキャッシュしない'''
+        payload = self.encode(veh, *position)
+        payload[self.TSLC_OFFSET] = min(max(tslc, 0), 255)
+        return payload
+
+    def encode(self, veh: Vehicle, lat: float, lon: float, alt: float) -> bytearray:
+        flags = veh.flags & Vehicle.ADSB_FLAGS_MASK
+        altitude_type = 0
 
-def send_heartbeat(mav):
+        if flags & Vehicle.VALID_ALTITUDE:
+            altitude_type = mavutil.mavlink.ADSB_ALTITUDE_TYPE_PRESSURE_QNH
+
+        # フィールドはワイヤ上の順(サイズの大きい順)
+        return bytearray(self.PAYLOAD.pack(veh.icao,
+            int(lat * 10**7),                            # lat * 10**7 (degE7)
+            int(lon * 10**7),
+            int(alt * 0.3048 * 1000),                    # Convert feet to millimeters
+            veh.track * 100,                             # 0~359.99° * 100 (cdeg)
+            int((veh.gs * 1.852 * 1000 * 100) / 3600),   # Convert from kts to cm/s
+            int(veh.vrate * 0.3048 * 100 / 60),          # Convert from f/m to cm/s
+            flags, veh.squawk, altitude_type,
+            veh.callsign.encode(), veh.emitter_type, 0))
+
+    def discard(self, veh: Vehicle) -> None:
+        self.payloads.pop(veh.icao, None)
+
+
+def send_heartbeat(out: MavFanout) -> bytes:
     '''Heartbeatを1Hzで送信
     Heartbeatを最低1回は送らないと受信できない
     '''
-    mav.mav.heartbeat_send(
+    return out.send(out.mav.heartbeat_encode(
         mavutil.mavlink.MAV_TYPE_ADSB,
         mavutil.mavlink.MAV_AUTOPILOT_INVALID,
         0,
         0,
-        mavutil.mavlink.MAV_STATE_ACTIVE)
-
-def send_adsb_vehicle(mav, hex_id: str, sbs: dict, d: int):
-    '''Send ADSB_VEHICLE'''
-    lat, lon, heading, altitude, altitude_type, heading = 0, 0, 0, 0, 0, 0
-    hor_velocity, ver_velocity, tslc, flags, squawk = 0, 0, 0, 0, 0
-    emitter_type = mavutil.mavlink.ADSB_EMITTER_TYPE_NO_INFO
-    ICAO_address = int(hex_id, 16)
-    callsign = sbs['callsign']
-    tslc = d
-
-    if callsign != '        ':
-        flags |= mavutil.mavlink.ADSB_FLAGS_VALID_CALLSIGN
-    if 'lat' in sbs.keys() and 'lon' in sbs.keys():
-        # lat * 10**7 (degE7)
-        flags |= mavutil.mavlink.ADSB_FLAGS_VALID_COORDS
-        lat = int(sbs['lat'] * 10**7)
-        lon = int(sbs['lon'] * 10**7)
-    if 'alt' in sbs.keys():
-        # Convert feet to millimeters
-        flags |= mavutil.mavlink.ADSB_FLAGS_VALID_ALTITUDE
-        flags |= mavutil.mavlink.ADSB_FLAGS_BARO_VALID
-        altitude_type = mavutil.mavlink.ADSB_ALTITUDE_TYPE_PRESSURE_QNH
-        altitude = int(sbs['alt'] * 0.3048 * 1000)
-    if 'track' in sbs.keys():
-        # 0~359.99° * 100 (cdeg)
-        flags |= mavutil.mavlink.ADSB_FLAGS_VALID_HEADING
-        heading = sbs['track'] * 100
-    if 'gs' in sbs.keys():
-        # Convert from kts to cm/s
-        flags |= mavutil.mavlink.ADSB_FLAGS_VALID_VELOCITY
-        hor_velocity = int((sbs['gs'] * 1.852 * 1000 * 100) / 3600)
-    if 'vrate' in sbs.keys():
-        # Convert from f/m to cm/s
-        flags |= mavutil.mavlink.ADSB_FLAGS_VERTICAL_VELOCITY_VALID
-        ver_velocity = int(sbs['vrate'] * 0.3048 * 100 / 60)
-    if 'squawk' in sbs.keys():
-        flags |= mavutil.mavlink.ADSB_FLAGS_VALID_SQUAWK
-        squawk = sbs['squawk']
-
-    mav.mav.adsb_vehicle_send(ICAO_address, lat, lon, altitude_type,
-        altitude, heading, hor_velocity, ver_velocity, callsign.encode(),
-        emitter_type, tslc, flags, squawk)
-
-async def cycle_recv(mav):
+        mavutil.mavlink.MAV_STATE_ACTIVE))
+
+def send_adsb_vehicle(out: MavFanout, cache: AdsbFrameCache, veh: Vehicle, d: int, position: tuple = None) -> bytes:
+    '''Send ADSB_VEHICLE
+    positionを指定したときは受信した位置の代わりにその位置 (緯度, 経度, 高度[ft]) を送る
+    '''
+    return out.send_payload(mavutil.mavlink.MAVLINK_MSG_ID_ADSB_VEHICLE,
+        mavutil.mavlink.MAVLink_adsb_vehicle_message.crc_extra,
+        cache.payload(veh, d) if position is None else cache.predicted(veh, d, position))
+
+
+class DeadReckoning:
+    """送信時刻の位置を対地速度・航跡・昇降率から推定する(推測航法)
+
+    位置と高度は、それぞれ最後に受信した時刻から送信時刻まで外挿する。外挿はhorizon秒で打ち切る。
+    1回の送信でまとめて送る航空機全体を1度に計算する。numpyがあれば配列演算で、無ければ1機ずつ計算する。
+    """
+
+    # これより少ない機数はnumpyの配列を作るより1機ずつ計算した方が速い
+    VECTOR_MIN = 32
+    NEED = Vehicle.VALID_COORDS | Vehicle.VALID_VELOCITY | Vehicle.VALID_HEADING
+
+    def __init__(self, horizon: float = 5.0) -> None:
+        self.horizon = horizon
+        self.predicted = 0
+        try:
+            import numpy
+            self.np = numpy
+        except ImportError:
+            self.np = None
+
+    def predict(self, vehicles: list, now: float) -> list:
+        '''vehiclesと同じ順に (緯度, 経度, 高度[ft]) を返す。速度か航跡が無い航空機はNone'''
+        if self.np is not None and len(vehicles) >= self.VECTOR_MIN:
+            positions = self.predict_array(vehicles, now)
+        else:
+            positions = [self.predict_one(v, now) for v in vehicles]
+        self.predicted += sum(p is not None for p in positions)
+        return positions
+
+    def predict_one(self, v: Vehicle, now: float) -> tuple:
+        f = v.flags
+        if f & self.NEED != self.NEED:
+            return None
+        dt = min(max(now - v.time_pos, 0.0), self.horizon)
+        d = v.gs * (1852 / 3600) * dt
+        track = math.radians(v.track)
+        lat = v.lat + d * math.cos(track) / METERS_PER_DEG
+        lon = v.lon + d * math.sin(track) / (METERS_PER_DEG * max(math.cos(math.radians(v.lat)), 0.01))
+        alt = v.alt
+        if f & Vehicle.VALID_ALTITUDE and f & Vehicle.VERTICAL_VELOCITY_VALID:
+            alt += v.vrate * min(max(now - v.time_alt, 0.0), self.horizon) / 60
+        return (lat, lon, alt)
+
+    def predict_array(self, vehicles: list, now: float) -> list:
+        np = self.np
+        a = np.array([(v.flags, v.lat, v.lon, v.alt, v.gs, v.track, v.vrate, v.time_pos, v.time_alt)
+            for v in vehicles], dtype=np.float64)
+        flags = a[:, 0].astype(np.int64)
+        lat, lon, alt, gs, track, vrate = a[:, 1], a[:, 2], a[:, 3], a[:, 4], a[:, 5], a[:, 6]
+        dt = np.clip(now - a[:, 7], 0.0, self.horizon)
+        dt_alt = np.clip(now - a[:, 8], 0.0, self.horizon)
+        d = gs * (1852 / 3600) * dt
+        track = np.radians(track)
+        plat = lat + d * np.cos(track) / METERS_PER_DEG
+        plon = lon + d * np.sin(track) / (METERS_PER_DEG * np.maximum(np.cos(np.radians(lat)), 0.01))
+        climb = (flags & Vehicle.VALID_ALTITUDE != 0) & (flags & Vehicle.VERTICAL_VELOCITY_VALID != 0)
+        palt = alt + np.where(climb, vrate * dt_alt / 60, 0.0)
+        ok = (flags & self.NEED) == self.NEED
+        return [(la, lo, al) if k else None
+            for la, lo, al, k in zip(plat.tolist(), plon.tolist(), palt.tolist(), ok.tolist())]
+
+    def register(self, registry) -> None:
+        '''metrics.Registryにメトリクスを登録する'''
+        registry.counter('adsb_predicted_total', 'ADSB_VEHICLE positions extrapolated by dead reckoning', lambda: self.predicted)
+
+
+class AdsbEmitter:
+    """ADSB_VEHICLEを送信する航空機を選ぶ
+
+    on_change=Trueのときは、値が変わった航空機を前回の送信からmin_interval秒以上経っていれば直ちに送信し、
+    変わっていない航空機もmax_interval秒ごとに再送する。
+    on_change=Falseのときは、max_interval秒ごとに全機を送信する。
+    trafficを指定したときは、その条件に合う航空機だけを送信する。
+    """
+
+    SWEEP_DIVISION = 4
+
+    def __init__(self, model: SbsModel, on_change: bool = True,
+            min_interval: float = 0.2, max_interval: float = 1.0, traffic=None) -> None:
+        self.model = model
+        self.traffic = traffic
+        self.on_change = on_change
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.sweep_time = 0.0
+        self.next_time = None
+
+    def due(self, now: float) -> list:
+        '''今送信すべき航空機のリストを返す'''
+        model = self.model
+        vehicles = model.vehicles
+        out = []
+        traffic = self.traffic
+        if not self.on_change:
+            if now >= self.sweep_time:
+                self.sweep_time = now + self.max_interval
+                out = traffic.select() if traffic is not None else list(vehicles.values())
+            # 変更マスクは送信した時点で sent() がクリアする。送信待ちの優先度の判定に使うため、ここでは消さない
+            model.dirty.clear()
+            return out
+
+        self.next_time = None
+        dirty = model.dirty
+        if dirty:
+            out = {}
+            for icao, t in dirty.drain().items():
+                veh = vehicles.get(icao)
+                if veh is None:
+                    continue
+                if traffic is not None and not traffic.accept(veh):
+                    veh.changed = 0
+                    continue
+                wait_until = veh.time_sent + self.min_interval
+                if now >= wait_until:
+                    out[icao] = veh
+                else:
+                    dirty.put(icao, t)
+                    if self.next_time is None or wait_until < self.next_time:
+                        self.next_time = wait_until
+        else:
+            out = {}
+
+        if now >= self.sweep_time:
+            self.sweep_time = now + self.max_interval / self.SWEEP_DIVISION
+            limit = now - self.max_interval
+            for veh in (traffic.select() if traffic is not None else vehicles.values()):
+                if veh.time_sent <= limit and veh.icao not in dirty:
+                    out.setdefault(veh.icao, veh)
+        return list(out.values())
+
+    def sent(self, veh: Vehicle, now: float) -> None:
+        veh.time_sent = now
+        veh.changed = 0
+
+    def wait_time(self, now: float, limit: float) -> float:
+        '''次に due() を呼ぶまでの待ち時間'''
+        t = self.sweep_time
+        if self.next_time is not None and self.next_time < t:
+            t = self.next_time
+        return min(max(t - now, 0.0), limit)
+
+
+class Ownship:
+    """自機の位置(GLOBAL_POSITION_INT)
+
+    最後に受信してからtimeout秒を過ぎた位置は無効とする。
+    """
+
+    def __init__(self, timeout: float = 5.0) -> None:
+        self.lat = 0.0
+        self.lon = 0.0
+        self.alt = 0.0      # AMSL [m]
+        self.time = 0.0
+        self.timeout = timeout
+
+    @property
+    def valid(self) -> bool:
+        return self.time > 0 and time.time() - self.time <= self.timeout
+
+    def set_position(self, msg, now: float) -> None:
+        self.lat = msg.lat / 10**7
+        self.lon = msg.lon / 10**7
+        self.alt = msg.alt / 1000
+        self.time = now
+
+    def distance2(self, veh: Vehicle) -> float:
+        '''航空機までの距離の2乗(正距円筒近似, [deg^2])'''
+        dlat = veh.lat - self.lat
+        dlon = (veh.lon - self.lon) * math.cos(math.radians(self.lat))
+        return dlat * dlat + dlon * dlon
+
+
+class TrafficFilter:
+    """自機からの距離・高度差・近い順の機数で送信する航空機を絞り込む
+
+    自機の位置(GLOBAL_POSITION_INT)が無効な間(受信するまでと、途絶えてOwnship.timeout秒を過ぎた後)は全機を送信する。
+    高度差はSBSの気圧高度と自機のAMSL高度の差で近似する。
+    """
+
+    def __init__(self, model: SbsModel, ownship: Ownship,
+            radius: float = None, alt_band: float = None, nearest: int = None) -> None:
+        self.model = model
+        self.ownship = ownship
+        self.radius = radius
+        self.alt_band = alt_band
+        self.nearest = nearest
+        self.selected = set()
+
+    @property
+    def active(self) -> bool:
+        return self.ownship.valid
+
+    def in_band(self, veh: Vehicle) -> bool:
+        if self.alt_band is None:
+            return True
+        return bool(veh.flags & Vehicle.VALID_ALTITUDE) and \
+            abs(veh.alt * 0.3048 - self.ownship.alt) <= self.alt_band
+
+    def accept(self, veh: Vehicle) -> bool:
+        '''変更のあった航空機を送信するかどうか'''
+        if not self.active:
+            return True
+        if self.nearest is not None:
+            return veh.icao in self.selected
+        if self.radius is not None:
+            if not veh.flags & Vehicle.VALID_COORDS:
+                return False
+            if distance(self.ownship.lat, self.ownship.lon, veh.lat, veh.lon) > self.radius:
+                return False
+        return self.in_band(veh)
+
+    def select(self) -> list:
+        '''条件に合う航空機を近い順に返す'''
+        vehicles = self.model.vehicles
+        if not self.active:
+            return list(vehicles.values())
+        if self.radius is None and self.nearest is None:
+            return [v for v in vehicles.values() if self.in_band(v)]
+
+        accept = None
+        if self.alt_band is not None:
+            accept = lambda icao: self.in_band(vehicles[icao])
+        found = self.model.grid.query(self.ownship.lat, self.ownship.lon, self.radius, self.nearest, accept)
+        self.selected = {icao for _, icao in found}
+        return [vehicles[icao] for _, icao in found]
+
+
+class AdsbScheduler:
+    """ADSB_VEHICLEを帯域(bytes/s)の範囲で優先度の高い順に送る
+
+    送信待ちはICAOごとに最新の1件だけを保持する。優先度は
+    緊急(emergencyフラグまたはスコーク7500/7600/7700)、SPI、変更あり、その他の順で、
+    同じ順位の中では自機に近い航空機を先に送る。
+    budgetがNoneのときは帯域を制限せず、優先度順に全て送る。
+    帯域からは実際に送信したフレームの長さを charge() / charge_adsb() で差し引く。
+    take() で送れる数は直前に送信したADSB_VEHICLEの長さ(frame_len)から見積もる。
+    """
+
+    # 最初のADSB_VEHICLEを送るまでのframe_lenの見積もり: MAVLink1 header(6) + payload(38) + crc(2)
+    # (MAVLINK20はpymavlinkの読み込み後に設定するので、ブリッジはMAVLink1で送信する)
+    ADSB_VEHICLE_LEN = 46
+    EMERGENCY_SQUAWKS = (7500, 7600, 7700)
+    BURST_TIME = 0.1
+
+    def __init__(self, budget: float = None, ownship: Ownship = None) -> None:
+        self.budget = budget
+        self.ownship = ownship
+        self.queue = {}
+        self.tokens = 0.0
+        self.time = None
+        self.frame_len = self.ADSB_VEHICLE_LEN
+        self.sent = 0
+        self.deferred = 0
+        self.dropped = 0
+
+    def submit(self, veh: Vehicle, now: float) -> None:
+        if veh.icao in self.queue:
+            # 送信前に新しい内容で置き換えられた
+            self.dropped += 1
+        self.queue[veh.icao] = [veh, self.priority(veh), False]
+
+    def discard(self, veh: Vehicle) -> None:
+        if self.queue.pop(veh.icao, None) is not None:
+            self.dropped += 1
+
+    def charge(self, size: int) -> None:
+        '''ADSB_VEHICLE以外の送信分を帯域から差し引く'''
+        self.tokens -= size
+
+    def charge_adsb(self, size: int) -> None:
+        '''送信したADSB_VEHICLEのフレームの長さを帯域から差し引く'''
+        self.tokens -= size
+        self.frame_len = size
+
+    def priority(self, veh: Vehicle) -> int:
+        if veh.emergency or veh.squawk in self.EMERGENCY_SQUAWKS:
+            return 0
+        if veh.spi:
+            return 1
+        if veh.changed:
+            return 2
+        return 3
+
+    def take(self, now: float) -> list:
+        '''今送信できる航空機を優先度順に返す'''
+        if not self.queue:
+            self.refill(now)
+            return []
+
+        ownship = self.ownship
+        if ownship is not None and ownship.valid:
+            key = lambda e: (e[1], ownship.distance2(e[0]))
+        else:
+            key = lambda e: e[1]
+
+        if self.budget is None:
+            entries = sorted(self.queue.values(), key=key)
+        else:
+            self.refill(now)
+            n = int((self.tokens + 1e-6) // self.frame_len)
+            if n <= 0:
+                entries = []
+            elif n >= len(self.queue):
+                entries = sorted(self.queue.values(), key=key)
+            else:
+                entries = heapq.nsmallest(n, self.queue.values(), key=key)
+
+        for e in entries:
+            del self.queue[e[0].icao]
+        for e in self.queue.values():
+            if not e[2]:
+                e[2] = True
+                self.deferred += 1
+        self.sent += len(entries)
+        return [e[0] for e in entries]
+
+    def refill(self, now: float) -> None:
+        if self.budget is None:
+            return
+        if self.time is not None:
+            burst = max(self.budget * self.BURST_TIME, self.frame_len)
+            self.tokens = min(burst, self.tokens + (now - self.time) * self.budget)
+        self.time = now
+
+    def wait_time(self, now: float, limit: float) -> float:
+        '''送信待ちを次に送れるようになるまでの待ち時間'''
+        if not self.queue:
+            return limit
+        if self.budget is None:
+            return 0.0
+        t = (self.frame_len - self.tokens) / self.budget
+        return min(max(t, 0.001), limit)
+
+    def stats(self) -> str:
+        return f'ADSB_VEHICLE sent:{self.sent} deferred:{self.deferred} dropped:{self.dropped} queued:{len(self.queue)}'
+
+
+class BridgeMetrics:
+    """ブリッジのメトリクスをmetrics.Registryに登録する"""
+
+    def __init__(self, registry, model: SbsModel, clients: list, scheduler: AdsbScheduler) -> None:
+        import metrics
+
+        feed = lambda sbs: f'feed="{sbs.host}:{sbs.port}"'
+        registry.counter('bytes_read_total', 'SBS bytes read', lambda: {feed(c): c.bytes for c in clients})
+        registry.counter('lines_read_total', 'SBS MSG lines read', lambda: {feed(c): c.lines for c in clients})
+        registry.counter('lines_duplicate_total', 'SBS MSG lines dropped as duplicates', lambda: {feed(c): c.duplicates for c in clients})
+        registry.counter('lines_parsed_total', 'SBS MSG lines applied to the model', lambda: model.parsed)
+        registry.counter('lines_rejected_total', 'SBS MSG lines rejected as malformed', lambda: model.rejected)
+        registry.gauge('vehicles', 'aircraft tracked', lambda: len(model.vehicles))
+        registry.counter('vehicles_expired_total', 'aircraft expired', lambda: model.expired)
+        registry.counter('adsb_sent_total', 'ADSB_VEHICLE messages sent', lambda: scheduler.sent)
+        registry.counter('adsb_deferred_total', 'ADSB_VEHICLE messages deferred by the bandwidth budget', lambda: scheduler.deferred)
+        registry.counter('adsb_dropped_total', 'ADSB_VEHICLE messages dropped before being sent', lambda: scheduler.dropped)
+        registry.gauge('queue_depth', 'aircraft waiting in the change queue', lambda: len(model.dirty))
+        registry.gauge('queue_oldest_seconds', 'age of the oldest entry in the change queue', lambda: model.dirty.oldest_age(time.time()))
+        self.parse_time = registry.histogram('parse_seconds', 'parse time per SBS line', metrics.PARSE_BUCKETS)
+        self.send_time = registry.histogram('adsb_send_seconds', 'encode and send time per ADSB_VEHICLE', metrics.LATENCY_BUCKETS)
+        self.data_age = registry.histogram('adsb_data_age_seconds', 'age of aircraft data when ADSB_VEHICLE is sent', metrics.AGE_BUCKETS)
+        self.loop_lag = registry.histogram('loop_lag_seconds', 'event loop lag', metrics.LATENCY_BUCKETS)
+        for sbs in clients:
+            sbs.parse_time = self.parse_time
+
+
+async def cycle_recv(out: MavFanout, ownship: Ownship):
     '''Receiving'''
-    type = ['HEARTBEAT']
-    msg = mav.recv_match(type=type, blocking=False)
-    # msg = mav.recv_msg()
+    type = ['HEARTBEAT', 'GLOBAL_POSITION_INT']
+    for mav in out.conns:
+        while True:
+            msg = mav.recv_match(type=type, blocking=False)
+            # msg = mav.recv_msg()
 
-    if (msg is None) or (msg.get_type() == 'BAD_DATA'):
-        pass
-    # else:
-    #     print("(sys:%u comp:%u) %s" % (msg.get_srcSystem(), msg.get_srcComponent(), msg.get_type()))
+            if msg is None:
+                break
+            elif msg.get_type() == 'GLOBAL_POSITION_INT':
+                ownship.set_position(msg, time.time())
+            # else:
+            #     print("(sys:%u comp:%u) %s" % (msg.get_srcSystem(), msg.get_srcComponent(), msg.get_type()))
 
-async def main_mav(model: SbsModel, device):
+async def main_mav(model: SbsModel, devices: list, baud: int, emitter: AdsbEmitter, scheduler: AdsbScheduler,
+        metrics: BridgeMetrics = None, predictor: DeadReckoning = None):
     loop = asyncio.get_running_loop()
     heartbeat_wait_time = 1.0
     heartbeat_end_time = 0
+    recv_wait_time = 0.2
+    reported = (0, 0, 0)
 
-    mav = mavutil.mavlink_connection(device, source_system=1,
-        source_component=mavutil.mavlink.MAV_COMP_ID_ADSB)
+    # 先にSBSの接続を始めさせてから、pymavlinkを読み込む
+    await asyncio.sleep(0)
+    load_mavlink()
+    out = MavFanout([mavutil.mavlink_connection(device, baud=baud, source_system=1,
+        source_component=mavutil.mavlink.MAV_COMP_ID_ADSB) for device in devices])
+    cache = AdsbFrameCache()
+    model.add_expire_listener(scheduler.discard)
+    model.add_expire_listener(cache.discard)
 
     while True:
         time_now = loop.time()
         if time_now >= heartbeat_end_time:
             heartbeat_end_time = time_now + heartbeat_wait_time
-            send_heartbeat(mav)
-
-            now = datetime.now(timezone.utc)
-            for k, v in model.vehicles.items():
-                d = int((now - v["datetime_gen"]).total_seconds())
-                send_adsb_vehicle(mav, k, v, d)
+            scheduler.charge(len(send_heartbeat(out)))
             model.delete_lost_aircraft()
-            model.clear_update_flag()
 
-        await cycle_recv(mav)
-        await asyncio.sleep(0.2)
+            if (scheduler.deferred, scheduler.dropped, model.dirty.overflow) != reported:
+                reported = (scheduler.deferred, scheduler.dropped, model.dirty.overflow)
+                print(f'{scheduler.stats()} {model.dirty.stats(time.time())}')
+
+        now = time.time()
+        model.dirty.event.clear()
+        for v in emitter.due(now):
+            scheduler.submit(v, now)
+        vehicles = scheduler.take(now)
+        if vehicles:
+            t = time.perf_counter()
+            if predictor is not None:
+                for v, position in zip(vehicles, predictor.predict(vehicles, now)):
+                    scheduler.charge_adsb(len(send_adsb_vehicle(out, cache, v, int(now - v.time_gen), position)))
+                    emitter.sent(v, now)
+            else:
+                for v in vehicles:
+                    scheduler.charge_adsb(len(send_adsb_vehicle(out, cache, v, int(now - v.time_gen))))
+                    emitter.sent(v, now)
+            if metrics is not None:
+                metrics.send_time.observe((time.perf_counter() - t) / len(vehicles), len(vehicles))
+                for v in vehicles:
+                    metrics.data_age.observe(now - v.time_gen)
+
+        await cycle_recv(out, scheduler.ownship)
+        wait = scheduler.wait_time(now, recv_wait_time)
+        if emitter.on_change:
+            try:
+                await asyncio.wait_for(model.dirty.event.wait(), emitter.wait_time(now, wait))
+            except asyncio.TimeoutError:
+                pass
+        else:
+            await asyncio.sleep(wait)
+
+
+def parse_feed(value: str) -> tuple:
+    host, _, port = value.rpartition(':')
+    if not host:
+        raise argparse.ArgumentTypeError(f'"{value}" is not host:port')
+    return (host, int(port))
+
+
+async def main(args):
+    aircraft_db = None
+    if args.aircraft_db:
+        from aircraft_db import AircraftDb
+        aircraft_db = AircraftDb(args.aircraft_db)
+    model = SbsModel(args.timeout, aircraft_db)
+    if args.snapshot:
+        try:
+            print(f'snapshot: restored {model.load_snapshot(args.snapshot)} aircraft')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f'snapshot: {e}')
+    ownship = Ownship(args.ownship_timeout)
+    traffic = None
+    if args.range is not None or args.alt_band is not None or args.nearest is not None:
+        traffic = TrafficFilter(model, ownship, args.range, args.alt_band, args.nearest)
+    emitter = AdsbEmitter(model, args.emit == 'change', args.min_interval, args.max_interval, traffic)
+    scheduler = AdsbScheduler(args.budget, ownship)
+    recorder = None
+    if args.record:
+        from sbs_record import SbsRecorder
+        recorder = SbsRecorder(args.record)
+    feeds = args.sbs or [(args.host, args.port)]
+    server = None
+    if args.serve:
+        from sbs_server import SbsServer
+        server = SbsServer(*args.serve, args.serve_tx, args.serve_buffer)
+    pool = None
+    if args.workers > 0:
+        from sbs_ingest import IngestPool
+        pool = IngestPool(model, feeds, args.workers)
+        clients = []
+    else:
+        clients = make_clients(model, feeds, recorder, server)
+
+    tasks = []
+    if server is not None:
+        tasks.append(server.run())
+    if args.snapshot:
+        tasks.append(save_snapshots(model, args.snapshot, args.snapshot_interval))
+    display = args.display or ('live' if sys.stdout.isatty() else 'print')
+    console = None
+    if display != 'none':
+        console = ConsoleDisplay(model, display, args.refresh, args.sort, args.rows, ownship)
+        tasks.append(console.run())
+    bridge_metrics = None
+    if args.metrics_port is not None or args.metrics_json is not None:
+        import metrics
+        registry = metrics.Registry()
+        bridge_metrics = BridgeMetrics(registry, model, clients, scheduler)
+        if pool is not None:
+            pool.register(registry)
+        if server is not None:
+            server.register(registry)
+        if console is not None:
+            console.register(registry)
+        tasks.append(metrics.monitor_loop_lag(bridge_metrics.loop_lag))
+        if args.metrics_port is not None:
+            tasks.append(metrics.serve_http(registry, 'localhost', args.metrics_port))
+        if args.metrics_json is not None:
+            tasks.append(metrics.write_json_lines(registry, args.metrics_json, args.metrics_interval))
+
+    predictor = DeadReckoning(args.predict) if args.predict else None
+    if bridge_metrics is not None and predictor is not None:
+        predictor.register(registry)
+
+    profiler = None
+    if args.profile:
+        global send_adsb_vehicle
+        from metrics import SamplingProfiler
+        profiler = SamplingProfiler(args.profile_rate)
+        SbsModel.apply = profiler.wrap(SbsModel.apply)
+        SbsParser.parse = profiler.wrap(SbsParser.parse)
+        send_adsb_vehicle = profiler.wrap(send_adsb_vehicle)
+
+    try:
+        await asyncio.gather(
+            main_mav(model, args.device or ['udpout:localhost:14550'], args.baud, emitter, scheduler, bridge_metrics,
+                predictor),
+            main_sbs(model, clients) if pool is None else pool.run(),
+            *tasks)
+    finally:
+        if recorder is not None:
+            recorder.close()
+        if args.snapshot:
+            try:
+                model.save_snapshot(args.snapshot)
+            except (OSError, struct.error) as e:
+                print(f'snapshot: {e}')
+        if profiler is not None:
+            profiler.dump(args.profile)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert SBS-1 CSV format data to MAVLink message.')
+    parser.add_argument('-d', '--device', type=str, action='append', help='device name. can be given more than once to send the same frames to several outputs. (ex. "udpout:localhost:14550", "udpin:localhost:14540", "/dev/tty.usbserial-0001") default=udpout:localhost:14550')
+    parser.add_argument('-b', '--baud', type=int, default=57600, help='baudrate. default=57600')
+    parser.add_argument('--host', type=str, default='localhost', help='SBS host. default=localhost')
+    parser.add_argument('-p', '--port', type=int, default=30003, help='SBS port. default=30003')
+    parser.add_argument('--sbs', type=parse_feed, action='append', help='SBS feed "host:port". can be given more than once to merge several receivers. default=HOST:PORT')
+    parser.add_argument('--record', type=str, default=None, help='record the received SBS stream to this file. ".gz" to compress (see sbs_record.py)')
+    parser.add_argument('--serve', type=parse_feed, default=None, metavar='HOST:PORT', help='re-serve the merged SBS lines that were applied to the model on this address (ex. "0.0.0.0:30004")')
+    parser.add_argument('--serve-tx', type=lambda v: set(v.split(',')), default=None, help='serve only these transmission types (ex. "1,3,4"). default=all')
+    parser.add_argument('--serve-buffer', type=int, default=1024 * 1024, help='drop a client whose unsent data exceeds this many bytes. default=1048576')
+    parser.add_argument('--workers', type=int, default=0, help='read and parse SBS feeds in this many worker processes (at most one per feed, see sbs_ingest.py). 0 = in the main process. default=0')
+    parser.add_argument('-t', '--timeout', type=float, default=30, help='seconds until a lost aircraft is deleted. default=30')
+    parser.add_argument('--snapshot', type=str, default=None, help='save the aircraft list to this file periodically and on exit, and restore it on startup (aircraft older than --timeout are dropped)')
+    parser.add_argument('--snapshot-interval', type=float, default=10, help='interval of --snapshot [s]. default=10')
+    parser.add_argument('--aircraft-db', type=str, default=None, help='aircraft database built by aircraft_db.py, used to fill emitter type and use the registration as callsign until one is received')
+    parser.add_argument('--emit', choices=['periodic', 'change'], default='periodic', help='ADSB_VEHICLE emission mode. "periodic" sends all aircraft every max-interval, "change" sends an aircraft as soon as it changes. default=periodic')
+    parser.add_argument('--min-interval', type=float, default=0.2, help='minimum interval between ADSB_VEHICLE of one aircraft in change mode [s]. default=0.2')
+    parser.add_argument('--max-interval', type=float, default=1.0, help='maximum interval between ADSB_VEHICLE of one aircraft [s]. default=1.0')
+    parser.add_argument('--budget', type=float, default=None, help='MAVLink output budget [bytes/s] (ex. 2000 for a 57600 baud telemetry radio). default=unlimited')
+    parser.add_argument('--predict', type=float, default=None, metavar='HORIZON', help='send positions extrapolated to the send time from ground speed, track and vertical rate, up to HORIZON seconds after the last position (numpy is used if available). combine with a smaller --max-interval to send smooth tracks. default=off')
+    parser.add_argument('--range', type=float, default=None, help='send only aircraft within this distance from ownship [m]. default=unlimited')
+    parser.add_argument('--alt-band', type=float, default=None, help='send only aircraft within this altitude difference from ownship [m]. default=unlimited')
+    parser.add_argument('--ownship-timeout', type=float, default=5.0, help='ignore the ownship position (GLOBAL_POSITION_INT) for --range/--alt-band/--nearest and the send order when it is older than this [s]. default=5')
+    parser.add_argument('--nearest', type=int, default=None, help='send only the nearest N aircraft to ownship. default=unlimited')
+    parser.add_argument('--display', choices=['live', 'print', 'none'], default=None, help='aircraft list display. "live" redraws changed rows in place, "print" prints the whole list, "none" is headless. default=live on a terminal, print otherwise')
+    parser.add_argument('--refresh', type=float, default=2.0, help='display refresh rate [Hz]. default=2')
+    parser.add_argument('--sort', choices=ConsoleDisplay.SORT_KEYS, default='icao', help='display order. "range" needs the ownship position. default=icao')
+    parser.add_argument('--rows', type=int, default=None, help='maximum number of aircraft to display. default=all (live: terminal height)')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve metrics on http://localhost:PORT/metrics (Prometheus) and /json')
+    parser.add_argument('--metrics-json', type=str, default=None, help='append metrics as JSON lines to this file ("-" for stderr)')
+    parser.add_argument('--metrics-interval', type=float, default=10, help='interval of --metrics-json [s]. default=10')
+    parser.add_argument('--profile', type=str, default=None, help='profile SbsParser.parse, SbsModel.apply and send_adsb_vehicle with cProfile and write pstats to this file on exit')
+    parser.add_argument('--profile-rate', type=int, default=100, help='profile one of N calls. default=100')
+    args = parser.parse_args()
+    if args.workers > 0 and args.record:
+        parser.error('--record cannot be used with --workers')
+    if args.workers > 0 and args.serve:
+        parser.error('--serve cannot be used with --workers')
+
     # device = 'udpin:localhost:14540' # PX4 Simulatorに送信
-    device = 'udpout:localhost:14550' # clientに直接送信
-    host = 'localhost'
-    port = 30003
-    model = SbsModel()
+    # device = 'udpout:localhost:14550' # clientに直接送信
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
 
-    tasks = [
-        main_mav(model, device),
-        main_sbs(model, host, port)
-    ]
+    def terminate(signum, frame):
+        # SIGTERMでもCtrl+Cと同じように終了処理(記録のクローズ、スナップショットの保存)を行う
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
 
     try:
-        asyncio.run(asyncio.wait(tasks))
-        # loop.run_until_complete(asyncio.wait(tasks))
+        asyncio.run(main(args))
     except KeyboardInterrupt:
         pass
     finally:
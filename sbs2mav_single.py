@@ -1,124 +1,189 @@
 #!/usr/bin/env python3
-import io
-import csv
+"""SBSを一括でMAVLinkのtlogに変換するブロッキング版
+
+sbs2mavと同じ解析とモデル(sbs2mav.iter_lines, SbsModel.iter_apply)を使い、asyncioを使わずに
+SBSのファイルかソケットを終わりまで読み、できるだけ速く処理して処理量を表示する。
+
+入力はSBSの生のテキスト(.gzも可、-で標準入力)、sbs_record.pyの記録ファイル、またはSBSサーバ(ポート30003)。
+出力のtlogは、8バイトのビッグエンディアンのμs時刻とMAVLinkのフレームを並べたもの(MAVProxyなどと同じ形式)。
+時刻はSBSの生成時刻で、航空機の値が変わった行ごとにADSB_VEHICLEを1つ、生成時刻の1秒ごとにHEARTBEATを書き込む。
+航空機の削除にも生成時刻を使う。
+
+-fも-oも指定しないときは、従来どおりSBSサーバから受信するたびに航空機の一覧を表示する。
+
+    $ python3 sbs2mav_single.py                         # 受信した航空機の一覧を表示する
+    $ python3 sbs2mav_single.py -f capture.sbs.gz -o capture.tlog
+    $ python3 sbs2mav_single.py -f capture.sbsrec.gz -o capture.tlog --min-interval 1
+    $ python3 sbs2mav_single.py --host 127.0.0.1 --port 30003 -o live.tlog
+    $ python3 sbs2mav_single.py -f capture.sbs          # 変換せずに解析の処理量だけ測る
+    $ python3 sbs2mav_single.py --batch                 # SBSサーバからの受信の処理量だけ測る
+"""
+import sys
+import gzip
+import time
 import socket
-from datetime import datetime, timezone
-from tzlocal import get_localzone
-from dateutil import parser, tz
-
-HOST = '127.0.0.1'
-PORT = 30003 # ポート番号
-BUF_SIZE = 4096 * 4
-
-zone = tz.gettz(str(get_localzone()))
-
-sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-sock.connect((HOST, PORT))
-
-
-# http://woodair.net/sbs/article/barebones42_socket_data.htm
-#
-# Field 1:  Message type            (MSG, STA, ID, AIR, SEL or CLK)
-# Field 2:  Transmission Type       MSG sub types 1 to 8. Not used by other message types.
-# Field 3:  Session ID              Database Session record number
-# Field 4:  AircraftID              Database Aircraft record number
-# Field 5:  HexIdent                Aircraft Mode S hexadecimal code
-# Field 6:  FlightID                Database Flight record number
-# Field 7:  Date message generated
-# Field 8:  Time message generated
-# Field 9:  Date message logged
-# Field 10: Time message logged
-
-# Field 11: Callsign                An eight digit flight ID - can be flight number or registration (or even nothing).
-# Field 12: Altitude                Mode C altitude. Height relative to 1013.2mb (Flight Level). Not height AMSL..
-# Field 13: GroundSpeed             Speed over ground (not indicated airspeed)
-# Field 14: Track                   Track of aircraft (not heading). Derived from the velocity E/W and velocity N/S
-# Field 15: Latitude                North and East positive. South and West negative.
-# Field 16: Longitude               North and East positive. South and West negative.
-# Field 17: VerticalRate            64ft resolution
-# Field 18: Squawk                  Assigned Mode A squawk code.
-# Field 19: Alert (Squawk change)   Flag to indicate squawk has changed.
-# Field 20: Emergency               Flag to indicate emergency code has been set
-# Field 21: SPI (Ident)             Flag to indicate transponder Ident has been activated.
-# Field 22: IsOnGround              Flag to indicate ground squat switch is active
-
-vehicles = {}
-
-try:
-    while True:
-        data = sock.recv(BUF_SIZE).decode()
-        if not data:
-            break
-
-        f = io.StringIO()
-        f.write(data)
-        f.seek(0)
-        csv_reader = csv.reader(f)
-        for line in csv_reader:
-            msg_type = line[0]
-            if msg_type == 'MSG':
-                # tx_type = line[1]
-                hex_ident = line[4]
-                gen_date = line[6]
-                gen_time = line[7]
-                log_date = line[8]
-                log_time = line[9]
-
-                veh = vehicles.setdefault(hex_ident, {})
-                veh['datetime_gen'] = parser.parse(f'{gen_date} {gen_time}').astimezone(zone)
-                veh['datetime_log'] = parser.parse(f'{log_date} {log_time}').astimezone(zone)
-
-                if 'callsign' not in veh.keys():
-                    veh['callsign'] = ''
-
-                if line[10] != '':
-                    veh['callsign'] = line[10]
-                if line[11] != '':
-                    veh['alt'] = int(line[11])
-                if line[12] != '':
-                    veh ['gs'] = int(line[12])
-                if line[13] != '':
-                    veh ['track'] = int(line[13])
-                if line[14] != '':
-                    veh ['lat'] = float(line[14])
-                if line[15] != '':
-                    veh ['lon'] = float(line[15])
-                if line[16] != '':
-                    veh ['vrate'] = int(line[16])
-                if line[17] != '':
-                    veh['squawk'] = int(line[17])
-                if line[18] != '':
-                    veh['alert'] = int(line[18])
-                if line[19] != '':
-                    veh['emergency'] = int(line[19])
-                if line[20] != '':
-                    veh['spi'] = int(line[20])
-                if line[21] != '':
-                    veh['gnd'] = int(line[21])
-
-                vehicles[hex_ident] = veh
-            else:
-                print(msg_type)
-
-        now = datetime.now(timezone.utc)
-        vehicles = {k: v for k, v in vehicles.items() if (now - v["datetime_gen"]).total_seconds() < 30}
-
-        print('')
-        for k, v in vehicles.items():
-            delta = (now - v["datetime_gen"]).total_seconds()
-            print(f'ModeS:{k} {delta:8.5f} MG:{v.get("datetime_gen").strftime("%x %X")}' \
-                f' CS:{v.get("callsign"):8}' \
-                f' Alt:{v["alt"] if "alt" in v.keys() else "-"}ft({int(v["alt"] / 3.281) if "alt" in v.keys() else "-"}m)' \
-                f' Lat:{v["lat"] if "lat" in v.keys() else "-"}' \
-                f' Lon:{v["lon"] if "lon" in v.keys() else "-"}' \
-                f' {v["gs"] if "gs" in v.keys() else "-"}kts({int(v["gs"] * 1.852) if "gs" in v.keys() else "-"}km/h)' \
-                f' {v["track"] if "track" in v.keys() else "-"}°' \
-                f' VR:{v["vrate"] if "vrate" in v.keys() else "-"}fpm({int(v["vrate"] / 3.281) if "vrate" in v.keys() else "-"}m)' \
-                f' SQ:{v.get("squawk")} ALERT:{v.get("alert")}' \
-                f' Emg:{v.get("emergency")} SPI:{v.get("spi")} GND:{v.get("gnd")}')
-
-except KeyboardInterrupt:
-    sock.shutdown(socket.SHUT_RD)
-
-sock.close()
-print('finish!')
+import struct
+import argparse
+from sbs2mav import (SbsModel, MavFanout, AdsbFrameCache, iter_chunks, iter_lines,
+    load_mavlink, send_heartbeat, send_adsb_vehicle)
+
+BUF_SIZE = 4096 * 16
+TLOG_TIME = struct.Struct('>Q')
+
+
+class TlogWriter:
+    """MavFanoutの接続の代わりに、フレームをtimestamp(epoch秒)とともにtlogに書き込む"""
+
+    def __init__(self, path: str) -> None:
+        mavutil = load_mavlink()
+        self.file = open(path, 'wb', buffering=1024 * 1024)
+        self.mav = mavutil.mavlink.MAVLink(None, srcSystem=1, srcComponent=mavutil.mavlink.MAV_COMP_ID_ADSB)
+        self.WIRE_PROTOCOL_VERSION = mavutil.mavlink.WIRE_PROTOCOL_VERSION
+        self.timestamp = 0.0
+        self.frames = 0
+
+    def write(self, buf: bytes) -> None:
+        self.file.write(TLOG_TIME.pack(int(self.timestamp * 1e6)) + buf)
+        self.frames += 1
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def open_source(path: str):
+    '''ファイルのbytesの列を返す。sbs_record.pyの記録ファイルは受信データを行の境界でつないで返す'''
+    if path == '-':
+        return iter_chunks(sys.stdin.buffer, BUF_SIZE)
+    from sbs_record import MAGIC, SbsReplay, LineJoiner
+    f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    try:
+        magic = f.read(len(MAGIC))
+    except EOFError:
+        # 先頭も読めないほど短い、書きかけの.gz
+        magic = b''
+    if magic == MAGIC:
+        f.close()
+        joiner = LineJoiner()
+        return (joiner.feed(feed, data) for _, feed, data in SbsReplay(path))
+    f.seek(0)
+    return iter_chunks(f, BUF_SIZE)
+
+
+class Counter:
+    """iter_chunks() などのbytesの列をそのまま返し、バイト数を数える"""
+
+    def __init__(self, chunks) -> None:
+        self.chunks = chunks
+        self.bytes = 0
+
+    def __iter__(self):
+        for data in self.chunks:
+            self.bytes += len(data)
+            yield data
+
+
+def convert(chunks, model: SbsModel, out: MavFanout = None, min_interval: float = 0) -> dict:
+    '''SBSのbytesの列をmodelに反映し、outがあれば値が変わった航空機のADSB_VEHICLEを書き込む
+
+    同じ航空機のADSB_VEHICLEは生成時刻でmin_interval秒以上あける。処理量を返す。
+    '''
+    counter = Counter(chunks)
+    cache = AdsbFrameCache()
+    model.add_expire_listener(cache.discard)
+    tlog = out.conns[0] if out is not None else None
+    latest = 0.0
+    expire_time = 0.0
+    heartbeat_time = 0.0
+    sent = 0
+    start = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        for veh in model.iter_apply(iter_lines(counter)):
+            t = veh.time_gen
+            if t > latest:
+                latest = t
+                if t - expire_time >= 1.0:
+                    expire_time = t
+                    # asyncioのブリッジと違いdirtyを取り出す送信側がいないので、ここで捨てる
+                    model.dirty.clear()
+                    model.delete_lost_aircraft(t)
+            if tlog is None or not veh.changed or t - veh.time_sent < min_interval:
+                continue
+            tlog.timestamp = t
+            if t - heartbeat_time >= 1.0:
+                heartbeat_time = t
+                send_heartbeat(out)
+            send_adsb_vehicle(out, cache, veh, 0)
+            veh.time_sent = t
+            veh.changed = 0
+            sent += 1
+    except KeyboardInterrupt:
+        pass
+    return {
+        'bytes': counter.bytes,
+        'lines': model.parsed + model.rejected,
+        'rejected': model.rejected,
+        'aircraft': len(model.vehicles) + model.expired,
+        'sent': sent,
+        'frames': tlog.frames if tlog is not None else 0,
+        'elapsed': time.perf_counter() - start,
+        'cpu': time.process_time() - cpu,
+    }
+
+
+def view(chunks, model: SbsModel) -> None:
+    '''受信するたびに、受信時刻でtimeout秒以内の航空機の一覧を表示する'''
+    try:
+        for lines in iter_lines(chunks):
+            model.set_vehicles(lines)
+            model.delete_lost_aircraft()
+            print('')
+            print(model)
+            # 次の表示では、その間に変わった航空機だけに印を付ける
+            model.dirty.clear()
+            for veh in model.vehicles.values():
+                veh.changed = 0
+    except KeyboardInterrupt:
+        pass
+
+
+def print_stats(s: dict) -> None:
+    elapsed = max(s['elapsed'], 1e-9)
+    print(f'{s["bytes"]} bytes {s["lines"]} MSG lines ({s["rejected"]} rejected) {s["aircraft"]} aircraft'
+        f' {s["sent"]} ADSB_VEHICLE {s["frames"]} frames')
+    print(f'{s["elapsed"]:.2f}s (cpu {s["cpu"]:.2f}s) {s["lines"] / elapsed:.0f} lines/s'
+        f' {s["bytes"] / elapsed / 1e6:.1f} MB/s {s["sent"] / elapsed:.0f} msgs/s')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert SBS to a MAVLink tlog as fast as possible.')
+    parser.add_argument('-f', '--file', type=str, default=None, help='SBS text (".gz" to decompress, "-" for stdin) or a sbs_record.py recording. default=read from HOST:PORT')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='SBS host. default=127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=30003, help='SBS port. default=30003')
+    parser.add_argument('-o', '--output', type=str, default=None, help='tlog to write. default=none (only parse and report throughput)')
+    parser.add_argument('-t', '--timeout', type=float, default=30, help='seconds until a lost aircraft is deleted. default=30')
+    parser.add_argument('--batch', action='store_true', help='read HOST:PORT as fast as possible and report throughput instead of showing the aircraft list')
+    parser.add_argument('--min-interval', type=float, default=0, help='minimum interval between ADSB_VEHICLE of one aircraft in SBS time [s]. default=0 (every change)')
+    args = parser.parse_args()
+
+    sock = None
+    if args.file:
+        chunks = open_source(args.file)
+    else:
+        sock = socket.create_connection((args.host, args.port))
+        print(f'connect! {args.host}:{args.port}')
+        chunks = iter_chunks(sock, BUF_SIZE)
+
+    out = MavFanout([TlogWriter(args.output)]) if args.output else None
+    try:
+        if sock is not None and out is None and not args.batch:
+            view(chunks, SbsModel(args.timeout))
+        else:
+            print_stats(convert(chunks, SbsModel(args.timeout), out, args.min_interval))
+    finally:
+        if out is not None:
+            out.close()
+        if sock is not None:
+            sock.close()
+
+    print('finish!')
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""SBSの受信と解析をワーカープロセスで行う取り込み
+
+ワーカーはSbsClientで受信した行をSbsParserで解析し、更新を固定長のバイナリ(SbsParser.RECORD)として
+ワーカーごとの共有メモリのリングバッファ(1対1)に書き込む。
+SbsModelとMAVLinkの接続を持つメインプロセスは、リングバッファから読み出した更新をSbsModelに反映するだけになる。
+
+フィードはワーカーに順に割り当てるので、ワーカー数はフィード数までしか効かない。
+複数のフィードの重複はメインプロセスで (ICAO, フィールドのマスク, 生成時刻) をキーに捨てる。
+
+    $ python3 sbs2mav.py --sbs rx1:30003 --sbs rx2:30003 --sbs rx3:30003 --workers 3
+"""
+import os
+import random
+import struct
+import asyncio
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+from sbs2mav import SbsClient, SbsParser, SbsDeduplicator
+
+U64 = struct.Struct('<Q')
+
+
+class ShmRing:
+    """共有メモリ上の固定長レコードのリングバッファ(書き込み側・読み出し側とも1つ)
+
+    先頭64バイトがヘッダで、書き込み位置(head)と読み出し位置(tail)をそれぞれ通算のレコード数で持つ。
+    headは書き込み側だけが、tailは読み出し側だけが書き換える。
+    ヘッダの読み書きは必ずlock(multiprocessingのLock)を取って行う。共有メモリへの書き込みの順序が
+    他のプロセスから同じ順に見えることと、32bit環境で64bitの値が途中まで書かれた状態で読まれないことを
+    ロックで保証する。レコードの中身はheadを進める前に書き込むので、ロックの外で書いてよい。
+    waitingは読み出し側が待っているときに立て、書き込み側はそれを見てパイプで起こす。
+    空の確認とwaitingの設定、headの更新とwaitingの確認はそれぞれロックの中で一度に行うので、起こし損ねない。
+    STATSはワーカーの統計で、書き込み側が定期的に更新する。
+    """
+
+    HEADER = 64
+    HEAD = 0
+    TAIL = 8
+    WAITING = 16
+    # 受信行数, 受信バイト数, 解析できなかった行数, リングバッファが一杯で待った回数, 接続回数
+    STATS = struct.Struct('<QQQQQ')
+    STATS_OFFSET = 24
+
+    def __init__(self, shm: shared_memory.SharedMemory, slots: int, lock, owner: bool) -> None:
+        self.shm = shm
+        self.buf = shm.buf
+        self.slots = slots
+        self.lock = lock
+        self.size = SbsParser.RECORD.size
+        self.owner = owner
+
+    @classmethod
+    def create(cls, slots: int, lock=None):
+        shm = shared_memory.SharedMemory(create=True, size=cls.HEADER + slots * SbsParser.RECORD.size)
+        shm.buf[:cls.HEADER] = bytes(cls.HEADER)
+        return cls(shm, slots, lock if lock is not None else mp.Lock(), True)
+
+    @classmethod
+    def attach(cls, name: str, slots: int, lock):
+        try:
+            # Python 3.13以降
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # 作成したプロセスが削除するので、接続する側はresource_trackerに登録しない。
+            # 登録すると終了時に「leaked shared_memory」の警告が出たり、二重に削除しようとしたりする
+            register = resource_tracker.register
+            resource_tracker.register = lambda name, rtype: None
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+        return cls(shm, slots, lock, False)
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def close(self) -> None:
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def _get(self, offset: int) -> int:
+        return U64.unpack_from(self.buf, offset)[0]
+
+    def _set(self, offset: int, value: int) -> None:
+        U64.pack_into(self.buf, offset, value)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self._get(self.HEAD) - self._get(self.TAIL)
+
+    def write(self, updates: list) -> int:
+        '''書き込み側。空いている分だけ書き込み、書き込んだ数を返す'''
+        with self.lock:
+            head = self._get(self.HEAD)
+            tail = self._get(self.TAIL)
+        n = min(len(updates), self.slots - (head - tail))
+        buf = self.buf
+        pack_into = SbsParser.pack_into
+        for k in range(n):
+            pack_into(buf, self.HEADER + (head + k) % self.slots * self.size, updates[k])
+        if n:
+            with self.lock:
+                self._set(self.HEAD, head + n)
+        return n
+
+    def read(self, limit: int) -> list:
+        '''読み出し側。最大limit個を読み出す'''
+        with self.lock:
+            tail = self._get(self.TAIL)
+            n = min(self._get(self.HEAD) - tail, limit)
+        if n <= 0:
+            return []
+        start = tail % self.slots
+        # 末尾で折り返す分は2回に分けて読む
+        first = min(n, self.slots - start)
+        offset = self.HEADER + start * self.size
+        updates = SbsParser.unpack(self.buf[offset:offset + first * self.size])
+        if first < n:
+            updates += SbsParser.unpack(self.buf[self.HEADER:self.HEADER + (n - first) * self.size])
+        with self.lock:
+            self._set(self.TAIL, tail + n)
+        return updates
+
+    def wait(self) -> bool:
+        '''読み出し側。空ならwaitingを立てて真を返す'''
+        with self.lock:
+            if self._get(self.HEAD) != self._get(self.TAIL):
+                return False
+            self._set(self.WAITING, 1)
+            return True
+
+    def need_wake(self) -> bool:
+        '''書き込み側。write() の後に呼ぶ。読み出し側が待っていればwaitingを下ろして真を返す'''
+        with self.lock:
+            if self._get(self.WAITING):
+                self._set(self.WAITING, 0)
+                return True
+            return False
+
+    def set_stats(self, *values) -> None:
+        with self.lock:
+            self.STATS.pack_into(self.buf, self.STATS_OFFSET, *values)
+
+    def stats(self) -> tuple:
+        with self.lock:
+            return self.STATS.unpack_from(self.buf, self.STATS_OFFSET)
+
+
+class RingSink:
+    """ワーカー内でSbsModelの代わりにSbsClientから行を受け取り、解析してリングバッファに書き込む"""
+
+    def __init__(self, ring: ShmRing, wake) -> None:
+        self.ring = ring
+        self.wake = wake
+        self.parser = SbsParser()
+        self.pending = []
+        self.stalls = 0
+
+    @property
+    def rejected(self) -> int:
+        return self.parser.rejected
+
+    def set_vehicles(self, lines, accepted: list = None) -> None:
+        '''SbsModel.set_vehicles() と同じ呼び出し方。acceptedを指定したときは、解析できた行をそこに追加する'''
+        pending = self.pending
+        for line, update in self.parser.iter_parse(lines):
+            pending.append(update)
+            if accepted is not None:
+                accepted.append(line)
+        self.flush()
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        n = self.ring.write(self.pending)
+        del self.pending[:n]
+        if n and self.ring.need_wake():
+            self.wake.send_bytes(b'\0')
+
+
+async def run_feed(index: int, sink: RingSink, sbs: SbsClient) -> None:
+    '''ワーカー内で1つの受信機から受信し続ける。切断やリセットされたら再接続する(sbs2mav.run_sbs() と同じ)'''
+    while True:
+        try:
+            async with sbs:
+                print(f'worker{index} connect! {sbs.host}:{sbs.port}')
+                while await sbs.recv():
+                    # リングバッファが空くまで受信を止め、TCPの受信ウインドウで送信側を待たせる
+                    while sink.pending:
+                        sink.stalls += 1
+                        await asyncio.sleep(0.001)
+                        sink.flush()
+        except OSError as e:
+            print(f'worker{index} disconnect {sbs.stats()} {e!r}')
+            await asyncio.sleep(sbs.RETRY_MIN * random.uniform(0.5, 1.0))
+            continue
+        print(f'worker{index} disconnect {sbs.stats()}')
+
+
+async def run_worker(index: int, feeds: list, ring: ShmRing, wake) -> None:
+    sink = RingSink(ring, wake)
+    clients = [SbsClient(sink, host, port, None, None, feed) for feed, (host, port) in feeds]
+    tasks = [asyncio.create_task(run_feed(index, sink, sbs)) for sbs in clients]
+    parent = os.getppid()
+    try:
+        while os.getppid() == parent:
+            ring.set_stats(sum(c.lines for c in clients), sum(c.bytes for c in clients),
+                sink.rejected, sink.stalls, sum(c.connects for c in clients))
+            await asyncio.sleep(0.5)
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+def worker_main(index: int, feeds: list, ring_name: str, slots: int, lock, wake) -> None:
+    '''ワーカープロセスの入口。feeds: (フィード番号, (host, port))のリスト'''
+    ring = ShmRing.attach(ring_name, slots, lock)
+    try:
+        asyncio.run(run_worker(index, feeds, ring, wake))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.close()
+
+
+class IngestPool:
+    """ワーカープロセスを起動し、リングバッファの更新をSbsModelに反映する
+
+    リングバッファが空で待っている間にワーカーが書き込むと、パイプで起こされる。
+    POLL_INTERVAL秒ごとに航空機の削除を行い、あわせて全てのリングバッファを読み出す。
+    """
+
+    BATCH = 4096
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, model, feeds: list, workers: int = 2, slots: int = 65536) -> None:
+        self.model = model
+        self.feeds = feeds
+        self.workers = max(1, min(workers, len(feeds)))
+        self.slots = slots
+        self.dedup = SbsDeduplicator() if len(feeds) > 1 else None
+        self.duplicates = 0
+        self.rings = []
+        self.pipes = []
+        self.processes = []
+        self.scheduled = set()
+        self.closed = False
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        ctx = mp.get_context('spawn')
+        for i in range(self.workers):
+            feeds = [(feed, f) for feed, f in enumerate(self.feeds) if feed % self.workers == i]
+            lock = ctx.Lock()
+            ring = ShmRing.create(self.slots, lock)
+            r, w = ctx.Pipe(duplex=False)
+            p = ctx.Process(target=worker_main, args=(i, feeds, ring.name, self.slots, lock, w), daemon=True)
+            p.start()
+            w.close()
+            self.rings.append(ring)
+            self.pipes.append(r)
+            self.processes.append(p)
+            loop.add_reader(r.fileno(), self.on_wake, i)
+
+    def close(self) -> None:
+        self.closed = True
+        loop = asyncio.get_running_loop()
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.join()
+        for r in self.pipes:
+            if not r.closed:
+                loop.remove_reader(r.fileno())
+                r.close()
+        for ring in self.rings:
+            ring.close()
+
+    def on_wake(self, i: int) -> None:
+        r = self.pipes[i]
+        try:
+            while r.poll():
+                r.recv_bytes()
+        except EOFError:
+            print(f'worker{i} exited')
+            asyncio.get_running_loop().remove_reader(r.fileno())
+            r.close()
+        self.schedule(i)
+
+    def schedule(self, i: int) -> None:
+        '''ワーカーiのリングバッファの読み出しを予約する。予約済みなら何もしない'''
+        if i not in self.scheduled:
+            self.scheduled.add(i)
+            asyncio.get_running_loop().call_soon(self.poll, i)
+
+    def poll(self, i: int) -> None:
+        self.scheduled.discard(i)
+        if self.closed:
+            return
+        ring = self.rings[i]
+        updates = ring.read(self.BATCH)
+        if updates:
+            if self.dedup is not None:
+                seen = self.dedup.seen
+                n = len(updates)
+                updates = [u for u in updates if not seen((u[0], u[1], u[2]))]
+                self.duplicates += n - len(updates)
+            self.model.apply_updates(updates)
+        if len(updates) >= self.BATCH or not ring.wait():
+            self.schedule(i)
+
+    async def run(self) -> None:
+        self.start()
+        try:
+            while True:
+                for i in range(self.workers):
+                    self.schedule(i)
+                self.model.delete_lost_aircraft()
+                await asyncio.sleep(self.POLL_INTERVAL)
+        finally:
+            self.close()
+
+    def worker_stats(self) -> list:
+        '''ワーカーごとの (受信行数, 受信バイト数, 解析できなかった行数, 待った回数, 接続回数, リングバッファの使用数)'''
+        return [ring.stats() + (len(ring),) for ring in self.rings]
+
+    def register(self, registry) -> None:
+        '''metrics.Registryにワーカーのメトリクスを登録する'''
+        stat = lambda k: lambda: {f'worker="{i}"': s[k] for i, s in enumerate(self.worker_stats())}
+        registry.counter('worker_lines_read_total', 'SBS MSG lines read by ingest workers', stat(0))
+        registry.counter('worker_bytes_read_total', 'SBS bytes read by ingest workers', stat(1))
+        registry.counter('worker_lines_rejected_total', 'SBS MSG lines rejected by ingest workers', stat(2))
+        registry.counter('worker_ring_stalls_total', 'times an ingest worker waited for ring buffer space', stat(3))
+        registry.gauge('worker_ring_depth', 'updates waiting in the ring buffer', stat(5))
+        registry.counter('worker_duplicates_total', 'updates dropped as duplicates', lambda: self.duplicates)
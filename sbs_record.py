@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""SBS(ポート30003)の受信データの記録と再生
+
+記録ファイルは先頭のMAGICに続いて、受信したデータをそのまま次のレコードとして並べたもの。
+
+    受信時刻(epoch秒, float64) フィードID(uint16) 長さ(uint32) データ
+
+ファイル名が.gzで終わるときはgzipで圧縮する。非圧縮のファイルはmmapで、圧縮したファイルは逐次読み込みで再生するため、
+ファイル全体をメモリに載せることはない。
+
+    $ python3 sbs_record.py record -o capture.sbsrec.gz --host localhost --port 30003
+    $ python3 sbs_record.py replay capture.sbsrec.gz --serve --port 30003 --speed 10
+    $ python3 sbs_record.py replay capture.sbsrec.gz --model --speed 0
+"""
+import os
+import gzip
+import mmap
+import time
+import struct
+import asyncio
+import argparse
+
+MAGIC = b'SBSREC1\n'
+RECORD = struct.Struct('<dHI')
+
+
+class SbsRecorder:
+    """受信データを受信時刻とともにファイルに記録する"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        if path.endswith('.gz'):
+            self.file = gzip.open(path, 'wb', compresslevel=6)
+        else:
+            self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.records = 0
+        self.bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, data: bytes, feed: int = 0, t: float = None) -> None:
+        if t is None:
+            t = time.time()
+        self.file.write(RECORD.pack(t, feed, len(data)))
+        self.file.write(data)
+        self.records += 1
+        self.bytes += len(data)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class SbsReplay:
+    """記録ファイルを (受信時刻, フィードID, データ) の順に読み出す"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def __iter__(self):
+        if self.path.endswith('.gz'):
+            return self._iter_stream()
+        return self._iter_mmap()
+
+    def _iter_mmap(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < len(MAGIC):
+                raise ValueError(f'{self.path}: not a SBS record file')
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(MAGIC)] != MAGIC:
+                    raise ValueError(f'{self.path}: not a SBS record file')
+                pos = len(MAGIC)
+                end = len(mm)
+                while pos + RECORD.size <= end:
+                    t, feed, n = RECORD.unpack_from(mm, pos)
+                    pos += RECORD.size
+                    if pos + n > end:
+                        # 書きかけのレコード
+                        break
+                    yield t, feed, mm[pos:pos + n]
+                    pos += n
+
+    def _iter_stream(self):
+        with gzip.open(self.path, 'rb') as f:
+            try:
+                magic = f.read(len(MAGIC))
+            except EOFError:
+                # 書き始めたばかりで、まだレコードがない
+                return
+            if magic != MAGIC:
+                raise ValueError(f'{self.path}: not a SBS record file')
+            while True:
+                try:
+                    head = f.read(RECORD.size)
+                    if len(head) < RECORD.size:
+                        break
+                    t, feed, n = RECORD.unpack(head)
+                    data = f.read(n)
+                except EOFError:
+                    # 書きかけで終端のない.gzは、最後の完全なレコードまでとする
+                    break
+                if len(data) < n:
+                    break
+                yield t, feed, data
+
+
+class Pacer:
+    """記録時の受信間隔をspeed倍速で再現する。speed=0のときは待たない"""
+
+    def __init__(self, speed: float) -> None:
+        self.speed = speed
+        self.origin = None
+
+    def delay(self, t: float) -> float:
+        if self.speed <= 0:
+            return 0.0
+        now = time.monotonic()
+        if self.origin is None:
+            self.origin = (t, now)
+            return 0.0
+        return (t - self.origin[0]) / self.speed - (now - self.origin[1])
+
+
+class LineJoiner:
+    """フィードごとに行の途中で切れたデータを次のデータとつなぎ、完全な行だけを返す"""
+
+    def __init__(self) -> None:
+        self.partial = {}
+
+    def feed(self, feed: int, data: bytes) -> bytes:
+        head = self.partial.pop(feed, b'')
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            self.partial[feed] = head + data
+            return b''
+        if cut < len(data):
+            self.partial[feed] = data[cut:]
+        return head + data[:cut] if head else data[:cut]
+
+
+async def replay_to_writer(path: str, writer: asyncio.StreamWriter, speed: float) -> int:
+    '''記録ファイルを1つのTCP接続に送る'''
+    pacer = Pacer(speed)
+    joiner = LineJoiner()
+    sent = 0
+    for t, feed, data in SbsReplay(path):
+        delay = pacer.delay(t)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        buf = joiner.feed(feed, data)
+        if buf:
+            writer.write(buf)
+            sent += len(buf)
+            await writer.drain()
+    return sent
+
+
+async def serve(path: str, host: str, port: int, speed: float) -> None:
+    '''記録ファイルをSBSサーバとして配信する。接続ごとに先頭から再生する'''
+    async def handle(reader, writer):
+        peer = writer.get_extra_info('peername')
+        print(f'connect {peer}')
+        try:
+            sent = await replay_to_writer(path, writer, speed)
+            print(f'finish {peer} {sent} bytes')
+        except (ConnectionError, OSError):
+            print(f'disconnect {peer}')
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f'serving {path} on {host}:{port} speed:{speed}')
+    async with server:
+        await server.serve_forever()
+
+
+def replay_to_model(path: str, model, speed: float = 0) -> dict:
+    '''記録ファイルをSbsModelに直接流し込み、処理量を返す
+
+    航空機の削除には記録時の受信時刻を使う。
+    '''
+    from sbs2mav import SbsFramer
+
+    framers = {}
+    pacer = Pacer(speed)
+    chunks = 0
+    nbytes = 0
+    lines = 0
+    last = 0.0
+    start = time.perf_counter()
+    cpu = time.process_time()
+    for t, feed, data in SbsReplay(path):
+        delay = pacer.delay(t)
+        if delay > 0:
+            time.sleep(delay)
+        framer = framers.get(feed)
+        if framer is None:
+            framer = framers[feed] = SbsFramer()
+        parsed = framer.feed(data)
+        model.set_vehicles(parsed)
+        if t - last >= 1.0:
+            model.delete_lost_aircraft(t)
+            last = t
+        chunks += 1
+        nbytes += len(data)
+        lines += len(parsed)
+    return {
+        'chunks': chunks,
+        'bytes': nbytes,
+        'lines': lines,
+        'vehicles': len(model.vehicles),
+        'elapsed': time.perf_counter() - start,
+        'cpu': time.process_time() - cpu,
+    }
+
+
+async def record(path: str, host: str, port: int) -> None:
+    '''SBSサーバから受信したデータをそのまま記録する'''
+    with SbsRecorder(path) as recorder:
+        reader, writer = await asyncio.open_connection(host, port)
+        print(f'recording {host}:{port} to {path}')
+        try:
+            while True:
+                data = await reader.read(4096 * 16)
+                if not data:
+                    break
+                recorder.write(data)
+        finally:
+            writer.close()
+            print(f'{recorder.records} records {recorder.bytes} bytes')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record and replay SBS-1 streams.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('record', help='record a SBS stream')
+    p.add_argument('-o', '--output', type=str, required=True, help='output file. ".gz" to compress')
+    p.add_argument('--host', type=str, default='localhost', help='SBS host. default=localhost')
+    p.add_argument('-p', '--port', type=int, default=30003, help='SBS port. default=30003')
+    p = sub.add_parser('replay', help='replay a recorded file')
+    p.add_argument('file', type=str, help='recorded file')
+    p.add_argument('--serve', action='store_true', help='serve the file as a SBS server')
+    p.add_argument('--model', action='store_true', help='feed the file into SbsModel and report throughput')
+    p.add_argument('--host', type=str, default='localhost', help='listen host. default=localhost')
+    p.add_argument('-p', '--port', type=int, default=30003, help='listen port. default=30003')
+    p.add_argument('-s', '--speed', type=float, default=1.0, help='playback speed. 0 = as fast as possible. default=1.0')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'record':
+            asyncio.run(record(args.output, args.host, args.port))
+        elif args.model:
+            from sbs2mav import SbsModel
+            r = replay_to_model(args.file, SbsModel(), args.speed)
+            print(f'{r["lines"]} lines {r["bytes"]} bytes {r["vehicles"]} vehicles'
+                f' {r["elapsed"]:.3f}s {r["lines"] / max(r["elapsed"], 1e-9):.0f} lines/s'
+                f' cpu {r["cpu"] * 1e6 / max(r["lines"], 1):.2f}ms/1k lines')
+        elif args.serve:
+            asyncio.run(serve(args.file, args.host, args.port, args.speed))
+        else:
+            parser.error('replay needs --serve or --model')
+    except KeyboardInterrupt:
+        pass
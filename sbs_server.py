@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""受信したSBSの行を複数のTCPクライアントに再配信するサーバ
+
+SbsModelが解析できた行(複数の受信機のときは重複を除いたもの)だけを、ポート30003と同じ形式で配信する。
+配信する行はflush_interval秒ごとにまとめて1度だけbytesにし、全クライアントに同じオブジェクトを書き込む。
+クライアントごとの書き込みバッファがmax_bufferバイトを超えたら、読むのが遅いクライアントとして切断する。
+
+    $ python3 sbs2mav.py --serve 0.0.0.0:30004 --serve-tx 3,4
+"""
+import asyncio
+
+
+class SbsServer:
+    """SBSの行を配信するTCPサーバ
+
+    txを指定したときは、その送信種別(MSGの2番目のフィールド)の行だけを配信する。
+    """
+
+    def __init__(self, host: str, port: int, tx: set = None, max_buffer: int = 1024 * 1024,
+            flush_interval: float = 0.05) -> None:
+        self.host = host
+        self.port = port
+        self.tx = tx
+        self.max_buffer = max_buffer
+        self.flush_interval = flush_interval
+        self.writers = set()
+        self.pending = []
+        self.connects = 0
+        self.dropped = 0
+        self.lines = 0
+        self.bytes = 0
+
+    def publish(self, lines: list) -> None:
+        '''フィールドに分割済みの行を配信待ちに追加する。クライアントがいなければ何もしない'''
+        if not self.writers:
+            return
+        if self.tx is not None:
+            tx = self.tx
+            lines = [line for line in lines if line[1] in tx]
+        self.pending.extend(lines)
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        data = ''.join([','.join(line) + '\r\n' for line in self.pending]).encode('ascii', 'replace')
+        self.lines += len(self.pending)
+        self.pending = []
+        for writer in list(self.writers):
+            if writer.transport.get_write_buffer_size() > self.max_buffer:
+                # 読むのが遅いクライアントを待つと全体が遅れるので切断する
+                self.writers.discard(writer)
+                writer.transport.abort()
+                self.dropped += 1
+                print(f'sbs server: drop slow client {writer.get_extra_info("peername")}')
+                continue
+            writer.write(data)
+            self.bytes += len(data)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.writers.add(writer)
+        self.connects += 1
+        try:
+            # クライアントからの入力は読み捨て、切断を待つ
+            while await reader.read(4096):
+                pass
+        except ConnectionError:
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def run(self) -> None:
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f'sbs server: {self.host}:{self.port}')
+        try:
+            async with server:
+                while True:
+                    await asyncio.sleep(self.flush_interval)
+                    self.flush()
+        finally:
+            for writer in list(self.writers):
+                writer.close()
+
+    def stats(self) -> str:
+        return f'clients:{len(self.writers)} connects:{self.connects} dropped:{self.dropped} lines:{self.lines} bytes:{self.bytes}'
+
+    def register(self, registry) -> None:
+        '''metrics.Registryにメトリクスを登録する'''
+        registry.gauge('serve_clients', 'SBS server clients', lambda: len(self.writers))
+        registry.counter('serve_dropped_total', 'SBS server clients dropped as slow', lambda: self.dropped)
+        registry.counter('serve_lines_total', 'SBS lines served', lambda: self.lines)
+        registry.counter('serve_bytes_total', 'SBS bytes written to clients', lambda: self.bytes)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import math
+import heapq
+
+EARTH_RADIUS = 6371000.0
+METERS_PER_DEG = EARTH_RADIUS * math.pi / 180
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    '''2点間の距離[m](正距円筒近似)'''
+    dy = (lat2 - lat1) * METERS_PER_DEG
+    dx = (lon2 - lon1) * METERS_PER_DEG * math.cos(math.radians(lat1))
+    return math.sqrt(dx * dx + dy * dy)
+
+
+class SpatialGrid:
+    """緯度経度の格子による空間インデックス
+
+    キー(ICAOアドレスなど)ごとに最新の位置を1つだけ保持する。
+    query() は基準点に近いセルから順に調べるため、コストは周辺にある点の数に比例する。
+    経度±180度をまたぐ範囲は扱わない。
+    """
+
+    def __init__(self, cell_deg: float = 0.1) -> None:
+        self.cell_deg = cell_deg
+        self.cells = {}
+        self.index = {}
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def cell(self, lat: float, lon: float) -> tuple:
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def update(self, key, lat: float, lon: float) -> None:
+        c = self.cell(lat, lon)
+        old = self.index.get(key)
+        if old is not None and old != c:
+            self._remove_from_cell(key, old)
+        self.index[key] = c
+        self.cells.setdefault(c, {})[key] = (lat, lon)
+
+    def remove(self, key) -> None:
+        c = self.index.pop(key, None)
+        if c is not None:
+            self._remove_from_cell(key, c)
+
+    def _remove_from_cell(self, key, c: tuple) -> None:
+        points = self.cells[c]
+        del points[key]
+        if not points:
+            del self.cells[c]
+
+    def query(self, lat: float, lon: float, radius: float = None, n: int = None, accept=None) -> list:
+        '''基準点から radius[m] 以内で近い順に最大n個の (距離[m], キー) を返す
+
+        accept(key) が偽を返すキーは除外する。
+        基準点を中心とするリング状にセルを調べ、n個見つかって次のリングより内側に収まったら打ち切る。
+        リングのセル数が残りの(点のある)セルの数を超えたら、残りのセルを直接調べる。
+        '''
+        if not self.cells or (radius is None and n is None):
+            return []
+
+        coslat = max(math.cos(math.radians(lat)), 0.01)
+        # 1セル進むごとに確実に含まれる距離(セルの短辺)
+        ring_m = self.cell_deg * METERS_PER_DEG * coslat
+        ci, cj = self.cell(lat, lon)
+        max_ring = math.ceil(radius / ring_m) if radius is not None else None
+
+        found = []
+
+        def scan(points: dict) -> None:
+            for key, (plat, plon) in points.items():
+                if accept is not None and not accept(key):
+                    continue
+                dy = (plat - lat) * METERS_PER_DEG
+                dx = (plon - lon) * METERS_PER_DEG * coslat
+                d = math.sqrt(dx * dx + dy * dy)
+                if radius is None or d <= radius:
+                    found.append((d, key))
+
+        # まだ調べていない点のあるセルの数
+        remaining = len(self.cells)
+        ring = 0
+        while remaining:
+            if ring * 8 > remaining:
+                # 空のセルを1つずつ引くより、残りのセルを直接調べる方が速い
+                for (i, j), points in self.cells.items():
+                    r = max(abs(i - ci), abs(j - cj))
+                    if r >= ring and (max_ring is None or r <= max_ring):
+                        scan(points)
+                break
+            for c in self._ring(ci, cj, ring):
+                points = self.cells.get(c)
+                if points is not None:
+                    remaining -= 1
+                    scan(points)
+
+            if max_ring is not None and ring >= max_ring:
+                break
+            if n is not None and len(found) >= n:
+                # 次のリングより内側にn個以上あれば打ち切り
+                if heapq.nsmallest(n, found)[-1][0] <= ring * ring_m:
+                    break
+            ring += 1
+
+        if n is not None:
+            return heapq.nsmallest(n, found)
+        found.sort()
+        return found
+
+    def _ring(self, ci: int, cj: int, r: int):
+        if r == 0:
+            yield (ci, cj)
+            return
+        for j in range(cj - r, cj + r + 1):
+            yield (ci - r, j)
+            yield (ci + r, j)
+        for i in range(ci - r + 1, ci + r):
+            yield (i, cj - r)
+            yield (i, cj + r)
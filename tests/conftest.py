@@ -0,0 +1,5 @@
+import os
+import sys
+
+# テストはリポジトリ直下のスクリプトをモジュールとして読み込む
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,13 @@
+"""テスト用のSBSの行"""
+
+
+def msg(icao: str, tx: int = 3, date: str = '2024/01/15', clock: str = '12:00:00.000', callsign: str = '',
+        alt: str = '', gs: str = '', track: str = '', lat: str = '', lon: str = '', vrate: str = '',
+        squawk: str = '', alert: str = '', emergency: str = '', spi: str = '', gnd: str = '') -> str:
+    '''MSG行を1行(CRLFなし)作る'''
+    return ','.join(['MSG', str(tx), '1', '1', icao, '1', date, clock, date, clock, callsign, alt, gs, track,
+        lat, lon, vrate, squawk, alert, emergency, spi, gnd])
+
+
+def fields(line: str) -> list:
+    return line.split(',')
@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from adsb_capture import AdsbCapture, load, summary
+
+
+class Msg:
+    def __init__(self, icao: int, flags: int = 0x13) -> None:
+        self.ICAO_address = icao
+        self.lat = 355000000
+        self.lon = 1397000000
+        self.altitude = 10000000
+        self.heading = 9000
+        self.hor_velocity = 20000
+        self.ver_velocity = 0
+        self.flags = flags
+        self.squawk = 1200
+        self.tslc = 1
+        self.emitter_type = 3
+        self.callsign = 'JAL123  '
+
+    def get_type(self) -> str:
+        return 'ADSB_VEHICLE'
+
+
+def capture(path: str, t0: float, n: int) -> None:
+    with AdsbCapture(path, chunk=4) as c:
+        for i in range(n):
+            c.extend([Msg(i % 3)], t0 + i)
+
+
+def test_rerun_appends_parts(tmp_path):
+    path = str(tmp_path / 'capture')
+    capture(path, 0.0, 6)
+    capture(path, 100.0, 5)
+    data = load(path)
+    assert len(data['time']) == 11
+    assert list(data['time']) == [float(i) for i in range(6)] + [100.0 + i for i in range(5)]
+    assert data['callsign'][0] == b'JAL123  '
+
+
+def test_summary(tmp_path):
+    path = str(tmp_path / 'capture')
+    capture(path, 0.0, 9)
+    s = summary(load(path))
+    assert s['rows'] == 9
+    assert s['aircraft'] == 3
+    assert s['interval_p50'] == 3.0
+    assert s['coverage']['VALID_COORDS'] == (1.0, 1.0)
+    assert s['coverage']['VALID_HEADING'] == (0.0, 0.0)
@@ -0,0 +1,66 @@
+import pytest
+
+from aircraft_db import AircraftDb, build, parse_category, parse_description, parse_aircraft_type
+
+
+def test_parse_description_prefers_longer_prefix():
+    assert parse_description('Lighter-than-air') == 10
+    assert parse_description('Light (< 15500 lbs)') == 1
+    assert parse_description('Rotorcraft') == 7
+    assert parse_description('') == 0
+
+
+def test_parse_category_clamps_to_adsb_emitter_type():
+    assert parse_category('A3') == 3
+    assert parse_category('B1') == 9
+    assert parse_category('C3') == 19
+    assert parse_category('C4') == 0
+    assert parse_category('A0') == 0
+    assert parse_category('19') == 19
+    assert parse_category('20') == 0
+    assert parse_category('255') == 0
+    assert parse_category('x') == 0
+
+
+def test_parse_aircraft_type():
+    assert parse_aircraft_type('L2J') == 3
+    assert parse_aircraft_type('L4J') == 5
+    assert parse_aircraft_type('H1T') == 7
+    assert parse_aircraft_type('L1P') == 1
+    assert parse_aircraft_type('') == 0
+
+
+@pytest.mark.parametrize('quote', ["'", '"'])
+def test_build_and_lookup(tmp_path, quote):
+    q = lambda v: f'{quote}{v}{quote}'
+    rows = [
+        ['icao24', 'registration', 'categoryDescription', 'icaoaircrafttype'],
+        ['86d5b4', 'JA123A', 'Lighter-than-air', ''],
+        ['8500f1', 'JA8500', '', 'L2J'],
+        ['0000ff', '', '', ''],
+        ['zzzzzz', 'BAD', '', ''],
+        ['abcdef', 'N1, INC', '', ''],
+    ]
+    csv_path = tmp_path / 'aircraft.csv'
+    csv_path.write_text(''.join(','.join(q(v) for v in row) + '\n' for row in rows))
+    db_path = str(tmp_path / 'aircraft.db')
+    assert build(str(csv_path), db_path) == 3
+
+    db = AircraftDb(db_path)
+    try:
+        assert len(db) == 3
+        assert db.lookup(0x86D5B4) == (10, 'JA123A')
+        assert db.lookup(0x8500F1) == (3, 'JA8500')
+        assert db.lookup(0xABCDEF) == (0, 'N1, INC')
+        assert db.lookup(0x0000FF) is None
+        assert db.lookup(0xFFFFFF) is None
+        assert db.lookup(0) is None
+    finally:
+        db.close()
+
+
+def test_not_a_database(tmp_path):
+    path = tmp_path / 'bad.db'
+    path.write_bytes(b'not a database at all')
+    with pytest.raises(ValueError):
+        AircraftDb(str(path))
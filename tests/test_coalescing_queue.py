@@ -0,0 +1,58 @@
+from sbs2mav import CoalescingQueue, SbsModel
+from sbs_lines import msg, fields
+
+
+def test_put_keeps_first_time():
+    q = CoalescingQueue()
+    q.put(1, 10.0)
+    q.put(2, 11.0)
+    q.put(1, 12.0)
+    assert len(q) == 2
+    assert 1 in q and 3 not in q
+    assert list(q) == [1, 2]
+    assert q.oldest_age(15.0) == 5.0
+    assert q.drain() == {1: 10.0, 2: 11.0}
+    assert len(q) == 0
+    assert q.oldest_age(15.0) == 0.0
+
+
+def test_overflow_drops_oldest():
+    q = CoalescingQueue(maxsize=3)
+    for icao in range(5):
+        q.put(icao, float(icao))
+    assert list(q) == [2, 3, 4]
+    assert q.overflow == 2
+    # 既にある航空機の更新は溢れない
+    q.put(3, 9.0)
+    assert q.overflow == 2
+    assert q.drain() == {2: 2.0, 3: 3.0, 4: 4.0}
+
+
+def test_discard_and_clear():
+    q = CoalescingQueue()
+    q.put(1, 1.0)
+    q.put(2, 2.0)
+    q.discard(1)
+    q.discard(99)
+    assert list(q) == [2]
+    q.clear()
+    assert len(q) == 0
+
+
+def test_model_coalesces_updates():
+    model = SbsModel()
+    model.set_vehicles([
+        fields(msg('ABCDEF', alt='1000')),
+        fields(msg('ABCDEF', alt='1100')),
+        fields(msg('123456', alt='2000')),
+        fields(msg('ABCDEF', alt='1200')),
+    ])
+    assert model.dirty.event.is_set()
+    pending = model.dirty.drain()
+    assert list(pending) == [0xABCDEF, 0x123456]
+    # 取り出した時点の値が最新の行の値
+    assert model.vehicles[0xABCDEF].alt == 1200
+
+    # 値が変わらない行はdirtyに入らない
+    model.set_vehicles([fields(msg('123456', alt='2000'))])
+    assert len(model.dirty) == 0
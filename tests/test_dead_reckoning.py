@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+from sbs2mav import DeadReckoning, Vehicle
+from spatial import METERS_PER_DEG
+
+
+def vehicle(icao: int, flags: int, lat=35.5, lon=139.7, alt=10000, gs=360, track=0, vrate=0,
+        time_pos=100.0, time_alt=100.0) -> Vehicle:
+    v = Vehicle(icao)
+    v.flags = flags
+    v.lat, v.lon, v.alt, v.gs, v.track, v.vrate = lat, lon, alt, gs, track, vrate
+    v.time_pos, v.time_alt = time_pos, time_alt
+    return v
+
+
+def test_predict_one():
+    dr = DeadReckoning(horizon=5.0)
+    moving = DeadReckoning.NEED | Vehicle.VALID_ALTITUDE | Vehicle.VERTICAL_VELOCITY_VALID
+    # 360ktで北へ2秒 = 370.4m、昇降率600ft/minで2秒 = 20ft
+    lat, lon, alt = dr.predict_one(vehicle(1, moving, vrate=600), 102.0)
+    assert lat == pytest.approx(35.5 + 370.4 / METERS_PER_DEG)
+    assert lon == pytest.approx(139.7)
+    assert alt == pytest.approx(10020)
+    # horizonで打ち切る
+    v = vehicle(1, moving, vrate=600)
+    assert dr.predict_one(v, 200.0) == pytest.approx(dr.predict_one(v, 105.0))
+    # 昇降率が無ければ高度はそのまま
+    assert dr.predict_one(vehicle(1, DeadReckoning.NEED, vrate=600), 102.0)[2] == 10000
+    assert dr.predict_one(vehicle(1, Vehicle.VALID_COORDS | Vehicle.VALID_VELOCITY), 102.0) is None
+
+
+def test_predict_array_matches_predict_one():
+    np = pytest.importorskip('numpy')
+    dr = DeadReckoning(horizon=5.0)
+    assert dr.np is np
+    rng = random.Random(1)
+    optional = (Vehicle.VALID_COORDS, Vehicle.VALID_VELOCITY, Vehicle.VALID_HEADING,
+        Vehicle.VALID_ALTITUDE, Vehicle.VERTICAL_VELOCITY_VALID)
+    vehicles = []
+    for i in range(500):
+        flags = DeadReckoning.NEED if i % 3 else 0
+        for bit in optional:
+            if rng.random() < 0.2:
+                flags ^= bit
+        vehicles.append(vehicle(i, flags, lat=rng.uniform(-89.9, 89.9), lon=rng.uniform(-180, 180),
+            alt=rng.randint(-1000, 45000), gs=rng.randint(0, 600), track=rng.randint(0, 359),
+            vrate=rng.randint(-6000, 6000), time_pos=100 + rng.uniform(-10, 10), time_alt=100 + rng.uniform(-10, 10)))
+    now = 103.0
+    expected = [dr.predict_one(v, now) for v in vehicles]
+    got = dr.predict_array(vehicles, now)
+    assert [p is None for p in got] == [p is None for p in expected]
+    for p, q in zip(got, expected):
+        if q is not None:
+            assert p == pytest.approx(q, rel=1e-12, abs=1e-9)
+    # 機数によらず同じ結果
+    assert dr.predict(vehicles, now) == got
+    assert dr.predict(vehicles[:DeadReckoning.VECTOR_MIN - 1], now) == expected[:DeadReckoning.VECTOR_MIN - 1]
+
+
+def test_register_exports_predicted():
+    import metrics
+
+    dr = DeadReckoning(horizon=5.0)
+    dr.predict([vehicle(1, DeadReckoning.NEED), vehicle(2, 0)], 102.0)
+    registry = metrics.Registry()
+    dr.register(registry)
+    assert 'sbs2mav_adsb_predicted_total 1' in registry.prometheus()
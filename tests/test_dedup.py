@@ -0,0 +1,29 @@
+from sbs2mav import SbsDeduplicator
+from sbs_lines import msg, fields
+
+
+def test_filter_drops_same_observation():
+    dedup = SbsDeduplicator()
+    a = fields(msg('ABCDEF', tx=3, clock='12:00:00.000', alt='1000'))
+    b = fields(msg('ABCDEF', tx=3, clock='12:00:00.100', alt='1000'))
+    c = fields(msg('ABCDEF', tx=4, clock='12:00:00.000', gs='450'))
+    d = fields(msg('123456', tx=3, clock='12:00:00.000', alt='1000'))
+    assert dedup.filter([a, b, c, d]) == [a, b, c, d]
+    # 別の受信機から届いた同じ観測
+    assert dedup.filter([fields(msg('ABCDEF', tx=3, clock='12:00:00.000', alt='1000')), c, d]) == []
+    assert dedup.filter([a, fields(msg('ABCDEF', tx=3, date='2024/01/16', alt='1000'))]) == [
+        fields(msg('ABCDEF', tx=3, date='2024/01/16', alt='1000'))]
+
+
+def test_generations():
+    dedup = SbsDeduplicator(size=4)
+    for i in range(4):
+        assert not dedup.seen(i)
+    # 1世代前までは覚えている
+    assert len(dedup.previous) == 4 and not dedup.current
+    assert all(dedup.seen(i) for i in range(4))
+    for i in range(4, 8):
+        assert not dedup.seen(i)
+    # 2世代前は捨てる
+    assert not dedup.seen(0)
+    assert dedup.seen(7)
@@ -0,0 +1,38 @@
+import io
+
+import metrics
+from sbs2mav import ConsoleDisplay, SbsModel
+from sbs_lines import msg, fields
+
+
+def make_model() -> SbsModel:
+    model = SbsModel()
+    model.set_vehicles([fields(msg(f'{i:06X}', callsign=f'TEST{i}', alt=str(1000 * i))) for i in range(1, 4)])
+    return model
+
+
+def test_live_rewrites_changed_rows_only():
+    model = make_model()
+    out = io.StringIO()
+    display = ConsoleDisplay(model, 'live', sort='alt', out=out)
+    display.render(100.0)
+    # 見出し2行と3機
+    assert display.rows_written == 5
+    display.render(100.0)
+    assert display.rows_written == 5
+    model.set_vehicles([fields(msg('000002', alt='5000'))])
+    display.render(100.0)
+    # 並び順が入れ替わった2行だけを書き直す
+    assert display.rows_written == 7
+    assert display.frames == 3
+
+
+def test_register_exports_counters():
+    model = make_model()
+    display = ConsoleDisplay(model, 'print', rows=2, out=io.StringIO())
+    display.render(100.0)
+    registry = metrics.Registry()
+    display.register(registry)
+    text = registry.prometheus()
+    assert 'sbs2mav_display_frames_total 1' in text
+    assert 'sbs2mav_display_rows_written_total 2' in text
@@ -0,0 +1,51 @@
+import pytest
+
+from sbs2mav import AdsbEmitter, SbsModel
+from sbs_lines import msg, fields
+
+
+def test_change_mode_min_and_max_interval():
+    model = SbsModel()
+    emitter = AdsbEmitter(model, True, min_interval=0.2, max_interval=1.0)
+    model.set_vehicles([fields(msg('ABCDEF', alt='1000'))])
+    veh = model.vehicles[0xABCDEF]
+
+    assert emitter.due(100.0) == [veh]
+    emitter.sent(veh, 100.0)
+    assert veh.changed == 0
+    assert emitter.due(100.05) == []
+
+    # min_interval以内の変更は送信待ちに戻し、その時刻まで待つ
+    model.set_vehicles([fields(msg('ABCDEF', alt='1100'))])
+    assert emitter.due(100.1) == []
+    assert 0xABCDEF in model.dirty
+    assert emitter.wait_time(100.1, 5.0) == pytest.approx(0.1)
+    assert emitter.wait_time(100.1, 0.05) == 0.05
+    assert emitter.due(100.2) == [veh]
+    emitter.sent(veh, 100.2)
+    assert len(model.dirty) == 0
+
+    # 変わらない航空機はmax_intervalごとに再送する(見回りはmax_interval / SWEEP_DIVISIONごと)
+    assert emitter.due(101.0) == []
+    assert emitter.wait_time(101.0, 5.0) == pytest.approx(0.25)
+    assert emitter.due(101.25) == [veh]
+
+
+def test_change_mode_sends_each_aircraft_once():
+    model = SbsModel()
+    emitter = AdsbEmitter(model, True, min_interval=0.2, max_interval=1.0)
+    model.set_vehicles([fields(msg(f'{i:06X}', alt='1000')) for i in range(1, 4)])
+    model.set_vehicles([fields(msg('000002', alt='1200'))])
+    # 変更と再送の両方に当たっても1回だけ
+    assert sorted(v.icao for v in emitter.due(100.0)) == [1, 2, 3]
+
+
+def test_periodic_mode():
+    model = SbsModel()
+    emitter = AdsbEmitter(model, False, max_interval=1.0)
+    model.set_vehicles([fields(msg(f'{i:06X}', alt='1000')) for i in range(1, 3)])
+    assert len(emitter.due(100.0)) == 2
+    assert len(model.dirty) == 0
+    assert emitter.due(100.5) == []
+    assert emitter.wait_time(100.5, 5.0) == pytest.approx(0.5)
+    assert len(emitter.due(101.0)) == 2
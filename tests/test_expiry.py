@@ -0,0 +1,55 @@
+from sbs2mav import SbsModel
+from sbs_lines import msg, fields
+
+
+def line_at(icao: str, clock: str, **kw) -> list:
+    return fields(msg(icao, clock=clock, **kw))
+
+
+def test_delete_lost_aircraft_uses_latest_time():
+    model = SbsModel(timeout=30)
+    expired = []
+    model.add_expire_listener(expired.append)
+    model.set_vehicles([
+        line_at('000001', '12:00:00.000', alt='1000'),
+        line_at('000002', '12:00:10.000', alt='1000'),
+    ])
+    t0 = model.vehicles[1].time_gen
+    # 000001はその後も受信している
+    model.set_vehicles([line_at('000001', '12:00:20.000', alt='1100')])
+
+    assert model.delete_lost_aircraft(t0 + 29) == []
+    assert [v.icao for v in model.delete_lost_aircraft(t0 + 40)] == [2]
+    assert set(model.vehicles) == {1}
+    assert [v.icao for v in expired] == [2]
+    # 積み直した最新の受信時刻で削除される
+    assert model.delete_lost_aircraft(t0 + 49) == []
+    assert [v.icao for v in model.delete_lost_aircraft(t0 + 50)] == [1]
+    assert model.vehicles == {}
+    assert model.expired == 2
+    assert model._expiry == []
+
+
+def test_delete_lost_aircraft_cleans_dirty_and_grid():
+    model = SbsModel(timeout=30)
+    model.set_vehicles([line_at('ABCDEF', '12:00:00.000', lat='35.5', lon='139.7')])
+    t0 = model.vehicles[0xABCDEF].time_gen
+    assert 0xABCDEF in model.dirty
+    model.delete_lost_aircraft(t0 + 30)
+    assert 0xABCDEF not in model.dirty
+    assert model.grid.query(35.5, 139.7, n=5) == []
+
+
+def test_delete_lost_aircraft_matches_full_scan():
+    model = SbsModel(timeout=30)
+    lines = []
+    for i in range(200):
+        icao = f'{i % 50:06X}'
+        lines.append(line_at(icao, f'12:{i // 60:02d}:{i % 60:02d}.000', alt=str(1000 + i)))
+    model.set_vehicles(lines)
+    start = model.decoder.decode('2024/01/15', '12:00:00.000')
+    for now in range(int(start), int(start) + 240, 7):
+        limit = now - model.timeout
+        lost = {icao for icao, v in model.vehicles.items() if v.time_gen <= limit}
+        assert {v.icao for v in model.delete_lost_aircraft(now)} == lost
+        assert all(v.time_gen > limit for v in model.vehicles.values())
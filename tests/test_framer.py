@@ -0,0 +1,75 @@
+import asyncio
+
+from sbs2mav import SbsClient, SbsFramer, SbsModel
+from sbs_lines import msg, fields
+
+
+def test_line_split_across_reads():
+    line = msg('ABCDEF', alt='35000', lat='35.5', lon='139.7')
+    data = (line + '\r\n').encode()
+    for cut in range(1, len(data)):
+        framer = SbsFramer()
+        got = framer.feed(data[:cut]) + framer.feed(data[cut:])
+        assert got == [fields(line)], cut
+    assert framer.partial == b''
+
+
+def test_crlf_split_between_reads():
+    framer = SbsFramer()
+    a = msg('ABCDEF', alt='1000')
+    b = msg('123456', alt='2000')
+    assert framer.feed((a + '\r').encode()) == []
+    assert framer.feed(('\n' + b + '\r\n').encode()) == [fields(a), fields(b)]
+    # CRだけが残ったまま次の行が来ても、フィールドにCRは残らない
+    assert framer.feed(b'\r') == []
+    assert framer.feed(b'\n') == []
+
+
+def test_overlong_partial_line_is_dropped():
+    framer = SbsFramer()
+    assert framer.feed(b'MSG,' + b'x' * (SbsFramer.MAX_LINE + 1)) == []
+    assert framer.partial == b''
+    line = msg('ABCDEF', alt='1000')
+    # 捨てた行の続きは次の行末までで1行になり、MSG行ではないので読み飛ばす
+    assert framer.feed(b'xxxx\r\n' + (line + '\r\n').encode()) == [fields(line)]
+
+
+def test_only_msg_lines():
+    framer = SbsFramer()
+    line = msg('ABCDEF', alt='1000')
+    data = ('STA,,1,1,ABCDEF,1,2024/01/15,12:00:00.000,2024/01/15,12:00:00.000,RM\r\n'
+        'AIR,,1,1,ABCDEF,1\r\n'
+        '\r\n'
+        'MSG\r\n'
+        + line + '\r\n'
+        'CLK,,,,,,\r\n').encode()
+    assert framer.feed(data) == [fields(line)]
+
+
+def test_reconnect_resets_partial_line():
+    line = msg('ABCDEF', alt='35000')
+    sends = [msg('111111', alt='1000')[:20].encode(), (line + '\r\n').encode()]
+
+    async def main():
+        async def handle(reader, writer):
+            writer.write(sends.pop(0))
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        model = SbsModel()
+        sbs = SbsClient(model, '127.0.0.1', port)
+        try:
+            for _ in range(2):
+                async with sbs:
+                    while await sbs.recv():
+                        pass
+        finally:
+            server.close()
+        return model, sbs
+
+    model, sbs = asyncio.run(main())
+    assert sbs.connects == 2
+    assert list(model.vehicles) == [0xABCDEF]
+    assert model.rejected == 0
@@ -0,0 +1,196 @@
+import time
+import socket
+import struct
+import asyncio
+
+from sbs2mav import SbsClient, SbsModel
+from sbs_ingest import IngestPool, RingSink, ShmRing, run_feed
+from sbs_lines import msg, fields
+
+
+class Wake:
+    def __init__(self) -> None:
+        self.count = 0
+
+    def send_bytes(self, data: bytes) -> None:
+        self.count += 1
+
+
+def test_ring_sink_accepts_the_sbs_client_call():
+    ring = ShmRing.create(16)
+    try:
+        sink = RingSink(ring, Wake())
+        accepted = []
+        lines = [fields(msg('ABCDEF', alt='35000')), fields(msg('ZZZZZZ', alt='1'))]
+        sink.set_vehicles(lines, accepted)
+        assert accepted == lines[:1]
+        assert sink.rejected == 1
+        assert [u[0] for u in ring.read(16)] == [0xABCDEF]
+    finally:
+        ring.close()
+
+
+def test_ring_sink_rejects_out_of_range():
+    ring = ShmRing.create(16)
+    try:
+        sink = RingSink(ring, Wake())
+        sink.set_vehicles([fields(msg('ABCDEF', alert='200')), fields(msg('123456', alert='-1'))])
+        assert sink.rejected == 1
+        assert [u[0] for u in ring.read(16)] == [0x123456]
+    finally:
+        ring.close()
+
+
+def test_run_feed_reconnects_after_reset():
+    data = (msg('ABCDEF', alt='35000') + '\r\n').encode()
+
+    async def main(ring):
+        connects = 0
+
+        async def handle(reader, writer):
+            nonlocal connects
+            connects += 1
+            if connects == 1:
+                # RSTで切断する
+                sock = writer.get_extra_info('socket')
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                writer.transport.abort()
+                return
+            writer.write(data)
+            await writer.drain()
+            await reader.read()
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        sink = RingSink(ring, Wake())
+        sbs = SbsClient(sink, '127.0.0.1', port)
+        sbs.RETRY_MIN = 0.01
+        task = asyncio.create_task(run_feed(0, sink, sbs))
+        try:
+            for _ in range(200):
+                if len(ring) or task.done():
+                    break
+                await asyncio.sleep(0.02)
+            assert not task.done(), task.exception()
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            server.close()
+        return sbs
+
+    ring = ShmRing.create(16)
+    try:
+        sbs = asyncio.run(main(ring))
+        assert [u[0] for u in ring.read(16)] == [0xABCDEF]
+        assert sbs.connects == 2
+    finally:
+        ring.close()
+
+
+def test_ingest_pool_end_to_end():
+    now = time.localtime()
+    date = time.strftime('%Y/%m/%d', now)
+    clock = time.strftime('%H:%M:%S.000', now)
+    data = ''.join(msg(f'{0x800000 + i:06X}', date=date, clock=clock, callsign=f'TEST{i}', alt='1000') + '\r\n'
+        for i in range(5)).encode()
+
+    async def main():
+        async def handle(reader, writer):
+            writer.write(data)
+            await writer.drain()
+            await reader.read()
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        model = SbsModel()
+        pool = IngestPool(model, [('127.0.0.1', port)], 1)
+        task = asyncio.create_task(pool.run())
+        try:
+            for _ in range(200):
+                if len(model.vehicles) == 5:
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            server.close()
+        return model
+
+    model = asyncio.run(main())
+    assert sorted(model.vehicles) == [0x800000 + i for i in range(5)]
+    assert model.vehicles[0x800002].callsign == 'TEST2'
+    assert model.parsed == 5
+
+
+def update(icao: int) -> tuple:
+    return (icao, 0x10, 1.5, 2.5, 'CALL', 100, 200, 90, 35.5, 139.5, -64, 1200, 0, 0, 0, 0)
+
+
+def test_ring_wraps_around_and_fills():
+    ring = ShmRing.create(4)
+    try:
+        assert ring.write([update(1), update(2), update(3)]) == 3
+        assert [u[0] for u in ring.read(2)] == [1, 2]
+        assert ring.write([update(4), update(5), update(6), update(7)]) == 3
+        assert len(ring) == 4
+        got = ring.read(10)
+        assert [u[0] for u in got] == [3, 4, 5, 6]
+        assert got[0] == update(3)
+        assert ring.read(10) == []
+    finally:
+        ring.close()
+
+
+def test_ring_wake_handshake():
+    ring = ShmRing.create(4)
+    try:
+        assert not ring.need_wake()
+        assert ring.wait()
+        ring.write([update(1)])
+        assert ring.need_wake()
+        assert not ring.need_wake()
+        # 空でなければ待たない
+        assert not ring.wait()
+        ring.read(4)
+        assert ring.wait()
+    finally:
+        ring.close()
+
+
+def test_worker_wakes_the_pool_without_polling():
+    class SlowPoll(IngestPool):
+        POLL_INTERVAL = 30.0
+
+    now = time.localtime()
+    data = (msg('ABCDEF', date=time.strftime('%Y/%m/%d', now), clock=time.strftime('%H:%M:%S.000', now),
+        alt='1000') + '\r\n').encode()
+
+    async def main():
+        async def handle(reader, writer):
+            # 取り込み側がリングバッファを空と確認して待ち始めてから送る
+            await asyncio.sleep(1.0)
+            writer.write(data)
+            await writer.drain()
+            await reader.read()
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        model = SbsModel()
+        pool = SlowPoll(model, [('127.0.0.1', port)], 1)
+        task = asyncio.create_task(pool.run())
+        start = time.monotonic()
+        try:
+            while not model.vehicles and time.monotonic() - start < 10:
+                await asyncio.sleep(0.01)
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            server.close()
+        return model, time.monotonic() - start
+
+    model, elapsed = asyncio.run(main())
+    assert list(model.vehicles) == [0xABCDEF]
+    assert elapsed < 10
@@ -0,0 +1,102 @@
+import pytest
+
+pytest.importorskip('pymavlink')
+
+import sbs2mav
+from sbs2mav import AdsbFrameCache, MavFanout, Vehicle, send_adsb_vehicle
+from pymavlink.dialects.v10 import ardupilotmega as mavlink1
+from pymavlink.dialects.v20 import ardupilotmega as mavlink2
+
+
+class Conn:
+    def __init__(self, dialect) -> None:
+        self.mav = dialect.MAVLink(None, srcSystem=1, srcComponent=dialect.MAV_COMP_ID_ADSB)
+        self.WIRE_PROTOCOL_VERSION = dialect.WIRE_PROTOCOL_VERSION
+        self.frames = []
+
+    def write(self, buf: bytes) -> None:
+        self.frames.append(buf)
+
+
+def full_vehicle() -> Vehicle:
+    v = Vehicle(0xABCDEF)
+    v.flags = (Vehicle.VALID_COORDS | Vehicle.VALID_ALTITUDE | Vehicle.VALID_HEADING | Vehicle.VALID_VELOCITY
+        | Vehicle.VALID_CALLSIGN | Vehicle.VALID_SQUAWK | Vehicle.VERTICAL_VELOCITY_VALID | Vehicle.BARO_VALID
+        | Vehicle.VALID_ALERT)
+    v.lat, v.lon, v.alt = 35.54321, -139.76543, 35000
+    v.track, v.gs, v.vrate, v.squawk = 271, 452, -640, 7700
+    v.callsign = 'JAL123'
+    v.emitter_type = 3
+    return v
+
+
+def expected_frame(dialect, seq: int, v: Vehicle, tslc: int) -> bytes:
+    '''pymavlinkでエンコードした同じADSB_VEHICLE'''
+    mav = dialect.MAVLink(None, srcSystem=1, srcComponent=dialect.MAV_COMP_ID_ADSB)
+    mav.seq = seq
+    flags = v.flags & Vehicle.ADSB_FLAGS_MASK
+    msg = dialect.MAVLink_adsb_vehicle_message(v.icao, int(v.lat * 10**7), int(v.lon * 10**7),
+        dialect.ADSB_ALTITUDE_TYPE_PRESSURE_QNH if flags & Vehicle.VALID_ALTITUDE else 0,
+        int(v.alt * 0.3048 * 1000), v.track * 100, int((v.gs * 1.852 * 1000 * 100) / 3600),
+        int(v.vrate * 0.3048 * 100 / 60), v.callsign.encode(), v.emitter_type, tslc, flags, v.squawk)
+    return msg.pack(mav)
+
+
+@pytest.fixture(autouse=True)
+def mavlink():
+    sbs2mav.load_mavlink()
+
+
+@pytest.mark.parametrize('dialect', [mavlink1, mavlink2], ids=['v1', 'v2'])
+@pytest.mark.parametrize('make', [full_vehicle, lambda: Vehicle(0x000001)], ids=['full', 'empty'])
+def test_adsb_vehicle_matches_pymavlink(dialect, make):
+    conn = Conn(dialect)
+    conn.mav.seq = 254
+    out = MavFanout([conn])
+    cache = AdsbFrameCache()
+    v = make()
+
+    first = send_adsb_vehicle(out, cache, v, 0)
+    assert first == expected_frame(dialect, 254, v, 0)
+    # 値が変わらない再送は、キャッシュしたペイロードのtslcだけを書き換える
+    again = send_adsb_vehicle(out, cache, v, 7)
+    assert again == expected_frame(dialect, 255, v, 7)
+    # tslcは0〜255に収める
+    assert send_adsb_vehicle(out, cache, v, 300) == expected_frame(dialect, 0, v, 255)
+    assert conn.frames == [first, again, expected_frame(dialect, 0, v, 255)]
+
+    # 受信側のpymavlinkで同じ値に戻る
+    rx = dialect.MAVLink(None)
+    msg = rx.parse_char(first)
+    assert msg.get_type() == 'ADSB_VEHICLE'
+    assert (msg.ICAO_address, msg.callsign, msg.squawk) == (v.icao, v.callsign, v.squawk)
+
+
+@pytest.mark.parametrize('dialect', [mavlink1, mavlink2], ids=['v1', 'v2'])
+def test_resend_after_change(dialect):
+    out = MavFanout([Conn(dialect)])
+    cache = AdsbFrameCache()
+    v = full_vehicle()
+    send_adsb_vehicle(out, cache, v, 3)
+    v.alt = 36000
+    v.version += 1
+    seq = out.mav.seq
+    assert send_adsb_vehicle(out, cache, v, 0) == expected_frame(dialect, seq, v, 0)
+    cache.discard(v)
+    assert send_adsb_vehicle(out, cache, v, 1) == expected_frame(dialect, seq + 1, v, 1)
+
+
+def test_fanout_writes_one_frame_to_every_connection():
+    conns = [Conn(mavlink2), Conn(mavlink2)]
+    out = MavFanout(conns)
+    buf = send_adsb_vehicle(out, AdsbFrameCache(), full_vehicle(), 0)
+    assert conns[0].frames == conns[1].frames == [buf]
+    assert conns[0].mav.seq == 1
+
+
+def test_scheduler_estimate_is_the_bridge_frame_length():
+    # ブリッジはMAVLink1で送信する。frame_lenの初期値はその長さ
+    from sbs2mav import AdsbScheduler
+
+    out = MavFanout([Conn(mavlink1)])
+    assert len(send_adsb_vehicle(out, AdsbFrameCache(), full_vehicle(), 0)) == AdsbScheduler.ADSB_VEHICLE_LEN
@@ -0,0 +1,91 @@
+from datetime import datetime
+
+import pytest
+
+from sbs2mav import SbsParser, Vehicle
+from sbs_lines import msg, fields
+
+
+def test_parse_full_line():
+    update = SbsParser().parse(fields(msg('abcdef', callsign='JAL123', alt='35000', gs='450', track='90',
+        lat='35.5', lon='139.75', vrate='-640', squawk='1200', alert='0', emergency='0', spi='0', gnd='-1')))
+    (icao, mask, time_gen, time_log, callsign, alt, gs, track, lat, lon,
+        vrate, squawk, alert, emergency, spi, gnd) = update
+    assert icao == 0xABCDEF
+    assert mask == (Vehicle.VALID_CALLSIGN | Vehicle.VALID_ALTITUDE | Vehicle.BARO_VALID | Vehicle.VALID_VELOCITY
+        | Vehicle.VALID_HEADING | Vehicle.VALID_COORDS | Vehicle.VERTICAL_VELOCITY_VALID | Vehicle.VALID_SQUAWK
+        | Vehicle.VALID_ALERT | Vehicle.VALID_EMERGENCY | Vehicle.VALID_SPI | Vehicle.VALID_GND)
+    assert time_gen == time_log == datetime(2024, 1, 15, 12).timestamp()
+    assert (callsign, alt, gs, track, lat, lon, vrate, squawk) == ('JAL123', 35000, 450, 90, 35.5, 139.75, -640, 1200)
+    assert (alert, emergency, spi, gnd) == (0, 0, 0, -1)
+
+
+def test_parse_missing_fields():
+    update = SbsParser().parse(fields(msg('123456', alt='1000', lat='35.5')))
+    assert update[1] == Vehicle.VALID_ALTITUDE | Vehicle.BARO_VALID
+    assert update[4:] == ('', 1000, 0, 0, 0.0, 0.0, 0, 0, 0, 0, 0, 0)
+
+
+@pytest.mark.parametrize('kw', [{'alt': 'x'}, {'lat': '35.5', 'lon': 'y'}, {'squawk': '12.5'}])
+def test_parse_broken_line(kw):
+    with pytest.raises(ValueError):
+        SbsParser().parse(fields(msg('123456', **kw)))
+    with pytest.raises(ValueError):
+        SbsParser().parse(fields(msg('zzzzzz')))
+
+
+def test_record_round_trip():
+    parser = SbsParser()
+    updates = [parser.parse(fields(line)) for line in (
+        msg('ABCDEF', callsign='JAL123', alt='35000', lat='35.5', lon='139.75', gnd='0'),
+        msg('123456', gs='450', track='270', vrate='64', squawk='7700', emergency='1'),
+        msg('0000FF', callsign='ANA12345'),
+    )]
+    buf = bytearray(len(updates) * SbsParser.RECORD.size)
+    for i, update in enumerate(updates):
+        SbsParser.pack_into(buf, i * SbsParser.RECORD.size, update)
+    assert SbsParser.unpack(buf) == updates
+
+
+@pytest.mark.parametrize('kw', [{'alert': '200'}, {'gnd': '-129'}, {'alt': str(2 ** 31)}, {'squawk': str(-2 ** 31 - 1)}])
+def test_parse_out_of_range(kw):
+    # RECORDに収まらない値は壊れた行として扱う
+    parser = SbsParser()
+    with pytest.raises(ValueError):
+        parser.parse(fields(msg('123456', **kw)))
+    with pytest.raises(ValueError):
+        parser.parse(fields(msg('1000000')))
+    update = parser.parse(fields(msg('FFFFFF', alert='-128', alt=str(2 ** 31 - 1))))
+    SbsParser.pack_into(bytearray(SbsParser.RECORD.size), 0, update)
+
+
+def test_models_share_the_parsing():
+    from sbs2mav import SbsModel, iter_lines
+    from sbs_ingest import RingSink, ShmRing
+
+    data = '\r\n'.join([
+        msg('ABCDEF', alt='1000'),
+        'STA,,1,1,ABCDEF,1,2024/01/15,12:00:00.000,2024/01/15,12:00:00.000,RM',
+        'MSG,3,1,1,123456,1',
+        msg('123456', alt='x'),
+        msg('123456', alert='200'),
+        msg('123456', gs='450'),
+    ]).encode() + b'\r\n'
+    batches = list(iter_lines([data]))
+
+    a = SbsModel()
+    for lines in batches:
+        a.set_vehicles(lines)
+    b = SbsModel()
+    assert [v.icao for v in b.iter_apply(batches)] == [0xABCDEF, 0x123456]
+    ring = ShmRing.create(16)
+    try:
+        sink = RingSink(ring, None)
+        accepted = []
+        for lines in batches:
+            sink.set_vehicles(lines, accepted)
+        assert len(accepted) == 2
+    finally:
+        ring.close()
+    assert (a.parsed, a.rejected) == (b.parsed, b.rejected) == (2, 2)
+    assert sink.rejected == 2
@@ -0,0 +1,53 @@
+import time
+import socket
+import struct
+import asyncio
+
+from sbs2mav import SbsClient, SbsModel, run_sbs
+from sbs_lines import msg
+
+
+def test_run_sbs_reconnects_after_reset():
+    # 受信のたびに削除されないように、現在時刻の行にする
+    now = time.localtime()
+    data = (msg('ABCDEF', date=time.strftime('%Y/%m/%d', now), clock=time.strftime('%H:%M:%S.000', now),
+        alt='35000') + '\r\n').encode()
+
+    async def main():
+        connects = 0
+
+        async def handle(reader, writer):
+            nonlocal connects
+            connects += 1
+            if connects == 1:
+                # RSTで切断する
+                sock = writer.get_extra_info('socket')
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                writer.transport.abort()
+                return
+            writer.write(data)
+            await writer.drain()
+            await reader.read()
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        model = SbsModel()
+        sbs = SbsClient(model, '127.0.0.1', port)
+        sbs.RETRY_MIN = 0.01
+        task = asyncio.create_task(run_sbs(model, sbs))
+        try:
+            for _ in range(200):
+                if model.vehicles or task.done():
+                    break
+                await asyncio.sleep(0.02)
+            assert not task.done(), task.exception()
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            server.close()
+        return model, sbs
+
+    model, sbs = asyncio.run(main())
+    assert list(model.vehicles) == [0xABCDEF]
+    assert sbs.connects == 2
@@ -0,0 +1,91 @@
+import asyncio
+
+from sbs_server import SbsServer
+from sbs_lines import msg, fields
+
+
+class Transport:
+    def __init__(self, buffered: int = 0) -> None:
+        self.buffered = buffered
+        self.aborted = False
+
+    def get_write_buffer_size(self) -> int:
+        return self.buffered
+
+    def abort(self) -> None:
+        self.aborted = True
+
+
+class Writer:
+    def __init__(self, buffered: int = 0) -> None:
+        self.transport = Transport(buffered)
+        self.data = []
+
+    def write(self, data: bytes) -> None:
+        self.data.append(data)
+
+    def get_extra_info(self, name: str):
+        return ('127.0.0.1', 0)
+
+
+def test_publish_without_clients_keeps_nothing():
+    server = SbsServer('127.0.0.1', 0)
+    server.publish([fields(msg('ABCDEF', alt='1000'))])
+    assert server.pending == []
+
+
+def test_flush_encodes_once_and_filters_tx():
+    server = SbsServer('127.0.0.1', 0, tx={'3', '4'})
+    a, b = Writer(), Writer()
+    server.writers.update((a, b))
+    lines = [fields(msg('ABCDEF', tx=3, alt='1000')), fields(msg('ABCDEF', tx=1, callsign='JAL123')),
+        fields(msg('123456', tx=4, gs='450'))]
+    server.publish(lines)
+    server.flush()
+    assert len(a.data) == len(b.data) == 1
+    # 全クライアントに同じbytesのオブジェクトを書き込む
+    assert a.data[0] is b.data[0]
+    assert a.data[0] == (msg('ABCDEF', tx=3, alt='1000') + '\r\n' + msg('123456', tx=4, gs='450') + '\r\n').encode()
+    assert server.lines == 2
+    assert server.bytes == 2 * len(a.data[0])
+    server.flush()
+    assert len(a.data) == 1
+
+
+def test_flush_drops_slow_client():
+    server = SbsServer('127.0.0.1', 0, max_buffer=1000)
+    fast, slow = Writer(), Writer(buffered=1001)
+    server.writers.update((fast, slow))
+    server.publish([fields(msg('ABCDEF', alt='1000'))])
+    server.flush()
+    assert slow.transport.aborted and slow.data == []
+    assert server.writers == {fast}
+    assert server.dropped == 1
+    assert len(fast.data) == 1
+
+
+def test_serve_over_tcp():
+    async def main():
+        server = SbsServer('127.0.0.1', 0)
+        tcp = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+        port = tcp.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for _ in range(100):
+            if server.writers:
+                break
+            await asyncio.sleep(0.01)
+        server.publish([fields(msg('ABCDEF', alt='1000'))])
+        server.flush()
+        line = await asyncio.wait_for(reader.readline(), 5)
+        writer.close()
+        for _ in range(100):
+            if not server.writers:
+                break
+            await asyncio.sleep(0.01)
+        tcp.close()
+        return server, line
+
+    server, line = asyncio.run(main())
+    assert line == (msg('ABCDEF', alt='1000') + '\r\n').encode()
+    assert server.connects == 1
+    assert not server.writers
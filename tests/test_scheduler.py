@@ -0,0 +1,42 @@
+from sbs2mav import SbsModel, AdsbEmitter, AdsbScheduler, Ownship
+from sbs_lines import msg, fields
+
+
+def make_model(*lines) -> SbsModel:
+    model = SbsModel()
+    model.set_vehicles([fields(line) for line in lines])
+    return model
+
+
+def test_periodic_mode_keeps_changes_for_priority():
+    model = make_model(msg('000001', alt='1000'), msg('000002', alt='2000'))
+    emitter = AdsbEmitter(model, on_change=False)
+    scheduler = AdsbScheduler()
+    for v in emitter.due(100.0):
+        emitter.sent(v, 100.0)
+    # 000002だけ変わった
+    model.set_vehicles([fields(msg('000002', alt='2100'))])
+    due = emitter.due(101.0)
+    assert len(due) == 2
+    for v in due:
+        scheduler.submit(v, 101.0)
+    assert [v.icao for v in scheduler.take(101.0)] == [2, 1]
+    assert not scheduler.queue
+    assert not model.dirty
+
+
+def test_budget_uses_the_sent_frame_length():
+    model = make_model(*(msg(f'{i:06X}', alt='1000') for i in range(1, 21)))
+    scheduler = AdsbScheduler(budget=460, ownship=Ownship())
+    scheduler.refill(0.0)
+    scheduler.charge_adsb(46)
+    scheduler.tokens = 0.0
+    scheduler.refill(1.0)
+    # バースト上限(460 * 0.1 = 46バイト)までしか貯まらない
+    for v in model.vehicles.values():
+        scheduler.submit(v, 1.0)
+    taken = scheduler.take(1.0)
+    assert len(taken) == 1
+    scheduler.charge_adsb(46)
+    assert scheduler.tokens == 0.0
+    assert scheduler.wait_time(1.0, 1.0) == 46 / 460
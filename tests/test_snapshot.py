@@ -0,0 +1,88 @@
+import time
+import asyncio
+
+import pytest
+
+from sbs2mav import SbsModel, Vehicle, save_snapshots
+from sbs_lines import msg, fields
+
+
+def make_model() -> SbsModel:
+    model = SbsModel(timeout=30)
+    model.set_vehicles([
+        fields(msg('ABCDEF', callsign='JAL123', alt='35000', gs='450', track='90', lat='35.5', lon='139.7',
+            vrate='-640', squawk='1200', alert='0', emergency='0', spi='0', gnd='0')),
+        fields(msg('123456', alt='1000')),
+    ])
+    return model
+
+
+def test_snapshot_round_trip(tmp_path):
+    model = make_model()
+    t = model.vehicles[0xABCDEF].time_gen
+    path = str(tmp_path / 'snap')
+    assert model.save_snapshot(path) == 2
+
+    restored = SbsModel(timeout=30)
+    assert restored.load_snapshot(path, t + 1) == 2
+    for icao, a in model.vehicles.items():
+        b = restored.vehicles[icao]
+        for name in Vehicle.__slots__:
+            if name not in ('changed', 'version', 'time_sent'):
+                assert getattr(b, name) == getattr(a, name), name
+        assert b.changed == b.flags
+        assert icao in restored.dirty
+    assert restored.dirty.event.is_set()
+    assert [k for _, k in restored.grid.query(35.5, 139.7, n=5)] == [0xABCDEF]
+    # 復元した航空機もtimeoutで削除される
+    assert {v.icao for v in restored.delete_lost_aircraft(t + 31)} == {0xABCDEF, 0x123456}
+
+
+def test_snapshot_drops_expired_and_existing(tmp_path):
+    model = make_model()
+    t = model.vehicles[0xABCDEF].time_gen
+    path = str(tmp_path / 'snap')
+    model.save_snapshot(path)
+
+    assert SbsModel(timeout=30).load_snapshot(path, t + 30) == 0
+    restored = SbsModel(timeout=30)
+    restored.set_vehicles([fields(msg('123456', alt='2000'))])
+    assert restored.load_snapshot(path, t + 1) == 1
+    assert restored.vehicles[0x123456].alt == 2000
+
+
+def test_snapshot_rejects_other_files(tmp_path):
+    path = tmp_path / 'snap'
+    path.write_bytes(b'SBSSNAP1' + bytes(20))
+    with pytest.raises(ValueError):
+        SbsModel().load_snapshot(str(path), time.time())
+    path.write_bytes(b'xx')
+    with pytest.raises(ValueError):
+        SbsModel().load_snapshot(str(path), time.time())
+
+
+def test_snapshot_out_of_range_line(tmp_path):
+    # 保存できない値の行は受け付けない
+    model = make_model()
+    model.set_vehicles([fields(msg('ABCDEF', alert='200'))])
+    assert model.rejected == 1
+    path = str(tmp_path / 'snap')
+    assert model.save_snapshot(path) == 2
+
+
+def test_save_snapshots_keeps_running(tmp_path):
+    model = make_model()
+    # 保存できない値でも定期保存は止まらない
+    model.vehicles[0xABCDEF].alert = 200
+
+    async def main():
+        task = asyncio.create_task(save_snapshots(model, str(tmp_path / 'snap'), 0.01))
+        await asyncio.sleep(0.1)
+        done = task.done()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return done
+
+    assert not asyncio.run(main())
+    assert not (tmp_path / 'snap').exists()
+    assert not (tmp_path / 'snap.tmp').exists()
@@ -0,0 +1,97 @@
+import math
+import time
+import random
+
+import pytest
+
+from spatial import SpatialGrid, distance, METERS_PER_DEG
+from sbs2mav import Ownship
+
+
+class CountingDict(dict):
+    def __init__(self, *args) -> None:
+        super().__init__(*args)
+        self.gets = 0
+        self.full_scans = 0
+
+    def get(self, key, default=None):
+        self.gets += 1
+        return super().get(key, default)
+
+    def items(self):
+        self.full_scans += 1
+        return super().items()
+
+    def __iter__(self):
+        self.full_scans += 1
+        return super().__iter__()
+
+
+def brute_force(points: dict, lat: float, lon: float, radius: float = None, n: int = None) -> list:
+    coslat = max(math.cos(math.radians(lat)), 0.01)
+    found = []
+    for key, (plat, plon) in points.items():
+        dy = (plat - lat) * METERS_PER_DEG
+        dx = (plon - lon) * METERS_PER_DEG * coslat
+        d = math.sqrt(dx * dx + dy * dy)
+        if radius is None or d <= radius:
+            found.append((d, key))
+    found.sort()
+    return found[:n] if n is not None else found
+
+
+@pytest.mark.parametrize('radius,n', [(50000, None), (None, 5), (30000, 3), (None, 500), (1e7, None)])
+def test_query_matches_brute_force(radius, n):
+    rnd = random.Random(1)
+    grid = SpatialGrid()
+    points = {}
+    for key in range(300):
+        p = (35 + rnd.uniform(-2, 2), 139 + rnd.uniform(-2, 2))
+        points[key] = p
+        grid.update(key, *p)
+    for _ in range(10):
+        lat, lon = 35 + rnd.uniform(-3, 3), 139 + rnd.uniform(-3, 3)
+        assert grid.query(lat, lon, radius, n) == brute_force(points, lat, lon, radius, n)
+
+
+def test_query_accept_and_remove():
+    grid = SpatialGrid()
+    grid.update('a', 35.0, 139.0)
+    grid.update('b', 35.01, 139.0)
+    grid.update('c', 35.02, 139.0)
+    grid.update('a', 36.0, 139.0)
+    grid.remove('c')
+    assert [k for _, k in grid.query(35.0, 139.0, n=2)] == ['b', 'a']
+    assert [k for _, k in grid.query(35.0, 139.0, n=2, accept=lambda k: k != 'b')] == ['a']
+    assert len(grid) == 2
+
+
+def test_nearest_scales_with_nearby_cells():
+    rnd = random.Random(2)
+    grid = SpatialGrid()
+    for key in range(2000):
+        grid.update(key, 35 + rnd.uniform(-5, 5), 139 + rnd.uniform(-5, 5))
+    grid.cells = CountingDict(grid.cells)
+    found = grid.query(35.0, 139.0, n=3)
+    assert len(found) == 3
+    assert grid.cells.full_scans == 0
+    assert grid.cells.gets < 100
+
+
+def test_distance():
+    assert distance(35.0, 139.0, 36.0, 139.0) == pytest.approx(METERS_PER_DEG)
+
+
+class Position:
+    lat = 350000000
+    lon = 1390000000
+    alt = 100000
+
+
+def test_ownship_position_goes_stale():
+    ownship = Ownship(timeout=5.0)
+    assert not ownship.valid
+    ownship.set_position(Position(), time.time())
+    assert ownship.valid
+    ownship.set_position(Position(), time.time() - 10)
+    assert not ownship.valid
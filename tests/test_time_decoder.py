@@ -0,0 +1,50 @@
+import os
+import time
+from datetime import datetime
+
+import pytest
+
+from sbs2mav import SbsTimeDecoder
+
+
+@pytest.fixture
+def local_zone():
+    '''ローカルタイムゾーンを一時的に切り替える'''
+    saved = os.environ.get('TZ')
+
+    def set_zone(zone: str) -> None:
+        os.environ['TZ'] = zone
+        time.tzset()
+
+    yield set_zone
+    if saved is None:
+        os.environ.pop('TZ', None)
+    else:
+        os.environ['TZ'] = saved
+    time.tzset()
+
+
+def expected(date: str, clock: str) -> float:
+    return datetime.strptime(f'{date} {clock}', '%Y/%m/%d %H:%M:%S.%f').timestamp()
+
+
+@pytest.mark.parametrize('zone', ['America/New_York', 'Europe/Berlin', 'Asia/Tokyo', 'UTC'])
+@pytest.mark.parametrize('date', ['2024/03/10', '2024/03/31', '2024/11/03', '2024/10/27', '2024/06/15'])
+def test_decode_matches_full_conversion(local_zone, zone, date):
+    local_zone(zone)
+    decoder = SbsTimeDecoder()
+    for hour in range(24):
+        for clock in (f'{hour:02d}:00:00.000', f'{hour:02d}:30:15.250', f'{hour:02d}:59:59.999'):
+            if hour == 2 and date in ('2024/03/10', '2024/03/31'):
+                # 夏時間の開始で存在しない時刻
+                continue
+            assert decoder.decode(date, clock) == pytest.approx(expected(date, clock), abs=1e-6), clock
+
+
+def test_dst_day_is_continuous(local_zone):
+    local_zone('America/New_York')
+    decoder = SbsTimeDecoder()
+    # 2024/03/10 01:59:59 EST の1秒後は 03:00:00 EDT
+    assert decoder.decode('2024/03/10', '03:00:00.000') - decoder.decode('2024/03/10', '01:59:59.000') == 1.0
+    # 切り替え後も1日の最後は翌日0時の直前になる
+    assert decoder.decode('2024/03/11', '00:00:00.000') - decoder.decode('2024/03/10', '23:59:59.000') == 1.0